@@ -1,40 +1,427 @@
 """Context manager for boilerplate and teardown code of DB transaction."""
+import os
+import re
+import time
+from collections import deque
+from threading import Condition, Lock, local
+
 import mariadb
 
+from metrics import add_time
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection frees up within the timeout."""
+    pass
+
+
+class RepeatedQuery(Exception):
+    """Raised by a strict QueryTracer when a request repeats a query."""
+    pass
+
+
+# Literals and placeholders replaced by '?' in normalized SQL.
+_LITERALS_RE = re.compile(r"'(?:[^'\\]|\\.|'')*'|\b\d+(?:\.\d+)?\b|%s|\?")
+# Runs of placeholders, e.g. in 'in (...)' lists or multi-row inserts.
+_PLACEHOLDER_LIST_RE = re.compile(r'\?(?:\s*,\s*\?)+')
+
+
+def normalize_sql(sql: str) -> str:
+    """Reduce a query to its shape: literals and spacing removed."""
+    sql = _LITERALS_RE.sub('?', ' '.join(sql.split()))
+    return _PLACEHOLDER_LIST_RE.sub('?+', sql)
+
+
+class QueryTracer():
+    """Collect timings of queries run through traced cursors.
+
+    Attributes:
+        - slow_threshold: seconds after which a query is logged as slow
+        - slow_log: most recent slow queries as dicts
+        - strict: raise RepeatedQuery at the end of a request that ran
+                  an identical query (same SQL and parameters) twice
+        - counters: totals of queries, rows, time and findings
+
+    Repeated queries are tracked per scope; the app opens a scope at
+    the start of each request and closes it at the end.
+    """
+
+    def __init__(self, slow_threshold: float=0.1, log_size: int=100,
+                 strict: bool=False) -> None:
+        self.slow_threshold = slow_threshold
+        self.slow_log = deque(maxlen=log_size)
+        self.strict = strict
+        self.counters = {'queries': 0, 'rows': 0, 'slow': 0, 'repeated': 0,
+                         'execute_seconds': 0.0, 'fetch_seconds': 0.0}
+        self._lock = Lock()
+        self._scope = local()
+
+    def begin_scope(self) -> None:
+        """Start tracking repeated queries (e.g. for one request)."""
+        self._scope.seen = {}
+
+    def end_scope(self, name: str='') -> list[tuple]:
+        """Stop tracking and return (normalized SQL, count) repeats."""
+        seen = getattr(self._scope, 'seen', None)
+        self._scope.seen = None
+        if not seen:
+            return []
+
+        repeats = [(sql, n) for (sql, _), n in seen.items() if n > 1]
+        for sql, n in repeats:
+            print('[DB] Query repeated {0} times{1}: {2}'.format(
+                n, ' in ' + name if name else '', sql))
+        if repeats:
+            with self._lock:
+                self.counters['repeated'] += len(repeats)
+            if self.strict:
+                raise RepeatedQuery('{0} repeated queries{1}.'.format(
+                    len(repeats), ' in ' + name if name else ''))
+        return repeats
+
+    def record(self, sql: str, nparams: int, params_key: str,
+               execute_seconds: float, fetch_seconds: float, rows: int) -> None:
+        """Account for one finished statement."""
+        normalized = normalize_sql(sql)
+        seen = getattr(self._scope, 'seen', None)
+        if seen is not None:
+            key = (normalized, params_key)
+            seen[key] = seen.get(key, 0) + 1
+
+        total = execute_seconds + fetch_seconds
+        with self._lock:
+            c = self.counters
+            c['queries'] += 1
+            c['rows'] += max(rows, 0)
+            c['execute_seconds'] += execute_seconds
+            c['fetch_seconds'] += fetch_seconds
+            if total >= self.slow_threshold:
+                c['slow'] += 1
+                self.slow_log.append({'sql': normalized, 'binds': nparams,
+                                      'execute_seconds': execute_seconds,
+                                      'fetch_seconds': fetch_seconds,
+                                      'rows': rows, 'at': time.time()})
+        if total >= self.slow_threshold:
+            print('[DB] Slow query ({0:.3f}s, {1} rows): {2}'.format(total, rows,
+                                                                    normalized))
+
+    def stats(self) -> dict:
+        """Return tracing counters."""
+        with self._lock:
+            return dict(self.counters)
+
+
+class TracingCursor():
+    """Cursor wrapper timing statements and counting fetched rows.
+
+    A statement is accounted for when the next one is executed or the
+    cursor is closed, so fetch time and row count are complete.
+    """
+
+    def __init__(self, cursor: 'MariaDB cursor', tracer: QueryTracer) -> None:
+        self._cursor = cursor
+        self._tracer = tracer
+        self._statement = None
+
+    def __getattr__(self, name: str) -> object:
+        # Everything not traced is served by the real cursor.
+        return getattr(self._cursor, name)
+
+    def _finish(self) -> None:
+        """Hand the previous statement's numbers to the tracer."""
+        if self._statement is not None:
+            self._tracer.record(*self._statement)
+            self._statement = None
+
+    def _start(self, sql: str, params: 'tuple | list', many: bool,
+               execute_seconds: float) -> None:
+        """Remember a just executed statement."""
+        nparams = sum(len(p) for p in params) if many else len(params or ())
+        rows = self._cursor.rowcount if many or self._cursor.description is None else 0
+        # Identical repeats need equal parameters; their repr is the key.
+        self._statement = [sql, nparams, repr(params), execute_seconds, 0.0, rows]
+
+    def execute(self, sql: str, params: 'tuple | list'=(), *args, **kwargs) -> None:
+        self._finish()
+        started = time.perf_counter()
+        self._cursor.execute(sql, params, *args, **kwargs)
+        self._start(sql, params, False, time.perf_counter() - started)
+
+    def executemany(self, sql: str, params: list, *args, **kwargs) -> None:
+        self._finish()
+        started = time.perf_counter()
+        self._cursor.executemany(sql, params, *args, **kwargs)
+        self._start(sql, params, True, time.perf_counter() - started)
+
+    def _fetch(self, method: str, *args) -> object:
+        """Call a fetch method, adding its time and rows to the statement."""
+        started = time.perf_counter()
+        result = getattr(self._cursor, method)(*args)
+        if self._statement is not None:
+            self._statement[4] += time.perf_counter() - started
+            if method == 'fetchone':
+                self._statement[5] += result is not None
+            else:
+                self._statement[5] += len(result)
+        return result
+
+    def fetchone(self) -> 'tuple | None':
+        return self._fetch('fetchone')
+
+    def fetchmany(self, size: int=None) -> list:
+        return self._fetch('fetchmany', *(() if size is None else (size,)))
+
+    def fetchall(self) -> list:
+        return self._fetch('fetchall')
+
+    def __iter__(self) -> 'Generator[tuple]':
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def close(self) -> None:
+        self._finish()
+        self._cursor.close()
+
+
+class ConnectionPool():
+    """Keep a bounded set of open MariaDB connections for reuse.
+
+    Attributes:
+        - configuration: database configuration passed to the connector
+        - size: maximum number of connections open at once
+        - timeout: seconds to wait for a free connection before giving up
+        - ping_interval: idle seconds after which a connection is pinged
+                         before being handed out again
+        - max_lifetime: seconds after which a connection is replaced
+                        (0 keeps connections indefinitely)
+        - counters: checkout, wait, timeout and reconnect statistics
+        - tracer: QueryTracer used by UseDatabase for pooled connections
+
+    Connections are opened lazily, so a pool created in the uWSGI master
+    holds no sockets when workers are forked. Each worker detects the
+    fork through its pid and starts with an empty pool of its own.
+    """
+
+    def __init__(self, config: dict, size: int=5, timeout: float=10.0,
+                 ping_interval: float=30.0, max_lifetime: float=3600.0,
+                 connector: object=mariadb.connect,
+                 tracer: QueryTracer=None) -> None:
+        """Initialize pool settings. No connection is opened here."""
+        self.configuration = config
+        # Cursors of pooled connections are traced if a tracer is set.
+        self.tracer = tracer
+        self.size = size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.max_lifetime = max_lifetime
+        self.connector = connector
+
+        self._cond = Condition()
+        self._reset_state()
+
+    def _reset_state(self) -> None:
+        """Forget all connections (used at creation and after a fork)."""
+        self._pid = os.getpid()
+        # Idle connections as (connection, created_at, last_used) tuples.
+        self._idle = deque()
+        # Number of connections currently checked out (or being opened).
+        self._nbusy = 0
+        # Creation time of every checked out connection, keyed by id().
+        self._created = {}
+        self.counters = {'checkouts': 0, 'waits': 0, 'timeouts': 0,
+                         'connects': 0, 'reconnects': 0, 'discards': 0}
+
+    def _count(self, name: str) -> None:
+        """Increment a counter from outside the pool's lock."""
+        # _cond wraps an RLock, so callers already holding it are fine.
+        with self._cond:
+            self.counters[name] += 1
+
+    def _connect(self) -> object:
+        """Open a new connection with the pool's configuration."""
+        conn = self.connector(**self.configuration)
+        self._count('connects')
+        return conn
+
+    def _is_healthy(self, conn: object, created_at: float,
+                    last_used: float) -> bool:
+        """Check if an idle connection can be handed out as is."""
+        now = time.monotonic()
+        if self.max_lifetime and now - created_at > self.max_lifetime:
+            return False
+        # Recently used connections are trusted to avoid a round-trip.
+        if now - last_used < self.ping_interval:
+            return True
+        try:
+            conn.ping()
+            return True
+        except mariadb.Error:
+            return False
+
+    def _discard(self, conn: object) -> None:
+        """Close a connection that is no longer usable."""
+        self._count('discards')
+        try:
+            conn.close()
+        except mariadb.Error:
+            pass
+
+    def _free_slot(self) -> None:
+        """Give back a checked out slot and wake up one waiter."""
+        with self._cond:
+            self._nbusy -= 1
+            self._cond.notify()
+
+    def acquire(self) -> object:
+        """Check out a healthy connection, waiting if the pool is full.
+
+        Raises PoolTimeout if no connection becomes free within
+        'timeout' seconds.
+        """
+        with self._cond:
+            # Connections inherited from the uWSGI master belong to it.
+            if self._pid != os.getpid():
+                self._reset_state()
+
+            deadline = time.monotonic() + self.timeout
+            waited = False
+            while not self._idle and self._nbusy >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.counters['timeouts'] += 1
+                    raise PoolTimeout('No database connection free after '
+                                      '{} seconds.'.format(self.timeout))
+                if not waited:
+                    self.counters['waits'] += 1
+                    waited = True
+                self._cond.wait(remaining)
+
+            self.counters['checkouts'] += 1
+            # Reserve the slot before leaving the lock.
+            self._nbusy += 1
+            conn = None
+            if self._idle:
+                conn, created_at, last_used = self._idle.pop()
+
+        # Pinging and connecting happen outside the lock.
+        try:
+            if conn is not None and not self._is_healthy(conn, created_at,
+                                                         last_used):
+                self._discard(conn)
+                self._count('reconnects')
+                conn = None
+            if conn is None:
+                conn = self._connect()
+                created_at = time.monotonic()
+        except BaseException:
+            self._free_slot()
+            raise
+
+        with self._cond:
+            self._created[id(conn)] = created_at
+        return conn
+
+    def release(self, conn: object) -> None:
+        """Return a connection to the pool after resetting its session.
+
+        Session state (variables, temporary tables, open transactions)
+        is cleared so the next user starts from a clean connection.
+        Connections that fail the reset are closed instead.
+        """
+        with self._cond:
+            if self._pid != os.getpid():
+                # Connection was checked out before a fork; drop it.
+                return
+            created_at = self._created.pop(id(conn), time.monotonic())
+
+        try:
+            conn.reset()
+        except mariadb.Error:
+            self._discard(conn)
+            self._free_slot()
+            return
+
+        with self._cond:
+            self._nbusy -= 1
+            self._idle.append((conn, created_at, time.monotonic()))
+            self._cond.notify()
+
+    def close(self) -> None:
+        """Close all idle connections held by the pool."""
+        with self._cond:
+            while self._idle:
+                conn, _, _ = self._idle.pop()
+                self._discard(conn)
+
+    def stats(self) -> dict:
+        """Return pool counters along with current occupancy."""
+        with self._cond:
+            stats = dict(self.counters)
+            stats['idle'] = len(self._idle)
+            stats['busy'] = self._nbusy
+            stats['size'] = self.size
+        return stats
+
 
 class UseDatabase():
     """Set up MariaDB cursor to execute queries and cleanup afterwards.
 
     Attributes:
-        - configuration: database configuration
+        - configuration: database configuration or a ConnectionPool
         - conn: MariaDB connection object
         - cursor: MariaDB cursor object
+
+    When given a ConnectionPool, the connection is checked out of and
+    returned to the pool instead of being opened and closed each time.
+    With a QueryTracer (given or the pool's), the cursor is wrapped in a
+    TracingCursor. Other keyword arguments (such as buffered=False, to
+    stream large results) are passed on to the connection's cursor().
     """
 
-    def __init__(self, config: dict) -> None:
-        """Initialize configuration with passed dictionary."""
+    def __init__(self, config: 'dict | ConnectionPool',
+                 tracer: QueryTracer=None, **cursor_options) -> None:
+        """Initialize configuration with passed dictionary or pool."""
         # dunder init takes care of all object creation argument(s)
         self.configuration = config
+        self.tracer = tracer or getattr(config, 'tracer', None)
+        self.cursor_options = cursor_options
 
     def __enter__(self) -> 'MariaDB cursor':
         """Connect with DB, initialize cursor and return it."""
         # The 'conn' and 'cursor' are prefixed with 'self'
         # so that they survive for use in 'dunder exit'
-        self.conn = mariadb.connect(**self.configuration)
-        self.cursor = self.conn.cursor()
+        self.started = time.perf_counter()
+        if isinstance(self.configuration, ConnectionPool):
+            self.conn = self.configuration.acquire()
+        else:
+            self.conn = mariadb.connect(**self.configuration)
+        self.cursor = self.conn.cursor(**self.cursor_options)
+        if self.tracer:
+            self.cursor = TracingCursor(self.cursor, self.tracer)
         return self.cursor
 
     def __exit__(self, exc_type, exc_value, exc_trace) -> None:
         """Close cursor and connection after commiting transactions."""
-        # Check if there was an Exception while executing queries
-        if exc_type:
-            # print('Rolling back ...')
-            self.conn.rollback()
-        else:
-            self.conn.commit()
+        try:
+            # Check if there was an Exception while executing queries
+            if exc_type:
+                # print('Rolling back ...')
+                self.conn.rollback()
+            else:
+                self.conn.commit()
 
-        self.cursor.close()
-        self.conn.close()
+            self.cursor.close()
+        finally:
+            # Pooled connections go back even if commit failed; the pool
+            # closes them if they can no longer be reset.
+            if isinstance(self.configuration, ConnectionPool):
+                self.configuration.release(self.conn)
+            else:
+                self.conn.close()
+            add_time('db', time.perf_counter() - self.started)
 
         # Raise Exception that occurred during query execution (if any)
         if exc_type:
@@ -0,0 +1,253 @@
+"""Asyncio counterpart of crud, for async views.
+
+The functions mirror crud's and return the same values, but they are
+coroutine functions running on the worker's background event loop (see
+aioloop), with connections from an aiomysql pool. A view awaiting them
+can overlap several queries:
+
+    user, page = await asyncio.gather(acrud.find_user(uid=uid),
+                                      acrud.get_payment_page(uid, 50))
+
+The pool is configured by init_app() from the same 'DB_*' settings as
+crud's, with 'ASYNC_DB_POOL_SIZE' connections at most (a waiting query
+costs no thread, so it can be much larger than crud's pool). The user
+cache is shared with crud, so writes through either invalidate it.
+
+Needs the optional 'aiomysql' package.
+"""
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
+import crud
+from aioloop import bridged
+from DBcm import PoolTimeout
+from usercache import UNCACHED_COLUMNS
+
+
+class AsyncPool():
+    """aiomysql pool opened lazily on the background loop of each worker.
+
+    Attributes:
+        - configuration: connection settings in aiomysql's names
+        - size: maximum number of connections open at once
+        - timeout: seconds to wait for a free connection
+        - max_lifetime: seconds after which a connection is replaced
+        - counters: checkouts, waits and timeouts
+    """
+
+    def __init__(self, config: dict, size: int=50, timeout: float=10.0,
+                 max_lifetime: float=3600.0) -> None:
+        """Initialize pool settings. No connection is opened here."""
+        if aiomysql is None:
+            raise ImportError('acrud needs the aiomysql package.')
+        self.configuration = config
+        self.size = size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.counters = {'checkouts': 0, 'waits': 0, 'timeouts': 0}
+        self._pool = None
+        self._pid = None
+        self._creating = None
+
+    async def _get_pool(self) -> 'aiomysql.Pool':
+        """Return this process's pool, creating it on first use."""
+        if self._pid != os.getpid():
+            # A pool inherited through a fork belongs to the parent.
+            self._pool, self._creating, self._pid = None, None, os.getpid()
+        if self._pool is None:
+            # Concurrent first queries share one pool creation.
+            if self._creating is None:
+                self._creating = asyncio.ensure_future(aiomysql.create_pool(
+                    minsize=0, maxsize=self.size, pool_recycle=self.max_lifetime,
+                    autocommit=False, **self.configuration))
+            self._pool = await self._creating
+        return self._pool
+
+    @asynccontextmanager
+    async def cursor(self) -> 'aiomysql.Cursor':
+        """Check out a connection and yield a cursor, like UseDatabase.
+
+        The transaction is committed if the block succeeds and rolled
+        back otherwise. Raises PoolTimeout if no connection is free
+        within 'timeout' seconds.
+        """
+        pool = await self._get_pool()
+        self.counters['checkouts'] += 1
+        if pool.freesize == 0 and pool.size >= self.size:
+            self.counters['waits'] += 1
+        try:
+            conn = await asyncio.wait_for(pool.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.counters['timeouts'] += 1
+            raise PoolTimeout('No database connection free after '
+                              '{} seconds.'.format(self.timeout))
+        try:
+            cursor = await conn.cursor()
+            try:
+                yield cursor
+                await conn.commit()
+            except BaseException:
+                await conn.rollback()
+                raise
+            finally:
+                await cursor.close()
+        finally:
+            pool.release(conn)
+
+    async def close(self) -> None:
+        """Close this process's pool and its connections, if opened."""
+        if self._pool is not None and self._pid == os.getpid():
+            pool, self._pool, self._creating = self._pool, None, None
+            pool.close()
+            await pool.wait_closed()
+
+    def stats(self) -> dict:
+        """Return pool counters along with current occupancy."""
+        stats = dict(self.counters)
+        pool = self._pool if self._pid == os.getpid() else None
+        stats['open'] = pool.size if pool else 0
+        stats['idle'] = pool.freesize if pool else 0
+        stats['size'] = self.size
+        return stats
+
+
+# Set up from the app's configuration by init_app().
+dbpool = None
+# Columns of user_details cached by the user cache, read on first use.
+user_columns = None
+
+
+def init_app(app: 'Flask') -> None:
+    """Configure the async pool from an app's 'DB_*' settings.
+
+    No connection is opened here.
+    """
+    global dbpool
+    # Same connection settings as crud's pool, in aiomysql's names.
+    names = {'database': 'db'}
+    dbconfig = {names.get(k, k): v for k, v in
+                ((k.removeprefix('DB_').lower(), v) for k, v in app.config.items()
+                 if k.startswith('DB_') and not k.startswith(('DB_POOL_', 'DB_TRACE_')))}
+    dbpool = AsyncPool(dbconfig,
+                       size=app.config.get('ASYNC_DB_POOL_SIZE', 50),
+                       timeout=app.config.get('DB_POOL_TIMEOUT', 10.0),
+                       max_lifetime=app.config.get('DB_POOL_MAX_LIFETIME', 3600.0))
+
+
+@bridged
+async def get_user(uname: str) -> 'dict | None':
+    """Fetch a user record, password hash included (see crud.get_user)."""
+    async with dbpool.cursor() as cursor:
+        _SQL = """select * from user_details where username=%s limit 1"""
+        await cursor.execute(_SQL, (uname,))
+        values = await cursor.fetchone()
+        if not values:
+            return None
+        to_dict = crud.description_row_factory(cursor)
+    user = to_dict(values)
+    if crud.user_cache:
+        crud.user_cache.put(user)
+    return user
+
+
+@bridged
+async def find_user(uid: int=None, username: str=None) -> 'dict | None':
+    """Fetch a user's record without password hash, through the user cache."""
+    global user_columns
+    if crud.user_cache:
+        user = crud.user_cache.get(uid, username)
+        if user is not None:
+            return user
+
+    column, value = ('id', uid) if uid is not None else ('username', username)
+    async with dbpool.cursor() as cursor:
+        if user_columns is None:
+            # Read here rather than through crud's catalog, whose
+            # blocking query would stall the loop.
+            _SQL = """select column_name from information_schema.columns
+                      where table_schema=database() and table_name='user_details'
+                      order by ordinal_position"""
+            await cursor.execute(_SQL)
+            user_columns = [row[0] for row in await cursor.fetchall()
+                            if row[0] not in UNCACHED_COLUMNS]
+
+        _SQL = """select {0} from user_details where {1}=%s limit 1""".format(
+            ', '.join(user_columns), column)
+        await cursor.execute(_SQL, (value,))
+        values = await cursor.fetchone()
+
+    if not values:
+        return None
+    user = dict(zip(user_columns, values))
+    if crud.user_cache:
+        crud.user_cache.put(user)
+    return user
+
+
+@bridged
+async def add_user(basic_data: dict, card_data: dict) -> None:
+    """Store a new user and their card atomically (see crud.add_user)."""
+    async with dbpool.cursor() as cursor:
+        _SQL = crud.prepare_insert(list(basic_data.keys()), 'user_details')
+        await cursor.execute(_SQL, tuple(basic_data.values()))
+        card_data['uid'] = newuser_id = cursor.lastrowid
+        _SQL = crud.prepare_insert(list(card_data.keys()), 'card_details')
+        await cursor.execute(_SQL, tuple(card_data.values()))
+
+    if crud.user_cache:
+        crud.user_cache.invalidate(newuser_id, basic_data['username'])
+
+
+@bridged
+async def update_password(uid: int, password_hash: str) -> None:
+    """Replace the stored password hash of a user."""
+    async with dbpool.cursor() as cursor:
+        _SQL = """update user_details set password=%s where id=%s"""
+        await cursor.execute(_SQL, (password_hash, uid))
+
+    if crud.user_cache:
+        crud.user_cache.invalidate(uid)
+
+
+@bridged
+async def get_employee(uname: str) -> 'dict | None':
+    """Fetch an employee record that matches the given username."""
+    async with dbpool.cursor() as cursor:
+        _SQL = """select * from emp_details where username=%s limit 1"""
+        await cursor.execute(_SQL, (uname,))
+        values = await cursor.fetchone()
+        if not values:
+            return None
+        to_dict = crud.description_row_factory(cursor)
+    return to_dict(values)
+
+
+@bridged
+async def get_payments(uid: int) -> list[tuple]:
+    """Fetch a list of all payments made by a given user account."""
+    async with dbpool.cursor() as cursor:
+        _SQL = """select trans_id, amount, tstamp, mode, note from payment_history where uid=%s"""
+        await cursor.execute(_SQL, (uid,))
+        return list(await cursor.fetchall())
+
+
+@bridged
+async def get_payment_page(uid: int, size: int, after: str=None,
+                           before: str=None) -> tuple[list, 'crud.PaymentPage']:
+    """Fetch a page of payments like crud.PaymentPage, all at once.
+
+    Return the rows, newest first, and the page with its cursors set.
+    Malformed cursors raise ValueError.
+    """
+    page = crud.PaymentPage(uid, size, after=after, before=before)
+    _SQL, params = page.query()
+    async with dbpool.cursor() as cursor:
+        await cursor.execute(_SQL, params)
+        rows = list(await cursor.fetchall())
+    return page.paginate(rows), page
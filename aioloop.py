@@ -0,0 +1,90 @@
+"""Event loop thread shared by the async data access of a worker.
+
+Flask runs each async view in an event loop of its own, created for
+that request. Connection pools and SMTP sessions cannot be shared
+between loops, so async I/O (acrud, mailutils.AsyncMailer) runs on one
+long-lived loop per worker process instead, in a background thread.
+
+Coroutine functions decorated with @bridged can be awaited from any
+loop: when called from another loop, they are scheduled on the shared
+one and the caller awaits the result. Several calls gathered by a view
+overlap their waits on the shared loop:
+
+    user, page = await asyncio.gather(acrud.find_user(uid=uid),
+                                      acrud.get_payment_page(uid, 50))
+"""
+import asyncio
+import os
+from functools import wraps
+from threading import Event, Lock, Thread
+
+
+class BackgroundLoop():
+    """An asyncio event loop running in a daemon thread.
+
+    The thread is started on first use in each process, so a loop
+    created before uWSGI forks its workers is never shared by them.
+    """
+
+    def __init__(self, name: str='aio-loop') -> None:
+        self.name = name
+        self._loop = None
+        self._pid = None
+        self._lock = Lock()
+
+    def _run(self, loop: asyncio.AbstractEventLoop, started: Event) -> None:
+        asyncio.set_event_loop(loop)
+        loop.call_soon(started.set)
+        loop.run_forever()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """Return this process's loop, starting its thread if needed."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    loop = asyncio.new_event_loop()
+                    started = Event()
+                    Thread(target=self._run, args=(loop, started), name=self.name,
+                           daemon=True).start()
+                    started.wait()
+                    self._loop, self._pid = loop, os.getpid()
+        return self._loop
+
+    def is_current(self) -> bool:
+        """Check if the caller runs on this loop."""
+        try:
+            return asyncio.get_running_loop() is self._loop and self._pid == os.getpid()
+        except RuntimeError:
+            return False
+
+    def run(self, coro: 'Coroutine', timeout: float=None) -> object:
+        """Run a coroutine on the loop and block until it finishes."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def stop(self) -> None:
+        """Stop the loop of this process, if started."""
+        if self._loop is not None and self._pid == os.getpid():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._pid = None
+
+
+# The loop of this worker process.
+background_loop = BackgroundLoop()
+
+
+def bridged(func: object) -> object:
+    """Make a coroutine function run on the background loop.
+
+    Called from that loop, the coroutine is returned as is. Called from
+    any other loop, it returns an awaitable of the result.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs) -> 'Awaitable':
+        coro = func(*args, **kwargs)
+        if background_loop.is_current():
+            return coro
+        future = asyncio.run_coroutine_threadsafe(coro, background_loop.loop)
+        return asyncio.wrap_future(future)
+
+    return wrapper
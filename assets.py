@@ -0,0 +1,183 @@
+"""Build step and URL rewriting for fingerprinted static assets.
+
+The build copies every file under static/ into static/dist/ with a
+hash of its content in the name (css/style.css becomes, say,
+css/style.3f2a9c1be0d4.css), writes gzip and brotli versions of text
+assets next to them and a WebP version of each PNG and JPEG image.
+static/dist/manifest.json maps original names to built ones:
+
+    flask --app main build-assets
+
+When a manifest exists, url_for('static', filename='css/style.css')
+points at the built file, which never changes and is sent with a
+year-long immutable Cache-Control header. Built files are meant to be
+served by uWSGI's static file offloading (see wsgi-config.ini), so no
+Python worker is taken up by them.
+
+Brotli and WebP output need the optional 'brotli' and 'Pillow'
+packages; without them those variants are skipped.
+"""
+import gzip
+import hashlib
+import json
+import os
+from io import BytesIO
+
+import click
+from flask import current_app, request
+from flask.cli import with_appcontext
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Directory, below the static folder, that built files go into.
+DIST_DIR = 'dist'
+
+# Assets worth compressing; images are compressed already.
+TEXT_EXTENSIONS = ('.css', '.js', '.svg', '.ico', '.json', '.txt', '.map')
+
+WEBP_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# Sent with built files, whose names change whenever their content does.
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def fingerprint(name: str, data: bytes) -> str:
+    """Insert a content hash before the extension of a file name."""
+    root, ext = os.path.splitext(name)
+    return '{0}.{1}{2}'.format(root, hashlib.sha256(data).hexdigest()[:12], ext)
+
+
+def write_file(path: str, data: bytes) -> None:
+    """Write a file, creating its directory if needed."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def compress(path: str, data: bytes) -> list[str]:
+    """Write .gz (and .br) versions of a file; return their suffixes."""
+    # mtime=0 keeps builds of the same content byte-identical.
+    write_file(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+    suffixes = ['.gz']
+    if brotli is not None:
+        write_file(path + '.br', brotli.compress(data, quality=11))
+        suffixes.append('.br')
+    return suffixes
+
+
+def to_webp(source: str, quality: int) -> bytes:
+    """Encode an image file as WebP."""
+    with Image.open(source) as image:
+        buffer = BytesIO()
+        image.save(buffer, 'WEBP', quality=quality, method=6)
+        return buffer.getvalue()
+
+
+def build_assets(static_dir: str, webp_quality: int=80,
+                 echo: object=print) -> dict:
+    """Fingerprint, precompress and convert the files of 'static_dir'.
+
+    Return the manifest, which is also written to the dist directory.
+    Files of earlier builds are left in place for pages still cached
+    by browsers.
+    """
+    dist_dir = os.path.join(static_dir, DIST_DIR)
+    manifest = {}
+    saved = 0
+
+    for root, dirs, files in os.walk(static_dir):
+        if os.path.abspath(root) == os.path.abspath(static_dir):
+            dirs[:] = [d for d in dirs if d != DIST_DIR]
+        for file in sorted(files):
+            source = os.path.join(root, file)
+            name = os.path.relpath(source, static_dir).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+
+            built = fingerprint(name, data)
+            target = os.path.join(dist_dir, built)
+            write_file(target, data)
+            manifest[name] = DIST_DIR + '/' + built
+
+            ext = os.path.splitext(name)[1].lower()
+            if ext in TEXT_EXTENSIONS:
+                compress(target, data)
+            if ext in WEBP_EXTENSIONS and Image is not None:
+                webp = to_webp(source, webp_quality)
+                # Only kept if smaller than the original.
+                if len(webp) < len(data):
+                    webp_name = os.path.splitext(name)[0] + '.webp'
+                    built = fingerprint(webp_name, webp)
+                    write_file(os.path.join(dist_dir, built), webp)
+                    manifest[webp_name] = DIST_DIR + '/' + built
+                    saved += len(data) - len(webp)
+
+    write_file(os.path.join(dist_dir, 'manifest.json'),
+               json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    if brotli is None:
+        echo('brotli is not installed, skipped .br files.')
+    if Image is None:
+        echo('Pillow is not installed, skipped WebP images.')
+    echo('{0} assets built, WebP saves {1} KB.'.format(len(manifest), saved // 1024))
+    return manifest
+
+
+class AssetManifest():
+    """Rewrite static URLs to fingerprinted files of the last build.
+
+    Attributes:
+        - files: original name -> name of the built file (relative to
+                 the static folder); empty if nothing was built
+    """
+
+    def __init__(self, app: 'Flask'=None) -> None:
+        self.files = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: 'Flask') -> None:
+        """Load the manifest and hook into URL building and responses."""
+        path = app.config.get('ASSETS_MANIFEST') or os.path.join(
+            app.static_folder, DIST_DIR, 'manifest.json')
+        try:
+            with open(path) as f:
+                self.files = json.load(f)
+        except FileNotFoundError:
+            self.files = {}
+        app.url_defaults(self.rewrite)
+        app.after_request(self.add_cache_headers)
+        app.jinja_env.globals['webp_variant'] = self.webp_variant
+
+    def rewrite(self, endpoint: str, values: dict) -> None:
+        """url_defaults hook swapping a static file name for its build."""
+        if endpoint == 'static' and 'filename' in values:
+            values['filename'] = self.files.get(values['filename'], values['filename'])
+
+    def webp_variant(self, filename: str) -> 'str | None':
+        """Return the name of an image's WebP version, if one was built."""
+        webp = os.path.splitext(filename)[0] + '.webp'
+        return webp if webp in self.files else None
+
+    def add_cache_headers(self, response: 'Response') -> 'Response':
+        """Mark built files as cacheable forever when Flask serves them."""
+        if request.endpoint == 'static' and \
+                request.view_args.get('filename', '').startswith(DIST_DIR + '/'):
+            response.headers['Cache-Control'] = IMMUTABLE
+        return response
+
+
+@click.command('build-assets')
+@click.option('--webp-quality', default=80, show_default=True,
+              help='Quality of generated WebP images (0-100).')
+@with_appcontext
+def build_assets_command(webp_quality: int) -> None:
+    """Fingerprint and precompress static files into static/dist."""
+    build_assets(current_app.static_folder, webp_quality, echo=click.echo)
@@ -1,8 +1,166 @@
 """Helps in authentication related tasks."""
+import hashlib
+import hmac
+import os
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from threading import BoundedSemaphore, Lock
+
 from bcrypt import gensalt, hashpw, checkpw
-from flask import session, redirect, url_for, flash
+from flask import session, redirect, url_for, flash, request, g
 from functools import wraps
 
+import crud
+from kvstore import LRUStore
+from metrics import add_time
+
+
+class HashingBusy(Exception):
+    """Raised when a password hash can't be computed in time."""
+    pass
+
+
+class HashExecutor():
+    """Run bcrypt on a bounded thread pool with admission control.
+
+    Attributes:
+        - workers: number of hashing threads (defaults to CPU count)
+        - max_pending: number of hashes allowed to wait for a thread
+        - timeout: seconds a hash may wait (queued or running) before
+                   HashingBusy is raised; 0 fails fast when all threads
+                   and queue slots are taken
+        - rounds: bcrypt work factor for new hashes
+
+    bcrypt releases the GIL, so threads hash in parallel while request
+    threads wait. Bounding the queue keeps a login burst from piling up
+    behind the hashing threads; excess work is turned away instead.
+    """
+
+    def __init__(self, workers: int=None, max_pending: int=None,
+                 timeout: float=2.0, rounds: int=12) -> None:
+        """Initialize settings. Threads are started on first use."""
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = self.workers * 2 if max_pending is None else max_pending
+        self.timeout = timeout
+        self.rounds = rounds
+
+        self._lock = Lock()
+        self._pid = None
+        self._pool = None
+
+    def _reset_state(self) -> None:
+        """Create a fresh pool (used on first use and after a fork)."""
+        self._pid = os.getpid()
+        self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='bcrypt')
+        self._slots = BoundedSemaphore(self.workers + self.max_pending)
+        self.counters = {'hashes': 0, 'busy': 0,
+                         'hash_seconds': 0.0, 'hash_seconds_max': 0.0,
+                         'wait_seconds': 0.0, 'wait_seconds_max': 0.0}
+
+    def _timed(self, submitted: float, func: object, *args) -> object:
+        """Run 'func' on a pool thread and record wait and run times."""
+        started = time.monotonic()
+        result = func(*args)
+        finished = time.monotonic()
+        with self._lock:
+            c = self.counters
+            c['hashes'] += 1
+            c['wait_seconds'] += started - submitted
+            c['wait_seconds_max'] = max(c['wait_seconds_max'], started - submitted)
+            c['hash_seconds'] += finished - started
+            c['hash_seconds_max'] = max(c['hash_seconds_max'], finished - started)
+        return result
+
+    def run(self, func: object, *args) -> object:
+        """Run 'func(*args)' on the pool and return its result.
+
+        Raises HashingBusy if no queue slot frees up, or the result
+        isn't ready, within 'timeout' seconds.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset_state()
+
+        started = time.perf_counter()
+        try:
+            return self._run(func, *args)
+        finally:
+            # Includes time spent waiting for a hashing thread.
+            add_time('bcrypt', time.perf_counter() - started)
+
+    def _run(self, func: object, *args) -> object:
+        """Admit 'func' to the pool and wait for its result."""
+        deadline = time.monotonic() + self.timeout
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.counters['busy'] += 1
+            raise HashingBusy('Password hashing queue is full.')
+
+        try:
+            future = self._pool.submit(self._timed, time.monotonic(), func, *args)
+            try:
+                if not self.timeout:
+                    return future.result()
+                return future.result(max(deadline - time.monotonic(), 0))
+            except TimeoutError:
+                # Drop the work if it hasn't started yet.
+                future.cancel()
+                with self._lock:
+                    self.counters['busy'] += 1
+                raise HashingBusy('Password hashing took too long.')
+        finally:
+            # A running hash keeps its thread busy anyway; only its
+            # queue slot is given back here.
+            self._slots.release()
+
+    def stats(self) -> dict:
+        """Return hashing counters (empty before first use)."""
+        with self._lock:
+            if self._pid != os.getpid():
+                return {}
+            return dict(self.counters)
+
+
+# Used by get_hash() and check_hash(); see configure_hashing().
+hasher = HashExecutor()
+
+
+def configure_hashing(workers: int=None, max_pending: int=None,
+                      timeout: float=2.0, rounds: int=12) -> None:
+    """Replace the hashing executor with one using given settings."""
+    global hasher
+    hasher = HashExecutor(workers, max_pending, timeout, rounds)
+
+
+# Set up by configure_employee_auth(); see require_employee().
+employee_throttle = None
+employee_auth_ttl = 60.0
+# Employees whose credentials were checked lately, keyed by
+# credentials_digest(), so repeated API calls skip bcrypt.
+verified_employees = LRUStore(256)
+# Random per process: digests are useless outside of it.
+_credentials_key = secrets.token_bytes(32)
+
+
+def configure_employee_auth(throttle: 'LoginThrottle', ttl: float=60.0) -> None:
+    """Throttle employee logins and cache verified credentials.
+
+    Parameters:
+        - throttle: LoginThrottle applied to credentials not verified yet
+        - ttl: seconds verified credentials are trusted without a check
+               (and how long a changed password or role may lag)
+    """
+    global employee_throttle, employee_auth_ttl
+    employee_throttle = throttle
+    employee_auth_ttl = ttl
+
+
+def credentials_digest(username: str, password: str) -> str:
+    """Return a keyed hash of credentials, to cache them by."""
+    return hmac.new(_credentials_key, '{0}\0{1}'.format(username, password).encode('utf-8'),
+                    hashlib.sha256).hexdigest()
+
 
 def require_login(func: object) -> object:
     """Protect the decorated view function from unauthorized access."""
@@ -16,17 +174,73 @@ def require_login(func: object) -> object:
 
         # Redirect to login page if not logged_in.
         flash('Please login before accessing this page.')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     return wrapper
 
 
+def require_employee(*roles: str) -> object:
+    """Protect the decorated view with HTTP basic auth for employees.
+
+    Parameters:
+        - roles: employee roles ('Scout', 'Cashier', 'Admin') allowed in
+
+    The authenticated employee's record, without the password hash, is
+    available as 'g.employee'.
+    Credentials are checked with bcrypt once and then trusted for
+    'employee_auth_ttl' seconds. Unverified ones go through the login
+    throttle first, which raises RateLimited when exceeded.
+    """
+    def decorator(func: object) -> object:
+        @wraps(func)
+        def wrapper(*args, **kwargs) -> 'function | tuple':
+            """Check credentials and role of the requesting employee."""
+            auth = request.authorization
+            if auth and auth.username and auth.password:
+                username, password = auth.username[:64], auth.password[:64]
+                key = credentials_digest(username, password)
+                employee = verified_employees.get(key)
+                if employee is None:
+                    # Only unverified credentials cost a query and a bcrypt
+                    # check, so only they are throttled.
+                    if employee_throttle is not None:
+                        employee_throttle.check(request.remote_addr or '', username)
+                    employee = crud.get_employee(username)
+                    if employee and check_hash(password, employee['password']):
+                        # The hash is neither cached nor handed to views.
+                        employee = {k: v for k, v in employee.items() if k != 'password'}
+                        verified_employees.set(key, employee, employee_auth_ttl)
+                    else:
+                        employee = None
+
+                if employee and employee['role'] in roles:
+                    g.employee = employee
+                    return func(*args, **kwargs)
+
+            return ('Employee credentials required.', 401,
+                    {'WWW-Authenticate': 'Basic realm="power-corp"'})
+
+        return wrapper
+    return decorator
+
+
 def get_hash(plain: str) -> str:
     """Generate hash for a plain string after salting it."""
-    salt = gensalt()
-    return hashpw(plain.encode('utf-8'), salt).decode('utf-8')
+    salt = gensalt(hasher.rounds)
+    return hasher.run(hashpw, plain.encode('utf-8'), salt).decode('utf-8')
 
 
 def check_hash(plain: str, hash: str) -> bool:
     """Check if a given plain string produces the given hash."""
-    return checkpw(plain.encode('utf-8'), hash.encode('utf-8'))
+    return hasher.run(checkpw, plain.encode('utf-8'), hash.encode('utf-8'))
+
+
+def needs_rehash(hash: str) -> bool:
+    """Check if a hash was made with a different work factor.
+
+    bcrypt hashes look like '$2b$<cost>$<salt and digest>'.
+    """
+    try:
+        return int(hash.split('$')[2]) != hasher.rounds
+    except (IndexError, ValueError):
+        return True
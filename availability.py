@@ -0,0 +1,211 @@
+"""Fast checks of whether a username or mobile number is still free.
+
+Each worker keeps a Bloom filter of the usernames and mobile numbers in
+user_details. A value not in the filter is certainly free, which is the
+answer for almost everything typed into the forms, and costs a few
+microseconds. A value in the filter is confirmed with an indexed query,
+as the filter has rare false positives.
+
+The filters are built in a background thread on first use (checks go
+to the database until then) and kept current by adding users created
+by this worker and, at most every 'refresh_interval' seconds, users
+with a greater id than any seen so far (created by other workers or the
+import command). The database's unique indexes stay the final word.
+"""
+import math
+import os
+import time
+from hashlib import blake2b
+from threading import Lock, Thread
+
+
+class BloomFilter():
+    """Set membership with false positives but no false negatives.
+
+    Attributes:
+        - capacity: number of items the filter is sized for
+        - error_rate: false positive rate at capacity
+        - count: number of items added
+    """
+
+    def __init__(self, capacity: int, error_rate: float=0.001) -> None:
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.nbits = math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.nhashes = max(1, round(self.nbits / self.capacity * math.log(2)))
+        self.bits = bytearray((self.nbits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str) -> 'Generator[int]':
+        """Bit positions of an item (double hashing of one digest)."""
+        digest = blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.nhashes):
+            yield (h1 + i * h2) % self.nbits
+
+    def add(self, item: str) -> None:
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+def normalize(field: str, value: str) -> str:
+    """Key of a value as the database compares it.
+
+    Usernames compare case-insensitively; mobile numbers are numbers.
+    """
+    value = value.strip()
+    if field == 'username':
+        return value.lower()
+    return value.lstrip('0') or '0'
+
+
+class AvailabilityIndex():
+    """Bloom filters of taken usernames and mobile numbers.
+
+    Attributes:
+        - refresh_interval: seconds between queries for new users
+        - chunk_size: users read per query while building
+        - counters: checks, filter-only answers, confirmation queries
+                    and false positives
+    """
+
+    FIELDS = {'username': 'username', 'mobile': 'mobile_num'}
+
+    def __init__(self, refresh_interval: float=1.0, chunk_size: int=10000) -> None:
+        self.refresh_interval = refresh_interval
+        self.chunk_size = chunk_size
+        self.counters = {'checks': 0, 'filtered': 0, 'confirmed': 0,
+                         'false_positives': 0, 'unindexed': 0}
+        self._lock = Lock()
+        self._refresh_lock = Lock()
+        self._filters = None
+        self._max_id = 0
+        self._refreshed_at = 0.0
+        # Process running a build; threads do not survive a fork.
+        self._building_pid = None
+
+    def _start_build(self, rebuild: bool=False) -> None:
+        """Build the filters in a background thread.
+
+        Until a first build finishes, checks query the database. A
+        rebuild keeps using the old filters meanwhile.
+        """
+        if self._filters is not None and not rebuild:
+            return
+        with self._lock:
+            if self._building_pid == os.getpid():
+                return
+            self._building_pid = os.getpid()
+        Thread(target=self._build, name='availability-build', daemon=True).start()
+
+    def _build(self) -> None:
+        """Load all users into new filters."""
+        import crud
+
+        try:
+            # Sized up front, so users are added a chunk at a time and
+            # memory does not grow with the table. Room for growth (and
+            # users created during the build) before the error rate
+            # degrades.
+            capacity = max(2 * crud.count_users(), 10000)
+            filters = {field: BloomFilter(capacity) for field in self.FIELDS}
+            after = 0
+            while True:
+                chunk = crud.get_identities(after, self.chunk_size)
+                if not chunk:
+                    break
+                for _, username, mobile_num in chunk:
+                    filters['username'].add(normalize('username', username))
+                    filters['mobile'].add(normalize('mobile', str(mobile_num)))
+                after = chunk[-1][0]
+
+            with self._lock:
+                self._filters = filters
+                self._max_id = after
+                self._refreshed_at = time.monotonic()
+            print('[AVAILABILITY] Indexed {} users.'.format(filters['username'].count))
+        except Exception as e:
+            # Tried again on a later check.
+            print('[AVAILABILITY] Could not build index: ', str(e))
+        finally:
+            self._building_pid = None
+
+    def _refresh(self) -> bool:
+        """Add users created since the last refresh, by any process.
+
+        Return False if the refresh failed, in which case the filters
+        may miss recent users and must not be trusted for this check.
+        """
+        import crud
+
+        if time.monotonic() - self._refreshed_at < self.refresh_interval:
+            return True
+        # One thread refreshes; the others go on with current filters.
+        if not self._refresh_lock.acquire(blocking=False):
+            return True
+        try:
+            try:
+                rows = crud.get_identities(self._max_id, self.chunk_size)
+            except Exception as e:
+                # Current filters are kept; tried again on a later check.
+                print('[AVAILABILITY] Could not refresh index: ', str(e))
+                return False
+            with self._lock:
+                for uid, username, mobile_num in rows:
+                    self._add(username, str(mobile_num))
+                    self._max_id = max(self._max_id, uid)
+                self._refreshed_at = time.monotonic()
+                overfull = self._filters['username'].count > self._filters['username'].capacity
+        finally:
+            self._refresh_lock.release()
+        if overfull:
+            # Rebuild bigger filters rather than lose accuracy.
+            self._start_build(rebuild=True)
+        return True
+
+    def _add(self, username: str, mobile_num: str) -> None:
+        self._filters['username'].add(normalize('username', username))
+        self._filters['mobile'].add(normalize('mobile', mobile_num))
+
+    def add(self, username: str, mobile_num: 'str | int') -> None:
+        """Record a user just inserted by this process."""
+        with self._lock:
+            if self._filters is not None:
+                self._add(username, str(mobile_num))
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    def is_taken(self, field: str, value: str) -> bool:
+        """Check if 'field' ('username' or 'mobile') has 'value'."""
+        import crud
+
+        column = self.FIELDS[field]
+        self._count('checks')
+        self._start_build()
+
+        indexed = self._filters is not None and self._refresh()
+        if not indexed:
+            self._count('unindexed')
+        elif normalize(field, value) not in self._filters[field]:
+            self._count('filtered')
+            return False
+
+        self._count('confirmed')
+        taken = crud.is_identity_taken(column, value)
+        if not taken and indexed:
+            self._count('false_positives')
+        return taken
+
+    def stats(self) -> dict:
+        """Return counters and the number of indexed users."""
+        with self._lock:
+            indexed = self._filters['username'].count if self._filters else 0
+            return dict(self.counters, indexed=indexed)
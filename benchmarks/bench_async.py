@@ -0,0 +1,96 @@
+"""Benchmark of acrud's async queries against crud's blocking ones.
+
+Each simulated request fetches a user's record and a page of their
+payments, as the payments view does. The synchronous path runs requests
+on a pool of threads, each query after the other, with a crud pool of
+as many connections as threads. The async path runs the same number of
+requests at once on the background event loop, with both queries of a
+request overlapping.
+
+It needs a MariaDB database (the app's config file, CONFIG_FILE) and
+the aiomysql package:
+
+    python benchmarks/bench_async.py --uid 1 [--concurrency 1 8 32 128]
+
+The user cache is disabled, so every request reaches the database.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import acrud  # noqa: E402
+import crud  # noqa: E402
+from aioloop import background_loop  # noqa: E402
+from main import create_app  # noqa: E402
+
+
+def percentile(latencies: list[float], p: float) -> float:
+    """Nearest-rank percentile of sorted latencies."""
+    return latencies[max(0, round(p / 100 * len(latencies)) - 1)]
+
+
+def run_sync(uid: int, page_size: int, requests: int, concurrency: int) -> list[float]:
+    """Run requests on 'concurrency' threads; return their latencies."""
+    def request() -> float:
+        started = time.perf_counter()
+        crud.find_user(uid=uid)
+        list(crud.PaymentPage(uid, page_size))
+        return time.perf_counter() - started
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        return list(pool.map(lambda _: request(), range(requests)))
+
+
+async def run_async(uid: int, page_size: int, requests: int,
+                    concurrency: int) -> list[float]:
+    """Run requests, 'concurrency' at a time; return their latencies."""
+    limit = asyncio.Semaphore(concurrency)
+
+    async def request() -> float:
+        async with limit:
+            started = time.perf_counter()
+            await asyncio.gather(acrud.find_user(uid=uid),
+                                 acrud.get_payment_page(uid, page_size))
+            return time.perf_counter() - started
+
+    return await asyncio.gather(*(request() for _ in range(requests)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare async and sync queries.')
+    parser.add_argument('--uid', type=int, required=True,
+                        help='user whose record and payments are fetched')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32, 128])
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='requests per run')
+    parser.add_argument('--page-size', type=int, default=50)
+    args = parser.parse_args()
+
+    print('{:>6} {:>6} {:>10} {:>10} {:>10}'.format('path', 'conc', 'req/s',
+                                                     'p50/ms', 'p99/ms'))
+    for concurrency in args.concurrency:
+        app = create_app(test_config={'STARTUP_REPORT': False,
+                                      'USER_CACHE_ENABLED': False,
+                                      'DB_POOL_SIZE': concurrency,
+                                      'ASYNC_DB_POOL_SIZE': concurrency})
+        acrud.init_app(app)
+        runs = (('sync', lambda: run_sync(args.uid, args.page_size, args.requests,
+                                          concurrency)),
+                ('async', lambda: background_loop.run(run_async(
+                    args.uid, args.page_size, args.requests, concurrency))))
+        for name, run in runs:
+            # One untimed round opens the pool's connections.
+            run()
+            started = time.perf_counter()
+            latencies = sorted(run())
+            elapsed = time.perf_counter() - started
+            print('{:>6} {:>6} {:>10.0f} {:>10.2f} {:>10.2f}'.format(
+                name, concurrency, len(latencies) / elapsed,
+                percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
+        crud.dbpool.close()
+        background_loop.run(acrud.dbpool.close())
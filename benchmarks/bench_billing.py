@@ -0,0 +1,67 @@
+"""Benchmark of the billing computation at millions of meters.
+
+Times billing.compute_bills() on synthetic readings and compares it
+with a per-customer Python loop over a sample:
+
+    python benchmarks/bench_billing.py [--meters 1000000 5000000]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from billing import DEFAULT_TARIFF, Tariff, compute_bills  # noqa: E402
+
+
+def loop_bill(units: int, slabs: tuple=DEFAULT_TARIFF) -> float:
+    """Bill one customer slab by slab in plain Python."""
+    amount, lower = 0.0, 0
+    for limit, rate in slabs:
+        upper = units if limit is None else min(units, limit)
+        if upper > lower:
+            amount += (upper - lower) * rate
+        lower = limit if limit is not None else units
+    return round(amount, 2)
+
+
+def readings(n: int, seed: int=0) -> tuple[np.ndarray, np.ndarray]:
+    """Random last/current readings with household-like consumption."""
+    rng = np.random.default_rng(seed)
+    last = rng.integers(0, 1_000_000, n)
+    curr = last + rng.gamma(2.0, 120.0, n).astype(np.int64)
+    return last, curr
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark billing.')
+    parser.add_argument('--meters', type=int, nargs='+',
+                        default=[10_000, 100_000, 1_000_000, 5_000_000])
+    parser.add_argument('--loop-sample', type=int, default=100_000,
+                        help='meters billed by the Python loop for comparison')
+    args = parser.parse_args()
+    tariff = Tariff()
+
+    # Both approaches must agree.
+    last, curr = readings(1000)
+    _, amounts, _ = compute_bills(last, curr, tariff)
+    expected = [loop_bill(int(u)) for u in curr - last]
+    assert np.allclose(amounts, expected), 'vectorized and loop bills differ'
+
+    last, curr = readings(args.loop_sample)
+    started = time.perf_counter()
+    for units in (curr - last).tolist():
+        loop_bill(units)
+    loop_rate = args.loop_sample / (time.perf_counter() - started)
+    print('{:>12} {:>16}'.format('meters', 'meters/s'))
+    print('{:>12} {:>16,.0f}  (Python loop)'.format(args.loop_sample, loop_rate))
+
+    for n in args.meters:
+        last, curr = readings(n)
+        started = time.perf_counter()
+        compute_bills(last, curr, tariff)
+        rate = n / (time.perf_counter() - started)
+        print('{:>12} {:>16,.0f}  ({:.0f}x loop)'.format(n, rate, rate / loop_rate))
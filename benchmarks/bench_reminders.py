@@ -0,0 +1,72 @@
+"""Benchmark of a reminder campaign against the local SMTP sink.
+
+Synthetic due meters are fed to reminders.run_campaign() in chunks, as
+crud.get_due_reminders() would return them, and sent to an SMTPSink
+started in this process. The sink's count is checked against the number
+of recipients afterwards:
+
+    python benchmarks/bench_reminders.py [--recipients 100000] [--sessions 1 8]
+
+Use --delay to make the sink answer like a distant server, where
+pipelining and parallel connections matter most.
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mailutils import SMTPSession  # noqa: E402
+from reminders import Checkpoint, ReminderComposer, ReminderSender, run_campaign  # noqa: E402
+from smtpsink import SMTPSink  # noqa: E402
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         'templates')
+
+
+def synthetic_chunks(recipients: int, chunk_size: int) -> 'Generator[list]':
+    """Yield chunks of due meter rows with distinct addresses."""
+    due = date.today() + timedelta(days=2)
+    for start in range(1, recipients + 1, chunk_size):
+        yield [(meter_id, 'Customer{}'.format(meter_id),
+                'customer{}@example.com'.format(meter_id), due,
+                meter_id * 7 % 100000, meter_id * 7 % 100000 + 250)
+               for meter_id in range(start, min(start + chunk_size, recipients + 1))]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark reminder campaigns.')
+    parser.add_argument('--recipients', type=int, default=100_000)
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='send-rate cap in messages/s (0 for none)')
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help='seconds the sink waits before each reply')
+    args = parser.parse_args()
+
+    env = Environment(loader=FileSystemLoader(TEMPLATES),
+                      autoescape=select_autoescape(['html']))
+    composer = ReminderComposer(env.get_template('reminder.html'), 'billing@powercorp.test')
+
+    print('{:>9} {:>10} {:>10} {:>8}'.format('sessions', 'messages', 'msgs/s', 'failed'))
+    for nsessions in args.sessions:
+        sink = SMTPSink(port=0, delay=args.delay, keep=False).start()
+        sender = ReminderSender(composer,
+                                lambda: SMTPSession('localhost', sink.port, use_ssl=False),
+                                nsessions=nsessions, rate=args.rate)
+        started = time.perf_counter()
+        progress = run_campaign(synthetic_chunks(args.recipients, args.chunk_size),
+                                sender, Checkpoint(None, 'bench'), echo=lambda _: None)
+        elapsed = time.perf_counter() - started
+
+        assert sink.wait_count(progress.sent, 10), 'sink is missing messages'
+        assert sink.count == args.recipients - progress.failed, \
+            'sink received {0} of {1} messages'.format(sink.count, args.recipients)
+        print('{:>9} {:>10} {:>10.0f} {:>8}'.format(nsessions, sink.count,
+                                                    sink.count / elapsed, progress.failed))
+        sink.stop()
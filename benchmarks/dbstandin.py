@@ -0,0 +1,103 @@
+"""SQLite stand-in for the MariaDB connector, used by benchmarks.
+
+connect() returns an object with the parts of the mariadb connection
+and cursor API that DBcm and crud use, so a ConnectionPool built with
+'connector=dbstandin.connect' runs crud's queries on a local file:
+
+    pool = ConnectionPool({'database': '/tmp/bench.db'},
+                          connector=dbstandin.connect)
+
+Only queries in the common subset of both SQL dialects work; '%s'
+placeholders are rewritten to SQLite's '?'.
+"""
+import sqlite3
+from datetime import datetime
+
+# Tables crud's benchmarked functions read, in SQLite's dialect.
+SCHEMA = """
+create table if not exists user_details (
+    id integer primary key autoincrement,
+    first_name text not null,
+    last_name text not null,
+    age integer not null,
+    address text not null,
+    gender text not null,
+    issue_date timestamp not null default current_timestamp,
+    username text not null unique,
+    password text not null,
+    mobile_num integer not null unique,
+    email text not null
+);
+create table if not exists payment_history (
+    trans_id integer primary key autoincrement,
+    uid integer not null references user_details (id),
+    amount real not null,
+    tstamp timestamp not null default current_timestamp,
+    mode text not null,
+    note text
+);
+create index if not exists uid_tstamp_trans on payment_history (uid, tstamp, trans_id);
+"""
+
+# 'timestamp' columns come back as datetime, like from MariaDB.
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_converter('timestamp',
+                           lambda value: datetime.fromisoformat(value.decode()))
+
+
+class StandInCursor():
+    """Cursor translating placeholders before running a query."""
+
+    def __init__(self, cursor: sqlite3.Cursor) -> None:
+        self._cursor = cursor
+
+    def __getattr__(self, name: str) -> object:
+        # description, rowcount, lastrowid, fetch* and close.
+        return getattr(self._cursor, name)
+
+    def __iter__(self) -> 'Iterator[tuple]':
+        return iter(self._cursor)
+
+    def execute(self, sql: str, params: 'tuple | list'=()) -> None:
+        self._cursor.execute(sql.replace('%s', '?'), tuple(params))
+
+    def executemany(self, sql: str, params: list) -> None:
+        self._cursor.executemany(sql.replace('%s', '?'), params)
+
+
+class StandInConnection():
+    """SQLite connection with the mariadb connection methods DBcm calls."""
+
+    def __init__(self, database: str) -> None:
+        self._conn = sqlite3.connect(database, detect_types=sqlite3.PARSE_DECLTYPES,
+                                     check_same_thread=False)
+
+    def cursor(self) -> StandInCursor:
+        return StandInCursor(self._conn.cursor())
+
+    def ping(self) -> None:
+        pass
+
+    def reset(self) -> None:
+        pass
+
+    def commit(self) -> None:
+        self._conn.commit()
+
+    def rollback(self) -> None:
+        self._conn.rollback()
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def connect(database: str=':memory:', **options) -> StandInConnection:
+    """Open a stand-in connection (other mariadb options are ignored)."""
+    return StandInConnection(database)
+
+
+def create_schema(database: str) -> None:
+    """Create the stand-in tables in a database file."""
+    conn = sqlite3.connect(database)
+    conn.executescript(SCHEMA)
+    conn.close()
@@ -0,0 +1,349 @@
+"""Concurrent load generator for the signup and login flows.
+
+Virtual users arrive at a given rate (Poisson arrivals) and each runs
+one flow against a running deployment:
+
+    - signup: /register -> /verify -> OTP mail -> /verify -> /signup,
+              then the login flow with the new account
+    - login: /login -> /user/payments with an account made earlier
+    - browse: / and /login without logging in
+
+OTP mails are caught by a bundled SMTP sink (smtpsink.py), so the app
+must send mail to it, e.g. with this in the config file:
+
+    SMTP_SERVER = 'localhost'
+    SMTP_PORT = 1025
+    SMTP_SSL = False
+
+uWSGI serves a unix socket by default; expose HTTP for the run with:
+
+    uwsgi --ini wsgi-config.ini --http :8080
+
+and start the generator:
+
+    python benchmarks/loadgen.py --url http://localhost:8080 --rate 20 \\
+        --duration 60 --mix signup=1,login=8,browse=1
+
+Latency percentiles, throughput and error rate are reported per route.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPException
+from http.cookies import SimpleCookie
+from itertools import count
+from threading import BoundedSemaphore, Lock
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smtpsink import SMTPSink  # noqa: E402
+
+FLOWS = ('signup', 'login', 'browse')
+
+# Every password meets the signup form's rules.
+PASSWORD = 'AAaa..11'
+
+
+class FlowFailed(Exception):
+    """A step of a flow got an unexpected response."""
+    pass
+
+
+class RouteStats():
+    """Latencies and outcomes of one route."""
+
+    def __init__(self) -> None:
+        self.latencies = []
+        self.errors = 0
+        self.statuses = {}
+
+    def summary(self, elapsed: float) -> dict:
+        """Return count, throughput, error rate and percentiles."""
+        latencies = sorted(self.latencies)
+        n = len(latencies)
+
+        def percentile(p: float) -> float:
+            # Nearest-rank percentile, in milliseconds.
+            return latencies[max(0, -(-n * p // 100) - 1)] * 1000 if n else 0.0
+
+        return {'count': n, 'rps': n / elapsed if elapsed else 0.0,
+                'error_rate': self.errors / n if n else 0.0,
+                'p50_ms': percentile(50), 'p95_ms': percentile(95),
+                'p99_ms': percentile(99), 'statuses': self.statuses}
+
+
+class VirtualUser():
+    """HTTP client with its own keep-alive connection and cookies."""
+
+    def __init__(self, url: str, timeout: float) -> None:
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.timeout = timeout
+        self.cookies = {}
+        self.conn = None
+
+    def request(self, method: str, path: str, form: dict=None) -> tuple[int, str]:
+        """Send a request; return status and redirect path (or '')."""
+        headers = {}
+        if self.cookies:
+            headers['Cookie'] = '; '.join('{0}={1}'.format(k, v)
+                                          for k, v in self.cookies.items())
+        body = None
+        if form is not None:
+            body = urlencode(form, doseq=True)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        if self.conn is None:
+            self.conn = HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            self.conn.request(method, path, body, headers)
+            response = self.conn.getresponse()
+            response.read()
+        except (OSError, HTTPException):
+            # Reconnect on the next request.
+            self.close()
+            raise
+
+        for header in response.headers.get_all('Set-Cookie') or []:
+            for name, morsel in SimpleCookie(header).items():
+                if morsel.value and morsel['max-age'] != '0':
+                    self.cookies[name] = morsel.value
+                else:
+                    self.cookies.pop(name, None)
+        return response.status, urlsplit(response.getheader('Location', '')).path
+
+    def close(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class LoadGenerator():
+    """Run flows of virtual users and record per-route statistics.
+
+    Attributes:
+        - url: base URL of the deployment
+        - sink: SMTPSink receiving the app's OTP mails
+        - timeout: seconds to wait for a response or an OTP mail
+        - accounts: (username, password) of accounts usable for login
+    """
+
+    def __init__(self, url: str, sink: SMTPSink, timeout: float=30.0) -> None:
+        self.url = url
+        self.sink = sink
+        self.timeout = timeout
+        self.accounts = []
+        self._lock = Lock()
+        # Unique suffixes for usernames, mobile and card numbers.
+        self._serial = count(random.randrange(10 ** 6))
+        self._run_id = random.randrange(10 ** 4)
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        """Forget recorded statistics (accounts are kept)."""
+        self.routes = {}
+        self.flows = {flow: {'started': 0, 'completed': 0, 'failed': 0} for flow in FLOWS}
+        self.dropped = 0
+
+    def record(self, route: str, seconds: float, ok: bool, status: int) -> None:
+        """Add one request's outcome to its route's statistics."""
+        with self._lock:
+            stats = self.routes.get(route)
+            if stats is None:
+                stats = self.routes[route] = RouteStats()
+            stats.latencies.append(seconds)
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            if not ok:
+                stats.errors += 1
+
+    def step(self, user: VirtualUser, method: str, path: str, form: dict=None,
+             redirect: tuple=None) -> None:
+        """Make one request; fail the flow on an unexpected response.
+
+        With 'redirect', success is a redirect to one of those paths,
+        otherwise a 200 response.
+        """
+        started = time.perf_counter()
+        try:
+            status, location = user.request(method, path, form)
+        except (OSError, HTTPException):
+            status, location = 0, ''
+        elapsed = time.perf_counter() - started
+
+        if redirect:
+            ok = status in (301, 302, 303) and location in redirect
+        else:
+            ok = status == 200
+        self.record('{0} {1}'.format(method, path), elapsed, ok, status)
+        if not ok:
+            raise FlowFailed('{0} {1}: {2} {3}'.format(method, path, status, location))
+
+    def registration(self) -> dict:
+        """Registration form data unique to this run and user."""
+        n = next(self._serial)
+        tag = '{0:04d}{1:07d}'.format(self._run_id, n)
+        return {'fname': 'Load', 'lname': 'Test', 'age': '30', 'gender': 'Unsaid',
+                'email': 'load{}@example.com'.format(tag), 'mobile-num': '9' + tag[-9:],
+                'addr': 'Load test address', 'card-name': 'LOAD TEST',
+                'card-type': 'Debit', 'card-number': '4' + tag.rjust(15, '0'),
+                'card-cvv': '123', 'card-expiry': '2030-11',
+                'username': 'load_' + tag}
+
+    def signup(self, user: VirtualUser) -> None:
+        """Register, verify the emailed OTP, set credentials and log in."""
+        form = self.registration()
+        self.step(user, 'POST', '/register', form, redirect=('/verify',))
+
+        # The OTP mail is queued while this request is served.
+        self.step(user, 'GET', '/verify')
+        started = time.perf_counter()
+        mail = self.sink.wait_for(form['email'], self.timeout)
+        self.record('OTP mail', time.perf_counter() - started, mail is not None,
+                    250 if mail else 0)
+        if mail is None:
+            raise FlowFailed('No OTP mail for ' + form['email'])
+        # Subjects look like '[123456] - Confirm email with OTP'.
+        otp = mail.parsed()['Subject'][1:7]
+
+        self.step(user, 'POST', '/verify', {'digits[]': list(otp)},
+                  redirect=('/signup',))
+        self.step(user, 'POST', '/signup',
+                  {'username': form['username'], 'password': PASSWORD,
+                   'confirm-password': PASSWORD}, redirect=('/', '/home'))
+        with self._lock:
+            self.accounts.append((form['username'], PASSWORD))
+        self.login(user, (form['username'], PASSWORD))
+
+    def login(self, user: VirtualUser, account: tuple=None) -> None:
+        """Log in and open the payment history."""
+        if account is None:
+            with self._lock:
+                if not self.accounts:
+                    raise FlowFailed('No account to log in with yet')
+                account = random.choice(self.accounts)
+        self.step(user, 'POST', '/login',
+                  {'username': account[0], 'password': account[1]},
+                  redirect=('/user/dashboard',))
+        self.step(user, 'GET', '/user/payments')
+
+    def browse(self, user: VirtualUser) -> None:
+        """Open the anonymous pages."""
+        self.step(user, 'GET', '/')
+        self.step(user, 'GET', '/login')
+
+    def run_flow(self, flow: str) -> None:
+        """Run one flow as a new virtual user."""
+        user = VirtualUser(self.url, self.timeout)
+        with self._lock:
+            self.flows[flow]['started'] += 1
+        try:
+            getattr(self, flow)(user)
+            outcome = 'completed'
+        except FlowFailed as e:
+            print('[LOAD] {0} failed: {1}'.format(flow, str(e)))
+            outcome = 'failed'
+        finally:
+            user.close()
+        with self._lock:
+            self.flows[flow][outcome] += 1
+
+    def run(self, rate: float, duration: float, mix: dict,
+            concurrency: int) -> float:
+        """Start flows at 'rate' per second for 'duration' seconds.
+
+        Arrivals are not held back by slow responses; an arrival that
+        finds all 'concurrency' virtual users busy is dropped and
+        counted. Return the elapsed time including the last flows.
+        """
+        flows, weights = zip(*mix.items())
+        slots = BoundedSemaphore(concurrency)
+        started = time.monotonic()
+        next_at = started
+        with ThreadPoolExecutor(concurrency) as executor:
+            while True:
+                next_at += random.expovariate(rate)
+                if next_at - started > duration:
+                    break
+                time.sleep(max(0.0, next_at - time.monotonic()))
+                if not slots.acquire(blocking=False):
+                    self.dropped += 1
+                    continue
+                future = executor.submit(self.run_flow, random.choices(flows, weights)[0])
+                future.add_done_callback(lambda f: slots.release())
+        return time.monotonic() - started
+
+    def report(self, elapsed: float) -> dict:
+        """Return per-route and per-flow results."""
+        return {'elapsed': elapsed, 'dropped': self.dropped, 'flows': self.flows,
+                'routes': {route: stats.summary(elapsed)
+                           for route, stats in sorted(self.routes.items())}}
+
+
+def parse_mix(text: str) -> dict:
+    """Parse 'signup=1,login=8' into flow weights."""
+    mix = {}
+    for item in text.split(','):
+        flow, _, weight = item.partition('=')
+        if flow not in FLOWS:
+            raise argparse.ArgumentTypeError('Unknown flow: {}'.format(flow))
+        mix[flow] = float(weight or 1)
+    return mix
+
+
+def print_report(report: dict) -> None:
+    """Print the report as tables."""
+    print('{0:<22}{1:>8}{2:>9}{3:>8}{4:>10}{5:>10}{6:>10}'.format(
+        'route', 'count', 'req/s', 'err%', 'p50/ms', 'p95/ms', 'p99/ms'))
+    for route, s in report['routes'].items():
+        print('{0:<22}{1:>8}{2:>9.1f}{3:>8.2f}{4:>10.1f}{5:>10.1f}{6:>10.1f}'.format(
+            route, s['count'], s['rps'], s['error_rate'] * 100,
+            s['p50_ms'], s['p95_ms'], s['p99_ms']))
+    print()
+    for flow, counts in report['flows'].items():
+        print('{0:<22}started {1}, completed {2}, failed {3}'.format(
+            flow, counts['started'], counts['completed'], counts['failed']))
+    print('Dropped arrivals: {0}; elapsed {1:.1f}s'.format(report['dropped'],
+                                                         report['elapsed']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate load on the signup and login flows.')
+    parser.add_argument('--url', default='http://localhost:8080')
+    parser.add_argument('--rate', type=float, default=10.0,
+                        help='flows started per second')
+    parser.add_argument('--duration', type=float, default=60.0, help='seconds')
+    parser.add_argument('--mix', type=parse_mix, default={'signup': 1, 'login': 8, 'browse': 1},
+                        help='flow weights, e.g. signup=1,login=8,browse=1')
+    parser.add_argument('--concurrency', type=int, default=1000,
+                        help='maximum virtual users at a time')
+    parser.add_argument('--warmup-signups', type=int, default=10,
+                        help='accounts created before the run for login flows')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--smtp-host', default='localhost')
+    parser.add_argument('--smtp-port', type=int, default=1025)
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    sink = SMTPSink(args.smtp_host, args.smtp_port).start()
+    generator = LoadGenerator(args.url, sink, args.timeout)
+    try:
+        if args.warmup_signups:
+            with ThreadPoolExecutor(min(args.warmup_signups, args.concurrency)) as executor:
+                list(executor.map(generator.run_flow, ['signup'] * args.warmup_signups))
+            print('[LOAD] Warmed up with {} accounts'.format(len(generator.accounts)))
+            # Only the timed run is reported.
+            generator.reset_stats()
+        elapsed = generator.run(args.rate, args.duration, args.mix, args.concurrency)
+    finally:
+        sink.stop()
+
+    report = generator.report(elapsed)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
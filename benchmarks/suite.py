@@ -0,0 +1,225 @@
+"""Micro-benchmarks of hot helper functions with JSON baselines.
+
+Times validations.is_email, authutils.check_hash,
+mailutils.compose_html_mail, crud.prepare_insert and crud's payment
+queries. The queries run against a SQLite stand-in for MariaDB
+(benchmarks/dbstandin.py) seeded with one user per table size:
+
+    python benchmarks/suite.py run [--save NAME] [--sizes 1000 1000000]
+    python benchmarks/suite.py compare BASELINE CURRENT [--threshold 10]
+
+'run' writes benchmarks/baselines/NAME.json. 'compare' takes two
+baseline names (or paths) and exits with status 1 if any benchmark got
+slower by more than the threshold (percent).
+
+crud's benchmarks need the MariaDB connector installed (only to import
+DBcm); they are skipped with a message otherwise.
+"""
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import timeit
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import authutils  # noqa: E402
+import dbstandin  # noqa: E402
+from flask import Flask  # noqa: E402
+from mailutils import compose_html_mail  # noqa: E402
+from validations import is_email  # noqa: E402
+
+BASELINE_DIR = os.path.join(ROOT, 'benchmarks', 'baselines')
+
+# Addresses as they arrive in registration forms, a few of them bad.
+EMAILS = ('someone.else@example.com', 'first.last+tag@mail.example.co.in',
+          'x@y.io', 'very.long.local.part.of.an.address@subdomain.example.org',
+          'missing-at.example.com', 'two@@example.com', 'trailing.dot@example.',
+          'UPPER_case-09@Example.COM')
+
+USER_COLUMNS = ['first_name', 'last_name', 'age', 'address', 'gender',
+                'username', 'password', 'mobile_num', 'email']
+
+
+def time_case(func: object, repeat: int) -> dict:
+    """Time a callable, calibrating calls per run to about 0.2s."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    runs = sorted(t / number for t in timer.repeat(repeat=repeat, number=number))
+    return {'best': runs[0], 'median': runs[len(runs) // 2], 'number': number,
+            'repeat': repeat}
+
+
+def helper_cases(rounds: int) -> list[tuple]:
+    """Benchmarks of functions that need neither app nor database."""
+    authutils.configure_hashing(rounds=rounds)
+    password_hash = authutils.get_hash('AAaa..11')
+
+    # compose_html_mail renders through Flask, outside the main app.
+    mail_app = Flask('bench', template_folder=os.path.join(ROOT, 'templates'))
+
+    def compose() -> str:
+        with mail_app.app_context():
+            return compose_html_mail('sender@example.com', 'someone@example.com',
+                                     '[123456] - Confirm email with OTP', 'otp.html',
+                                     user='Someone', user_mail='so*****@example.com',
+                                     otp=123456)
+
+    return [('validations.is_email', lambda: [is_email(a) for a in EMAILS], len(EMAILS)),
+            ('authutils.check_hash[rounds={}]'.format(rounds),
+             lambda: authutils.check_hash('AAaa..11', password_hash), 1),
+            ('mailutils.compose_html_mail', compose, 1)]
+
+
+def seed(path: str, sizes: list[int]) -> dict:
+    """Create one user per size with that many payments; return uids."""
+    dbstandin.create_schema(path)
+    conn = dbstandin.connect(path)
+    cursor = conn.cursor()
+    uids = {}
+    start = datetime(2015, 1, 1)
+    for i, size in enumerate(sizes):
+        cursor.execute("""insert into user_details (first_name, last_name, age, address,
+                          gender, username, password, mobile_num, email)
+                          values (%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+                       ('Bench', 'User', 30, 'Somewhere', 'Unsaid', 'bench_{}'.format(size),
+                        'hash_{}'.format(size), 9000000000 + i, 'bench@example.com'))
+        uid = uids[size] = cursor.lastrowid
+        # Payments a few minutes apart, spread over the account's life.
+        step = timedelta(seconds=max(1, 10 ** 8 // size))
+        cursor.executemany("""insert into payment_history (uid, amount, tstamp, mode, note)
+                              values (%s, %s, %s, %s, %s)""",
+                           ((uid, 100 + n % 5000, start + n * step,
+                             ('Credit Card', 'Debit Card')[n % 2], 'Bill payment')
+                            for n in range(size)))
+        conn.commit()
+        print('[BENCH] Seeded {} payments'.format(size))
+    conn.close()
+    return uids
+
+
+def crud_cases(path: str, sizes: list[int]) -> list[tuple]:
+    """Benchmarks of crud on a seeded stand-in database."""
+    import crud
+    from DBcm import ConnectionPool
+
+    crud.dbpool = ConnectionPool({'database': path}, size=1,
+                                 connector=dbstandin.connect)
+    uids = seed(path, sizes)
+    cases = [('crud.prepare_insert',
+              lambda: crud.prepare_insert(USER_COLUMNS, 'user_details'), 1),
+             ('crud.get_user', lambda: crud.get_user('bench_{}'.format(sizes[0])), 1)]
+
+    for size, uid in uids.items():
+        # Cursor of a payment halfway through the account's history.
+        page = crud.PaymentPage(uid, size // 2)
+        list(page)
+        middle = page.next_cursor
+
+        cases += [('crud.get_payments[{}]'.format(size),
+                   lambda uid=uid: crud.get_payments(uid), 1),
+                  ('crud.PaymentPage.first[{}]'.format(size),
+                   lambda uid=uid: list(crud.PaymentPage(uid, 20)), 1),
+                  ('crud.PaymentPage.middle[{}]'.format(size),
+                   lambda uid=uid, middle=middle: list(crud.PaymentPage(uid, 20, after=middle)), 1)]
+    return cases
+
+
+def baseline_path(name: str) -> str:
+    """Map a baseline name to its file; paths are returned unchanged."""
+    if name.endswith('.json') or os.sep in name:
+        return name
+    return os.path.join(BASELINE_DIR, name + '.json')
+
+
+def run(args: argparse.Namespace) -> None:
+    """Run selected benchmarks and save the results as a baseline."""
+    cases = helper_cases(args.rounds)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            cases += crud_cases(os.path.join(tmpdir, 'bench.db'), sorted(args.sizes))
+        except ImportError as e:
+            print('[BENCH] Skipping crud benchmarks:', str(e))
+
+        results = {}
+        for name, func, ops in cases:
+            if args.only and not fnmatch.fnmatch(name, args.only):
+                continue
+            result = time_case(func, args.repeat)
+            # Per-operation times for cases looping over several inputs.
+            result['best'] /= ops
+            result['median'] /= ops
+            results[name] = result
+            print('{0:<40}{1:>14.2f} us'.format(name, result['best'] * 1e6))
+
+    data = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(), 'machine': platform.node(),
+            'results': results}
+    path = baseline_path(args.save)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+    print('[BENCH] Saved', path)
+
+
+def compare(args: argparse.Namespace) -> int:
+    """Print relative changes; return 1 if anything regressed."""
+    with open(baseline_path(args.baseline)) as f:
+        baseline = json.load(f)['results']
+    with open(baseline_path(args.current)) as f:
+        current = json.load(f)['results']
+
+    regressions = 0
+    print('{0:<40}{1:>14}{2:>14}{3:>9}'.format('benchmark', 'baseline/us',
+                                               'current/us', 'change'))
+    for name in sorted(set(baseline) | set(current)):
+        if name not in baseline or name not in current:
+            print('{0:<40}  only in {1}'.format(name, 'baseline' if name in baseline
+                                                else 'current'))
+            continue
+        before, after = baseline[name]['best'], current[name]['best']
+        change = (after / before - 1) * 100
+        flag = ''
+        if change > args.threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('{0:<40}{1:>14.2f}{2:>14.2f}{3:>8.1f}%{4}'.format(name, before * 1e6,
+                                                              after * 1e6, change, flag))
+
+    print('[BENCH] {0} regression(s) above {1}%'.format(regressions, args.threshold))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run or compare micro-benchmarks.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run benchmarks and save a baseline')
+    run_parser.add_argument('--save', default='latest',
+                            help='baseline name or path (default: latest)')
+    run_parser.add_argument('--sizes', type=int, nargs='+',
+                            default=[1_000, 10_000, 100_000, 1_000_000],
+                            help='payments per seeded user')
+    run_parser.add_argument('--rounds', type=int, default=12,
+                            help='bcrypt work factor of the checked hash')
+    run_parser.add_argument('--repeat', type=int, default=5,
+                            help='timing runs per benchmark')
+    run_parser.add_argument('--only', help='glob selecting benchmarks by name')
+
+    compare_parser = commands.add_parser('compare', help='compare two baselines')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=10.0,
+                                help='slowdown in percent reported as regression')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        sys.exit(compare(args))
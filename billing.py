@@ -0,0 +1,131 @@
+"""Billing run over the 'consumption' table.
+
+Meters whose due date has come are loaded in large chunks into NumPy
+arrays, and tiered tariff slabs are applied to whole chunks at once
+instead of looping over customers in Python. Run with:
+
+    flask --app main run-billing [--date YYYY-MM-DD] [--dry-run]
+"""
+import time
+from datetime import date
+
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import with_appcontext
+
+# Units up to each limit are charged at the slab's rate; the last slab
+# (limit None) covers all remaining units.
+DEFAULT_TARIFF = ((100, 3.0), (300, 4.5), (None, 6.5))
+
+
+class Tariff():
+    """Tiered electricity tariff.
+
+    Attributes:
+        - limits: upper unit limit of each slab (inf for the last one)
+        - rates: price per unit within each slab
+        - fixed_charge: amount added to every bill
+    """
+
+    def __init__(self, slabs: 'tuple | list'=DEFAULT_TARIFF,
+                 fixed_charge: float=0.0) -> None:
+        """Initialize from (upper limit, rate) pairs in ascending order."""
+        self.limits = np.array([np.inf if limit is None else limit
+                                for limit, _ in slabs], dtype=np.float64)
+        self.rates = np.array([rate for _, rate in slabs], dtype=np.float64)
+        self.fixed_charge = fixed_charge
+
+        if np.any(np.diff(self.limits) <= 0) or self.limits[-1] != np.inf:
+            raise ValueError('Tariff slabs must ascend and end with an open slab.')
+
+    def charges(self, units: np.ndarray) -> np.ndarray:
+        """Return the bill amount for every element of 'units'."""
+        units = units.astype(np.float64, copy=False)
+        amounts = np.full(units.shape, self.fixed_charge)
+        lower = 0.0
+        # One vectorized pass per slab; tariffs only have a few slabs.
+        for limit, rate in zip(self.limits, self.rates):
+            amounts += np.clip(units - lower, 0.0, limit - lower) * rate
+            lower = limit
+        return np.round(amounts, 2)
+
+
+def compute_bills(last: np.ndarray, curr: np.ndarray,
+                  tariff: Tariff) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Compute consumed units and bill amounts of a chunk of meters.
+
+    Returns units, amounts and a mask of valid meters. Meters whose
+    current reading is below the last one (e.g. a replaced meter) are
+    marked invalid and left for manual review.
+    """
+    valid = curr >= last
+    units = np.where(valid, curr - last, 0)
+    return units, tariff.charges(units), valid
+
+
+def run_billing(due_by: date, tariff: Tariff, chunk_size: int=50000,
+                dry_run: bool=False, echo: object=print) -> dict:
+    """Bill all meters due on or before 'due_by'.
+
+    Each chunk's bills are stored, and its readings rolled forward, in
+    one transaction. Meters already billed for a due date are skipped,
+    so an interrupted run can be started again.
+    """
+    # Imported here so the computation can be used without a database.
+    import crud
+
+    totals = {'meters': 0, 'billed': 0, 'skipped': 0, 'units': 0, 'amount': 0.0}
+    after = 0
+    started = time.monotonic()
+
+    while True:
+        rows = crud.get_due_meters(due_by, after, chunk_size)
+        if not rows:
+            break
+        after = rows[-1][0]
+
+        # Columns: meter_id, id, last_reading, curr_reading, due_date
+        meter_ids = np.fromiter((r[0] for r in rows), np.int64, len(rows))
+        uids = np.fromiter((r[1] for r in rows), np.int64, len(rows))
+        last = np.fromiter((r[2] for r in rows), np.int64, len(rows))
+        curr = np.fromiter((r[3] for r in rows), np.int64, len(rows))
+        due_dates = [r[4] for r in rows]
+
+        units, amounts, valid = compute_bills(last, curr, tariff)
+
+        idx = np.flatnonzero(valid)
+        if not dry_run and len(idx):
+            bills = list(zip(meter_ids[idx].tolist(), uids[idx].tolist(),
+                             units[idx].tolist(), amounts[idx].tolist(),
+                             [due_dates[i] for i in idx]))
+            crud.store_bills(bills)
+
+        totals['meters'] += len(rows)
+        totals['billed'] += len(idx)
+        totals['skipped'] += len(rows) - len(idx)
+        totals['units'] += int(units[idx].sum())
+        totals['amount'] += float(amounts[idx].sum())
+
+        echo('{0} meters processed ({1:.0f} meters/s)'.format(
+            totals['meters'], totals['meters'] / (time.monotonic() - started)))
+    return totals
+
+
+@click.command('run-billing')
+@click.option('--date', 'due_by', type=click.DateTime(['%Y-%m-%d']),
+              help='Bill meters due on or before this date (default: today).')
+@click.option('--chunk-size', default=50000, show_default=True,
+              help='Meters loaded and stored per transaction.')
+@click.option('--dry-run', is_flag=True, help='Compute bills without storing them.')
+@with_appcontext
+def billing_command(due_by: 'datetime', chunk_size: int, dry_run: bool) -> None:
+    """Generate bills for meters that are due."""
+    due_by = due_by.date() if due_by else date.today()
+    tariff = Tariff(current_app.config.get('BILLING_TARIFF', DEFAULT_TARIFF),
+                    current_app.config.get('BILLING_FIXED_CHARGE', 0.0))
+
+    totals = run_billing(due_by, tariff, chunk_size, dry_run, echo=click.echo)
+    click.echo('{0}{1} meters billed, {2} skipped, {3} units, {4:.2f} total.'.format(
+        '[DRY RUN] ' if dry_run else '', totals['billed'], totals['skipped'],
+        totals['units'], totals['amount']))
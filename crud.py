@@ -1,10 +1,56 @@
 """Functions that provide python interface for DB transactions."""
-from DBcm import UseDatabase
-from main import app
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
 
-# Find DB configuration variables (prefix 'DB_') in flask app config
-# and copy them into separate dictionary.
-dbconfig = {k.removeprefix('DB_').lower(): v for k, v in app.config.items() if k.startswith('DB_')}
+from DBcm import UseDatabase, ConnectionPool, QueryTracer
+from usercache import UserCache, UNCACHED_COLUMNS
+
+# Set up from the app's configuration by init_app(). Connections are
+# opened lazily and reused for the worker's lifetime.
+dbpool = None
+# Query tracer of the pool, if tracing is enabled.
+tracer = None
+# Column names are read once per worker, on first use.
+catalog = None
+# Cache of user records, unless disabled in the configuration.
+user_cache = None
+
+
+def init_app(app: 'Flask', user_store: object=None) -> None:
+    """Configure the connection pool from an app's 'DB_*' settings.
+
+    Parameters:
+        - app: app whose configuration is read
+        - user_store: kvstore store shared by workers for the user
+                      cache, or None to keep the cache per worker
+
+    No connection is opened here.
+    """
+    global dbpool, tracer, catalog, user_cache
+    # Find DB configuration variables (prefix 'DB_') in flask app config
+    # and copy them into separate dictionary.
+    # Pool settings (prefix 'DB_POOL_') and tracing settings (prefix
+    # 'DB_TRACE_') are kept apart from connection ones.
+    dbconfig = {k.removeprefix('DB_').lower(): v for k, v in app.config.items()
+                if k.startswith('DB_') and not k.startswith(('DB_POOL_', 'DB_TRACE_'))}
+    poolconfig = {k.removeprefix('DB_POOL_').lower(): v for k, v in app.config.items()
+                  if k.startswith('DB_POOL_')}
+
+    # Query tracing is off unless enabled in the configuration.
+    tracer = None
+    if app.config.get('DB_TRACE_ENABLED', False):
+        tracer = QueryTracer(app.config.get('DB_TRACE_SLOW_MS', 100) / 1000,
+                             app.config.get('DB_TRACE_LOG_SIZE', 100),
+                             app.config.get('DB_TRACE_STRICT', False))
+
+    dbpool = ConnectionPool(dbconfig, tracer=tracer, **poolconfig)
+    catalog = SchemaCatalog(dbpool)
+
+    user_cache = None
+    if app.config.get('USER_CACHE_ENABLED', True):
+        user_cache = UserCache(app.config.get('USER_CACHE_SIZE', 1000), user_store,
+                               app.config.get('USER_CACHE_TTL', 5.0),
+                               app.config.get('USER_CACHE_SHARED_TTL', 300.0))
 
 
 def prepare_insert(columns: list, table: str) -> str:
@@ -29,19 +75,88 @@ def prepare_insert(columns: list, table: str) -> str:
     return query
 
 
+class SchemaCatalog():
+    """Cache column names of database tables for the worker's lifetime.
+
+    Attributes:
+        - tables: names of tables loaded together on first use
+        - pool: ConnectionPool used to read the schema
+
+    Column lists of all 'tables' are read in one query the first time
+    any of them is needed. Tables outside 'tables' are looked up (and
+    cached) individually. Call invalidate() after altering a table.
+    """
+
+    TABLES = ('user_details', 'card_details', 'payment_history', 'consumption')
+
+    def __init__(self, pool: ConnectionPool, tables: tuple=TABLES) -> None:
+        """Initialize an empty catalog. No query is run here."""
+        self.pool = pool
+        self.tables = tables
+        self._columns = {}
+        self._row_factories = {}
+
+    def load(self) -> None:
+        """Read column names of all known tables in a single query."""
+        placeholders = ', '.join(['%s'] * len(self.tables))
+        _SQL = """select table_name, column_name from information_schema.columns
+                  where table_schema=database() and table_name in ({})
+                  order by table_name, ordinal_position""".format(placeholders)
+        columns = {table: [] for table in self.tables}
+        with UseDatabase(self.pool) as cursor:
+            cursor.execute(_SQL, self.tables)
+            for table, column in cursor.fetchall():
+                columns[table].append(column)
+
+        self._columns.update({k: tuple(v) for k, v in columns.items()})
+
+    def columns(self, table: str) -> tuple:
+        """Return column names of the given table in schema order."""
+        if table not in self._columns:
+            if table in self.tables:
+                self.load()
+            else:
+                with UseDatabase(self.pool) as cursor:
+                    cursor.execute("""describe {}""".format(table))
+                    # First element of each column's schema is its name
+                    self._columns[table] = tuple(row[0] for row in cursor.fetchall())
+        return self._columns[table]
+
+    def row_factory(self, table: str) -> object:
+        """Return a function turning a full row of 'table' into a dict."""
+        if table not in self._row_factories:
+            self._row_factories[table] = make_row_factory(self.columns(table))
+        return self._row_factories[table]
+
+    def invalidate(self, table: str=None) -> None:
+        """Forget cached columns of one table, or of all if not given."""
+        if table is None:
+            self._columns.clear()
+            self._row_factories.clear()
+        else:
+            self._columns.pop(table, None)
+            self._row_factories.pop(table, None)
+
+
+def make_row_factory(columns: 'tuple | list') -> object:
+    """Return a function that maps a row tuple to a dict of 'columns'."""
+    keys = tuple(columns)
+
+    def row_to_dict(row: tuple) -> dict:
+        return dict(zip(keys, row))
+
+    return row_to_dict
+
+
+def description_row_factory(cursor: 'MariaDB cursor') -> object:
+    """Return a row factory for the result set of an executed cursor."""
+    # First element of each column description is its name.
+    return make_row_factory([col[0] for col in cursor.description])
+
+
 def get_column_names(table: str) -> list:
     """Get column names of given SQL table."""
-    with UseDatabase(dbconfig) as cursor:
-        # Get table schema.
-        _SQL = """describe {}""".format(table)
-        cursor.execute(_SQL)
-        schema = cursor.fetchall()
-
-    columns = []
-    # First element of each column's schema is its name
-    for row in schema:
-        columns.append(row[0])
-    return columns
+    return list(catalog.columns(table))
 
 
 def get_user(uname: str) -> 'dict | None':
@@ -55,22 +170,54 @@ def get_user(uname: str) -> 'dict | None':
         - keys: column names of 'user_details' table
         - values: corresponding values for fields of the found record
     """
-    # Array to hold names of columns in 'user_details' table
-    keys = get_column_names('user_details')
-
-    with UseDatabase(dbconfig) as cursor:
+    with UseDatabase(dbpool) as cursor:
         # Search for the given username.
         _SQL = """select * from user_details where username=%s limit 1"""
         cursor.execute(_SQL, (uname,))
         values = cursor.fetchone()
 
-    if not values:
-        # If the user doesn't exist.
-        return None
+        if not values:
+            # If the user doesn't exist.
+            return None
+
+        # Column names come along with the result set, so no separate
+        # schema query is needed.
+        to_dict = description_row_factory(cursor)
 
     # Return a dict by combining column names and field values of
     # found record in DB.
-    return dict(zip(keys, values))
+    user = to_dict(values)
+    # Logins read the password hash from here; the cache never gets it.
+    if user_cache:
+        user_cache.put(user)
+    return user
+
+
+def find_user(uid: int=None, username: str=None) -> 'dict | None':
+    """Fetch a user's record by id or username, through the user cache.
+
+    The record is that of get_user() without the password hash. Use it
+    wherever user details are needed but the password is not.
+    """
+    if user_cache:
+        user = user_cache.get(uid, username)
+        if user is not None:
+            return user
+
+    columns = [c for c in catalog.columns('user_details') if c not in UNCACHED_COLUMNS]
+    column, value = ('id', uid) if uid is not None else ('username', username)
+    with UseDatabase(dbpool) as cursor:
+        _SQL = """select {0} from user_details where {1}=%s limit 1""".format(
+            ', '.join(columns), column)
+        cursor.execute(_SQL, (value,))
+        values = cursor.fetchone()
+
+    if not values:
+        return None
+    user = dict(zip(columns, values))
+    if user_cache:
+        user_cache.put(user)
+    return user
 
 
 def add_user(basic_data: dict, card_data: dict) -> None:
@@ -83,7 +230,7 @@ def add_user(basic_data: dict, card_data: dict) -> None:
 
     Both database insertions are atomic as a whole.
     """
-    with UseDatabase(dbconfig) as cursor:
+    with UseDatabase(dbpool) as cursor:
         # Add basic user data into 'user_details' table.
         _SQL = prepare_insert(list(basic_data.keys()), 'user_details')
         cursor.execute(_SQL, tuple(basic_data.values()))
@@ -99,10 +246,504 @@ def add_user(basic_data: dict, card_data: dict) -> None:
         _SQL = prepare_insert(list(card_data.keys()), 'card_details')
         cursor.execute(_SQL, tuple(card_data.values()))
 
+    if user_cache:
+        user_cache.invalidate(newuser_id, basic_data['username'])
+
+
+def add_users(basic_rows: list[dict], card_rows: list[dict]) -> None:
+    """Store many new users in a single transaction.
+
+    Arguments:
+        - basic_rows: dicts inserted as records into 'user_details'
+        - card_rows: card record of each user, in the same order (each
+                     one gets its user's id under 'uid')
+
+    All dicts of a list must have the same keys. Rows are sent with
+    executemany, so the whole batch costs a few round-trips. If any row
+    violates a constraint, nothing of the batch is stored.
+    """
+    if not basic_rows:
+        return
+
+    with UseDatabase(dbpool) as cursor:
+        _SQL = prepare_insert(list(basic_rows[0].keys()), 'user_details')
+        cursor.executemany(_SQL, [tuple(row.values()) for row in basic_rows])
+
+        # Look up ids assigned to the new users by their unique usernames.
+        usernames = [row['username'] for row in basic_rows]
+        placeholders = ', '.join(['%s'] * len(usernames))
+        _SQL = """select username, id from user_details where username in ({})"""
+        cursor.execute(_SQL.format(placeholders), usernames)
+        ids = dict(cursor.fetchall())
+
+        for basic, card in zip(basic_rows, card_rows):
+            card['uid'] = ids[basic['username']]
+        _SQL = prepare_insert(list(card_rows[0].keys()), 'card_details')
+        cursor.executemany(_SQL, [tuple(row.values()) for row in card_rows])
+
+    if user_cache:
+        for username, uid in ids.items():
+            user_cache.invalidate(uid, username)
+
+
+def get_identities(after: int, limit: int) -> list[tuple]:
+    """Fetch (id, username, mobile_num) of users, ordered by id.
+
+    Parameters:
+        - after: only users with a greater id (keyset of the last chunk)
+        - limit: maximum number of users returned
+    """
+    with UseDatabase(dbpool) as cursor:
+        _SQL = """select id, username, mobile_num from user_details
+                  where id > %s order by id limit %s"""
+        cursor.execute(_SQL, (after, limit))
+        return cursor.fetchall()
+
+
+def count_users() -> int:
+    """Return the number of rows in user_details."""
+    with UseDatabase(dbpool) as cursor:
+        cursor.execute("""select count(*) from user_details""")
+        return cursor.fetchone()[0]
+
+
+def is_identity_taken(column: str, value: 'str | int') -> bool:
+    """Check if a user with the given username or mobile_num exists."""
+    if column not in ('username', 'mobile_num'):
+        raise ValueError('Not a unique user column: {}'.format(column))
+    with UseDatabase(dbpool) as cursor:
+        # Both columns have a unique index.
+        _SQL = """select 1 from user_details where {}=%s limit 1""".format(column)
+        cursor.execute(_SQL, (value,))
+        return cursor.fetchone() is not None
+
+
+def get_due_meters(due_by: 'date', after: int, limit: int) -> list[tuple]:
+    """Fetch a chunk of meters due for billing, ordered by meter id.
+
+    Parameters:
+        - due_by: include meters with a due date on or before this day
+        - after: only meters with a greater id (keyset of the last chunk)
+        - limit: maximum number of meters returned
+
+    Rows hold meter_id, id, last_reading, curr_reading and due_date.
+    """
+    with UseDatabase(dbpool) as cursor:
+        _SQL = """select meter_id, id, last_reading, curr_reading, due_date from consumption
+                  where meter_id > %s and due_date <= %s order by meter_id limit %s"""
+        cursor.execute(_SQL, (after, due_by, limit))
+        return cursor.fetchall()
+
+
+def get_due_reminders(due_from: 'date', due_to: 'date', after: int,
+                      limit: int) -> list[tuple]:
+    """Fetch a chunk of meters due in a date range with their owner's mail.
+
+    Parameters:
+        - due_from, due_to: first and last due date included
+        - after: only meters with a greater id (keyset of the last chunk)
+        - limit: maximum number of meters returned
+
+    Rows hold meter_id, first_name, email, due_date, last_reading and
+    curr_reading. Users without an email address are left out.
+    """
+    with UseDatabase(dbpool) as cursor:
+        _SQL = """select c.meter_id, u.first_name, u.email, c.due_date,
+                  c.last_reading, c.curr_reading
+                  from consumption c join user_details u on u.id = c.id
+                  where c.meter_id > %s and c.due_date between %s and %s
+                  and u.email is not null
+                  order by c.meter_id limit %s"""
+        cursor.execute(_SQL, (after, due_from, due_to, limit))
+        return cursor.fetchall()
+
+
+def store_bills(bills: list[tuple]) -> None:
+    """Store bills and roll the billed meters' readings forward.
+
+    Arguments:
+        - bills: (meter_id, uid, units, amount, due_date) tuples
+
+    In one transaction, each bill is inserted (unless that meter was
+    already billed for that due date) and its meter's current reading
+    becomes the last one, with the due date moved a month ahead.
+    """
+    with UseDatabase(dbpool) as cursor:
+        _SQL = """insert ignore into bills (meter_id, uid, units, amount, due_date)
+                  values (%s, %s, %s, %s, %s)"""
+        cursor.executemany(_SQL, bills)
+
+        # Matching on the billed due date keeps a rerun from rolling twice.
+        _SQL = """update consumption set last_reading=curr_reading,
+                  due_date=date_add(due_date, interval 1 month)
+                  where meter_id=%s and due_date=%s"""
+        cursor.executemany(_SQL, [(b[0], b[4]) for b in bills])
+
+
+def apply_readings(readings: list[tuple]) -> int:
+    """Move meters' current readings forward in one transaction.
+
+    Arguments:
+        - readings: (meter_id, reading) pairs, one per meter
+
+    A reading is only applied if it is not below the meter's current
+    (and last) reading, so applying the same readings again changes
+    nothing. Return the number of meters whose reading changed.
+    """
+    with UseDatabase(dbpool) as cursor:
+        _SQL = """update consumption set curr_reading=%s
+                  where meter_id=%s and curr_reading < %s and last_reading <= %s"""
+        cursor.executemany(_SQL, [(r, m, r, r) for m, r in readings])
+        return cursor.rowcount
+
+
+def get_employee(uname: str) -> 'dict | None':
+    """Fetch an employee record that matches the given username."""
+    with UseDatabase(dbpool) as cursor:
+        _SQL = """select * from emp_details where username=%s limit 1"""
+        cursor.execute(_SQL, (uname,))
+        values = cursor.fetchone()
+        if not values:
+            return None
+        to_dict = description_row_factory(cursor)
+    return to_dict(values)
+
+
+def update_password(uid: int, password_hash: str) -> None:
+    """Replace the stored password hash of a user."""
+    with UseDatabase(dbpool) as cursor:
+        _SQL = """update user_details set password=%s where id=%s"""
+        cursor.execute(_SQL, (password_hash, uid))
+
+    # Updates of user_details drop the user's cached record.
+    if user_cache:
+        user_cache.invalidate(uid)
+
+
+def record_payments(payments: list[tuple]) -> dict:
+    """Store payments in one transaction unless their keys were used.
+
+    Arguments:
+        - payments: (uid, idem_key, amount, mode, note) tuples; of
+                    several with the same user and key, the first counts
+
+    Return {(uid, idem_key): (payment dict, created)} for every stored
+    payment, where 'created' is True only for payments inserted by this
+    call (for keys stored earlier, the payment dict is the earlier one).
+    Payments the database skipped, e.g. of unknown users, are missing
+    from the result.
+    """
+    unique = {}
+    for payment in payments:
+        unique.setdefault((payment[0], payment[1]), payment)
+    keys = list({key for _, key in unique})
+    _SELECT = """select trans_id, uid, idem_key, amount, tstamp, mode, note
+                 from payment_history where idem_key in ({})""".format(
+                     ', '.join(['%s'] * len(keys)))
+
+    with UseDatabase(dbpool) as cursor:
+        # Keys are looked up by the (idem_key, uid) index and only
+        # matter per user. This first read also fixes the transaction's
+        # snapshot (REPEATABLE READ).
+        cursor.execute(_SELECT, keys)
+        existing = {(row[1], row[2]) for row in cursor.fetchall()}
+
+        new = [p for k, p in unique.items() if k not in existing]
+        if new:
+            # Insert ignore skips keys stored meanwhile by another
+            # worker; the unique index keeps theirs.
+            _SQL = """insert ignore into payment_history (uid, idem_key, amount, mode, note)
+                      values (%s, %s, %s, %s, %s)"""
+            cursor.executemany(_SQL, new)
+
+        # The snapshot plus this transaction's own rows: whatever was
+        # not there before was inserted here.
+        cursor.execute(_SELECT, keys)
+        to_dict = description_row_factory(cursor)
+        stored = {(row[1], row[2]): (to_dict(row), (row[1], row[2]) not in existing)
+                  for row in cursor.fetchall() if (row[1], row[2]) in unique}
+
+        # Keys skipped for another worker's rows are only visible to a
+        # locking read, which sees the latest committed data.
+        missing = [key for key in unique if key not in stored]
+        if missing:
+            cursor.execute(_SELECT + ' lock in share mode', keys)
+            for row in cursor.fetchall():
+                if (row[1], row[2]) in unique and (row[1], row[2]) not in stored:
+                    stored[(row[1], row[2])] = (to_dict(row), False)
+    return stored
+
 
 def get_payments(uid: int) -> list[tuple]:
     """Fetch a list of all payments made by a given user account."""
-    with UseDatabase(dbconfig) as cursor:
+    with UseDatabase(dbpool) as cursor:
         _SQL = """select trans_id, amount, tstamp, mode, note from payment_history where uid=%s"""
         cursor.execute(_SQL, (uid,))
         return cursor.fetchall()
+
+
+# Columns of payment exports, from payment_history (p) and user_details (u).
+EXPORT_COLUMNS = ('trans_id', 'tstamp', 'uid', 'username', 'first_name', 'last_name',
+                  'email', 'amount', 'mode', 'note')
+
+
+def get_export_bound(settle_seconds: int) -> int:
+    """Return the newest trans_id an export can include (0 if none).
+
+    Payments newer than 'settle_seconds' are left for the next export:
+    a transaction still open may yet commit a lower trans_id, which an
+    export up to a higher one would miss for good.
+    """
+    with UseDatabase(dbpool) as cursor:
+        # Walks the primary key back from the newest payment only.
+        _SQL = """select trans_id from payment_history
+                  where tstamp < now() - interval %s second
+                  order by trans_id desc limit 1"""
+        cursor.execute(_SQL, (settle_seconds,))
+        row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def export_payments(after: int, until: int, chunk_size: int=10000,
+                    buffered: bool=False) -> 'Generator[tuple]':
+    """Yield payments with their owner's details, oldest first.
+
+    Parameters:
+        - after, until: range of trans_id exported (after excluded)
+        - chunk_size: payments read per query
+        - buffered: read each chunk whole and give its connection back
+                    before yielding any of it
+
+    Each chunk is read in a transaction of its own (keyset on trans_id),
+    so neither memory nor any one transaction grows with the size of
+    the table. Unbuffered, rows are streamed from the server and the
+    connection stays checked out while the caller handles them; buffer
+    when the caller may be slow (e.g. an HTTP client), so a pooled
+    connection is never held waiting on it.
+    """
+    _SQL = """select p.trans_id, p.tstamp, p.uid, u.username, u.first_name,
+              u.last_name, u.email, p.amount, p.mode, p.note
+              from payment_history p join user_details u on u.id = p.uid
+              where p.trans_id > %s and p.trans_id <= %s
+              order by p.trans_id limit %s"""
+    while after < until:
+        if buffered:
+            with UseDatabase(dbpool) as cursor:
+                cursor.execute(_SQL, (after, until, chunk_size))
+                rows = cursor.fetchall()
+            if rows:
+                after = rows[-1][0]
+            yield from rows
+            count = len(rows)
+        else:
+            count = 0
+            with UseDatabase(dbpool, buffered=False) as cursor:
+                cursor.execute(_SQL, (after, until, chunk_size))
+                while True:
+                    batch = cursor.fetchmany(256)
+                    if not batch:
+                        break
+                    count += len(batch)
+                    after = batch[-1][0]
+                    yield from batch
+        if count < chunk_size:
+            return
+
+
+def encode_page_cursor(tstamp: datetime, trans_id: int) -> str:
+    """Encode a payment's keyset position into an opaque URL token."""
+    key = '{0}|{1}'.format(tstamp.isoformat(), trans_id)
+    return urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+
+def decode_page_cursor(token: str) -> tuple[datetime, int]:
+    """Decode a token made by encode_page_cursor().
+
+    Raises ValueError if the token is malformed.
+    """
+    try:
+        key = urlsafe_b64decode(token.encode('ascii')).decode('utf-8')
+        tstamp, trans_id = key.split('|')
+        return datetime.fromisoformat(tstamp), int(trans_id)
+    except (UnicodeError, TypeError, ValueError) as e:
+        raise ValueError('Invalid page cursor: {}'.format(token)) from e
+
+
+class PaymentPage():
+    """One page of a user's payments, newest first, fetched by keyset.
+
+    Attributes:
+        - uid: id of the user whose payments are listed
+        - size: maximum number of payments on the page
+        - after: cursor of the last payment on the previous (newer) page
+        - before: cursor of the first payment on the next (older) page
+        - next_cursor: cursor for the following (older) page, if any
+        - prev_cursor: cursor for the preceding (newer) page, if any
+
+    Pages are addressed by the (tstamp, trans_id) position of their
+    boundary rows rather than an offset, so every page is a range scan
+    on the (uid, tstamp, trans_id) index however old the account is.
+
+    Rows are fetched when iteration starts, all at once, so a streamed
+    template never holds a database connection while it draws them.
+    Both cursors are only known once iteration has started. A page can
+    be iterated once.
+    """
+
+    _COLUMNS = """select trans_id, amount, tstamp, mode, note from payment_history"""
+
+    def __init__(self, uid: int, size: int, after: str=None,
+                 before: str=None) -> None:
+        """Initialize page boundaries. Malformed cursors raise ValueError."""
+        self.uid = uid
+        self.size = size
+        self.after = decode_page_cursor(after) if after else None
+        self.before = decode_page_cursor(before) if before else None
+        self.next_cursor = None
+        self.prev_cursor = None
+
+    def query(self) -> tuple[str, tuple]:
+        """Build the keyset query and its parameters."""
+        # One extra row tells if there is another page in that direction.
+        if self.before:
+            tstamp, trans_id = self.before
+            _SQL = self._COLUMNS + """ where uid=%s and (tstamp > %s or (tstamp=%s and trans_id > %s))
+                                       order by tstamp, trans_id limit %s"""
+            return _SQL, (self.uid, tstamp, tstamp, trans_id, self.size + 1)
+
+        if self.after:
+            tstamp, trans_id = self.after
+            _SQL = self._COLUMNS + """ where uid=%s and (tstamp < %s or (tstamp=%s and trans_id < %s))
+                                       order by tstamp desc, trans_id desc limit %s"""
+            return _SQL, (self.uid, tstamp, tstamp, trans_id, self.size + 1)
+
+        _SQL = self._COLUMNS + """ where uid=%s order by tstamp desc, trans_id desc limit %s"""
+        return _SQL, (self.uid, self.size + 1)
+
+    def __iter__(self) -> 'Generator[tuple]':
+        """Yield payment rows of the page, newest first."""
+        _SQL, params = self.query()
+        # The page is small: read it whole and give the connection back
+        # before a streamed template waits on the client.
+        with UseDatabase(dbpool) as cursor:
+            cursor.execute(_SQL, params)
+            rows = cursor.fetchall()
+        yield from self.paginate(rows)
+
+    def paginate(self, rows: list) -> list:
+        """Turn all rows fetched by query() into the page's rows.
+
+        Return them newest first and set the page's cursors.
+        """
+        more = len(rows) > self.size
+        rows = rows[:self.size]
+        if self.before:
+            # Rows come oldest first when paging backwards; the page is
+            # bounded by 'size', so reversing it in memory is fine.
+            rows.reverse()
+        if rows:
+            self._set_cursors(rows[0], rows[-1], more)
+        return rows
+
+    def _set_cursors(self, first: tuple, last: tuple, more: bool) -> None:
+        """Set cursors from the page's first and last rows."""
+        # Column positions: trans_id = 0, tstamp = 2.
+        if self.before:
+            self.prev_cursor = encode_page_cursor(first[2], first[0]) if more else None
+            self.next_cursor = encode_page_cursor(last[2], last[0])
+        else:
+            self.prev_cursor = encode_page_cursor(first[2], first[0]) if self.after else None
+            self.next_cursor = encode_page_cursor(last[2], last[0]) if more else None
+
+
+class PaymentSearch():
+    """A user's payments matching search filters, newest first.
+
+    Attributes:
+        - uid: id of the user whose payments are searched
+        - size: maximum number of payments returned
+        - filters: any of 'date_from' and 'date_to' (datetimes, the end
+                   excluded), 'mode', 'min_amount' and 'max_amount'
+                   (inclusive) and 'text' (a full-text query on notes)
+        - after: cursor of the last payment of the previous results
+        - next_cursor: cursor for more results, if any
+
+    Only the columns shown are selected. Both (uid, tstamp, ...) and
+    (uid, mode, tstamp, ...) indexes hold all of them, so every filter
+    but 'text' is answered from one index range without reading rows.
+    'text' goes through the full-text index on notes instead. As with
+    PaymentPage, results are fetched when iteration starts and can be
+    iterated once.
+    """
+
+    COLUMNS = ('trans_id', 'amount', 'tstamp', 'mode', 'note')
+
+    # Filter name -> condition it adds to the query.
+    CONDITIONS = {'date_from': 'tstamp >= %s',
+                  'date_to': 'tstamp < %s',
+                  'mode': 'mode=%s',
+                  'min_amount': 'amount >= %s',
+                  'max_amount': 'amount <= %s',
+                  'text': 'match(note) against (%s in boolean mode)'}
+
+    def __init__(self, uid: int, size: int, after: str=None, **filters) -> None:
+        """Initialize the search. Malformed cursors raise ValueError."""
+        unknown = set(filters) - set(self.CONDITIONS)
+        if unknown:
+            raise ValueError('Unknown payment filters: {}'.format(', '.join(sorted(unknown))))
+        self.uid = uid
+        self.size = size
+        self.filters = {k: v for k, v in filters.items() if v is not None}
+        self.after = decode_page_cursor(after) if after else None
+        self.next_cursor = None
+
+    def _query(self) -> tuple[str, tuple]:
+        """Build the search query and its parameters."""
+        conditions, params = ['uid=%s'], [self.uid]
+        # Fixed order, so each combination of filters is one statement.
+        for name, condition in self.CONDITIONS.items():
+            if name in self.filters:
+                conditions.append(condition)
+                params.append(self.filters[name])
+        if self.after:
+            tstamp, trans_id = self.after
+            conditions.append('(tstamp < %s or (tstamp=%s and trans_id < %s))')
+            params += [tstamp, tstamp, trans_id]
+
+        # One extra row tells if there are more results.
+        _SQL = """select {0} from payment_history where {1}
+                  order by tstamp desc, trans_id desc limit %s""".format(
+            ', '.join(self.COLUMNS), ' and '.join(conditions))
+        return _SQL, tuple(params) + (self.size + 1,)
+
+    def __iter__(self) -> 'Generator[tuple]':
+        _SQL, params = self._query()
+        # At most size + 1 rows: read them whole and give the connection
+        # back before the response is streamed to a possibly slow client.
+        with UseDatabase(dbpool) as cursor:
+            cursor.execute(_SQL, params)
+            rows = cursor.fetchall()
+
+        # The extra row only tells that there are more results.
+        # Column positions: trans_id = 0, tstamp = 2.
+        if len(rows) > self.size:
+            rows = rows[:self.size]
+            self.next_cursor = encode_page_cursor(rows[-1][2], rows[-1][0])
+        yield from rows
+
+    def explain(self) -> list[dict]:
+        """Return the optimizer's plan of the search query, one dict per table."""
+        _SQL, params = self._query()
+        with UseDatabase(dbpool) as cursor:
+            cursor.execute('explain ' + _SQL, params)
+            to_dict = description_row_factory(cursor)
+            return [to_dict(row) for row in cursor.fetchall()]
+
+
+def find_table_scans(plan: list[dict]) -> list[dict]:
+    """Return the steps of an EXPLAIN plan that read a whole table or index.
+
+    'ALL' is a table scan and 'index' a scan of a full index; both
+    grow with the table rather than with the result.
+    """
+    return [step for step in plan if step.get('type') in ('ALL', 'index')]
@@ -10,7 +10,7 @@ INSERT INTO `card_details` VALUES
 
 
 
-INSERT INTO `payment_history` VALUES
+INSERT INTO `payment_history` (`trans_id`, `uid`, `amount`, `tstamp`, `mode`, `note`) VALUES
 (1,1,10000.00,'2022-12-25 16:58:49','Credit Card','test payment a'),
 (3,1,25000.00,'2022-12-26 06:32:45','Debit Card','test payment b'),
 (4,1,250.00,'2022-12-26 06:33:11','Debit Card','test payment c'),
@@ -15,6 +15,29 @@
 /*!40101 SET @OLD_SQL_MODE=@@SQL_MODE, SQL_MODE='NO_AUTO_VALUE_ON_ZERO' */;
 /*!40111 SET @OLD_SQL_NOTES=@@SQL_NOTES, SQL_NOTES=0 */;
 
+--
+-- Table structure for table `bills`
+--
+
+DROP TABLE IF EXISTS `bills`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `bills` (
+  `bill_id` int(11) unsigned NOT NULL AUTO_INCREMENT,
+  `meter_id` int(11) unsigned NOT NULL,
+  `uid` int(11) unsigned NOT NULL,
+  `units` int(11) unsigned NOT NULL,
+  `amount` decimal(13,2) NOT NULL,
+  `due_date` date NOT NULL,
+  `issue_date` timestamp NOT NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (`bill_id`),
+  UNIQUE KEY `meter_due` (`meter_id`,`due_date`),
+  KEY `uid` (`uid`),
+  CONSTRAINT `bills_ibfk_1` FOREIGN KEY (`meter_id`) REFERENCES `consumption` (`meter_id`),
+  CONSTRAINT `bills_ibfk_2` FOREIGN KEY (`uid`) REFERENCES `user_details` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `card_details`
 --
@@ -97,8 +120,12 @@ CREATE TABLE `payment_history` (
   `tstamp` timestamp NOT NULL DEFAULT current_timestamp(),
   `mode` varchar(16) NOT NULL CHECK (`mode` in ('Credit Card','Debit Card')),
   `note` varchar(64) DEFAULT NULL,
+  `idem_key` varchar(64) CHARACTER SET utf8mb4 COLLATE utf8mb4_nopad_bin DEFAULT NULL,
   PRIMARY KEY (`trans_id`),
-  KEY `uid` (`uid`),
+  UNIQUE KEY `idem_key_uid` (`idem_key`,`uid`),
+  KEY `uid_tstamp_trans` (`uid`,`tstamp`,`trans_id`,`mode`,`amount`,`note`),
+  KEY `uid_mode_tstamp` (`uid`,`mode`,`tstamp`,`trans_id`,`amount`,`note`),
+  FULLTEXT KEY `note_text` (`note`),
   CONSTRAINT `payment_history_ibfk_1` FOREIGN KEY (`uid`) REFERENCES `user_details` (`id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 /*!40101 SET character_set_client = @saved_cs_client */;
@@ -0,0 +1,207 @@
+"""Bulk export of payments, with their owners' details, for accounting.
+
+Payments are read in trans_id order a chunk at a time (see
+crud.export_payments()), formatted as CSV or newline-delimited JSON and
+gzip compressed on the fly, so memory use is the same for a thousand
+payments or a hundred million. Run with:
+
+    flask --app main export-payments payments.csv.gz [--watermark FILE]
+
+With --watermark, the newest exported trans_id is saved after a
+complete export and the next export starts after it (an incremental
+export). Admins can download the same through
+/api/admin/exports/payments?format=csv&after=<trans_id>; the response's
+'X-Export-Watermark' header is the 'after' of the next download.
+"""
+import csv
+import io
+import json
+import os
+import time
+import zlib
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+# Media type of each export format (before compression).
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+# Text gathered before it is handed to the compressor.
+FLUSH_CHARS = 64 * 1024
+
+
+# Leading characters that make spreadsheets read a cell as a formula.
+FORMULA_PREFIXES = ('=', '+', '-', '@')
+
+
+def _safe_cell(value: object) -> object:
+    """Quote text a spreadsheet would evaluate as a formula."""
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def csv_pieces(rows: 'Iterable[tuple]', columns: tuple) -> 'Generator[str]':
+    """Yield CSV text of rows, with a header line, in large pieces.
+
+    Text cells starting with '=', '+', '-' or '@' are prefixed with a
+    quote, so names or notes are never run as formulas when the file is
+    opened in a spreadsheet.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([_safe_cell(value) for value in row])
+        if buffer.tell() >= FLUSH_CHARS:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _json_default(value: object) -> str:
+    """Write timestamps in ISO format and decimals as exact strings."""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def ndjson_pieces(rows: 'Iterable[tuple]', columns: tuple) -> 'Generator[str]':
+    """Yield one JSON object per row and line, in large pieces."""
+    dumps = json.JSONEncoder(separators=(',', ':'), default=_json_default).encode
+    lines, size = [], 0
+    for row in rows:
+        line = dumps(dict(zip(columns, row)))
+        lines.append(line)
+        size += len(line) + 1
+        if size >= FLUSH_CHARS:
+            lines.append('')
+            yield '\n'.join(lines)
+            lines, size = [], 0
+    if lines:
+        lines.append('')
+        yield '\n'.join(lines)
+
+
+def gzip_stream(pieces: 'Iterable[str]', level: int=6) -> 'Generator[bytes]':
+    """Compress text pieces into a gzip stream as they come."""
+    # wbits 31: deflate data in a gzip container, like gzip.compress().
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for piece in pieces:
+        data = compressor.compress(piece.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_stream(fmt: str, after: int, until: int, chunk_size: int=10000,
+                  level: int=6, totals: dict=None,
+                  buffered: bool=False) -> 'Generator[bytes]':
+    """Yield the gzip compressed export of payments after..until.
+
+    Parameters:
+        - fmt: 'csv' or 'ndjson'
+        - after, until: range of trans_id exported (after excluded)
+        - totals: dict updated with the number of 'rows' and 'bytes'
+        - buffered: read whole chunks, holding no connection between
+                    them (see crud.export_payments())
+    """
+    # Imported here so the formatting can be used without a database.
+    import crud
+
+    totals = totals if totals is not None else {}
+    totals.update(rows=0, bytes=0)
+
+    def counted(rows: 'Iterable[tuple]') -> 'Generator[tuple]':
+        for row in rows:
+            totals['rows'] += 1
+            yield row
+
+    formatter = csv_pieces if fmt == 'csv' else ndjson_pieces
+    rows = counted(crud.export_payments(after, until, chunk_size, buffered))
+    for data in gzip_stream(formatter(rows, crud.EXPORT_COLUMNS), level):
+        totals['bytes'] += len(data)
+        yield data
+
+
+class Watermark():
+    """Newest trans_id of the last complete export, kept in a file.
+
+    Attributes:
+        - path: JSON file the watermark is kept in
+        - trans_id: newest payment exported (0 before the first export)
+        - rows: number of payments in the last export
+        - exported_at: when the last export finished (ISO format)
+    """
+
+    def __init__(self, path: str) -> None:
+        """Load a saved watermark, or start from the first payment."""
+        self.path = path
+        self.trans_id = self.rows = 0
+        self.exported_at = None
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            self.trans_id = saved['trans_id']
+            self.rows = saved['rows']
+            self.exported_at = saved['exported_at']
+
+    def save(self) -> None:
+        """Atomically write the watermark to disk."""
+        if not self.path:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'trans_id': self.trans_id, 'rows': self.rows,
+                       'exported_at': self.exported_at}, f)
+        os.replace(tmp, self.path)
+
+
+@click.command('export-payments')
+@click.argument('output', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'fmt', type=click.Choice(list(EXPORT_FORMATS)),
+              help='Output format (guessed from the file name by default).')
+@click.option('--after', type=click.IntRange(min=0),
+              help='Export payments after this trans_id (default: the watermark, or 0).')
+@click.option('--watermark', type=click.Path(dir_okay=False),
+              help='File keeping the newest exported trans_id between exports.')
+@click.option('--chunk-size', default=10000, show_default=True,
+              help='Payments read per query.')
+@click.option('--level', default=6, show_default=True, type=click.IntRange(1, 9),
+              help='gzip compression level.')
+@with_appcontext
+def export_payments_command(output: str, fmt: str, after: int, watermark: str,
+                            chunk_size: int, level: int) -> None:
+    """Export payments and their owners to a gzip compressed file."""
+    import crud
+
+    fmt = fmt or ('ndjson' if '.ndjson' in output or '.jsonl' in output else 'csv')
+    mark = Watermark(watermark)
+    after = mark.trans_id if after is None else after
+    until = crud.get_export_bound(current_app.config.get('EXPORT_SETTLE_SECONDS', 60))
+    if until <= after:
+        click.echo('No payments after trans_id {}.'.format(after))
+        return
+
+    started = time.monotonic()
+    totals = {}
+    # Written aside and renamed, so a failed export leaves no partial file.
+    tmp = output + '.part'
+    with open(tmp, 'wb') as f:
+        for data in export_stream(fmt, after, until, chunk_size, level, totals):
+            f.write(data)
+    os.replace(tmp, output)
+
+    mark.trans_id, mark.rows = until, totals['rows']
+    mark.exported_at = datetime.now().isoformat(timespec='seconds')
+    mark.save()
+
+    elapsed = time.monotonic() - started
+    click.echo('{0} payments (trans_id {1} to {2}) exported to {3}: {4:.1f} MB '
+               'in {5:.1f}s ({6:.0f} payments/s).'.format(
+                   totals['rows'], after + 1, until, output, totals['bytes'] / 1e6,
+                   elapsed, totals['rows'] / elapsed if elapsed else 0))
@@ -0,0 +1,215 @@
+"""Bulk import of user accounts from CSV or JSON Lines files.
+
+Each record uses the field names of the registration and signup forms
+(fname, lname, age, gender, email, mobile-num, addr, card-name,
+card-type, card-number, card-cvv, card-expiry, username, password) and
+goes through the same checks. Run with:
+
+    flask --app main import-users customers.csv
+"""
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import click
+import mariadb
+from bcrypt import gensalt, hashpw
+from flask import current_app
+from flask.cli import with_appcontext
+
+import crud
+from validations import REGISTRATION_FORM, CARD_FORM, SIGNUP_FORM
+
+
+def hash_password(plain: str, rounds: int) -> str:
+    """Hash a password (runs in a worker process)."""
+    return hashpw(plain.encode('utf-8'), gensalt(rounds)).decode('utf-8')
+
+
+class MalformedRecord():
+    """Stands in for a JSON Lines record that could not be read.
+
+    Attributes:
+        - error: why the line was not a record, with its line number
+    """
+
+    def __init__(self, error: str) -> None:
+        self.error = error
+
+
+def read_records(path: str, fmt: str) -> 'Generator[dict | MalformedRecord]':
+    """Yield records of a CSV (with header row) or JSON Lines file.
+
+    JSON Lines that are not a JSON object are yielded as a
+    MalformedRecord, to be rejected like any invalid record.
+    """
+    with open(path, newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            yield from csv.DictReader(f)
+        else:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    yield MalformedRecord('line {0}: invalid JSON ({1})'.format(number, e))
+                    continue
+                if not isinstance(record, dict):
+                    yield MalformedRecord('line {}: not a JSON object'.format(number))
+                    continue
+                yield record
+
+
+def clean_record(record: 'dict | MalformedRecord') -> tuple[dict, dict, list]:
+    """Validate a record like the web forms do.
+
+    Returns basic info, card info and a list of error messages.
+    """
+    if isinstance(record, MalformedRecord):
+        return {}, {}, [record.error]
+    # Form values are strings; JSON files may hold numbers.
+    form = {k: str(v) for k, v in record.items() if v is not None}
+    form.setdefault('confirm-password', form.get('password'))
+
+    basic, errors = REGISTRATION_FORM.clean(form)
+    card, card_errors = CARD_FORM.clean(form)
+    credentials, cred_errors = SIGNUP_FORM.clean(form)
+    errors += card_errors + cred_errors
+    basic['username'] = credentials.get('username')
+    basic['password'] = credentials.get('password')
+    return basic, card, errors
+
+
+class Checkpoint():
+    """Progress of an import, saved after every committed chunk.
+
+    Attributes:
+        - path: JSON file the progress is kept in
+        - offset: number of input records already handled
+        - imported: number of users stored
+        - rejected: number of records turned away
+    """
+
+    def __init__(self, path: str, source: str) -> None:
+        """Load saved progress for 'source', or start from scratch."""
+        self.path = path
+        self.source = os.path.abspath(source)
+        self.offset = self.imported = self.rejected = 0
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved.get('source') == self.source:
+                self.offset = saved['offset']
+                self.imported = saved['imported']
+                self.rejected = saved['rejected']
+
+    def save(self) -> None:
+        """Atomically write progress to disk."""
+        if not self.path:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'source': self.source, 'offset': self.offset,
+                       'imported': self.imported, 'rejected': self.rejected}, f)
+        os.replace(tmp, self.path)
+
+
+def store_chunk(users: list, cards: list, rejects: list) -> int:
+    """Store valid users of a chunk and return how many were stored.
+
+    A batch failing on a constraint (e.g. a taken username) is retried
+    row by row so that only the offending records are rejected.
+    """
+    try:
+        crud.add_users(users, cards)
+        return len(users)
+    except mariadb.IntegrityError:
+        pass
+
+    stored = 0
+    for basic, card in zip(users, cards):
+        try:
+            crud.add_user(basic, card)
+            stored += 1
+        except mariadb.IntegrityError as e:
+            rejects.append((basic['username'], [str(e)]))
+    return stored
+
+
+@click.command('import-users')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='Input format (guessed from the file extension by default).')
+@click.option('--chunk-size', default=1000, show_default=True,
+              help='Users stored per transaction.')
+@click.option('--workers', type=int, help='Hashing processes (default: CPU count).')
+@click.option('--checkpoint', type=click.Path(dir_okay=False),
+              help='File to save progress in and resume from.')
+@click.option('--rejects', type=click.Path(dir_okay=False),
+              help='JSON Lines file listing rejected records and why.')
+@with_appcontext
+def import_users(path: str, fmt: str, chunk_size: int, workers: int,
+                 checkpoint: str, rejects: str) -> None:
+    """Import user accounts from a CSV or JSON Lines file."""
+    fmt = fmt or ('jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+    rounds = current_app.config.get('BCRYPT_ROUNDS', 12)
+    progress = Checkpoint(checkpoint, path)
+    if progress.offset:
+        click.echo('Resuming after {} records.'.format(progress.offset))
+
+    records = islice(read_records(path, fmt), progress.offset, None)
+    started = time.monotonic()
+    done = 0
+    reject_file = open(rejects, 'a', encoding='utf-8') if rejects else None
+
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            while True:
+                chunk = list(islice(records, chunk_size))
+                if not chunk:
+                    break
+
+                users, cards, rejected = [], [], []
+                for number, record in enumerate(chunk, progress.offset + 1):
+                    basic, card, errors = clean_record(record)
+                    if errors:
+                        rejected.append(('record {}'.format(number), errors))
+                    else:
+                        users.append(basic)
+                        cards.append(card)
+
+                # Hash passwords of the chunk in parallel.
+                hashes = pool.map(hash_password, [u['password'] for u in users],
+                                  [rounds] * len(users),
+                                  chunksize=max(1, len(users) // (4 * (workers or os.cpu_count() or 1))))
+                for user, password_hash in zip(users, hashes):
+                    user['password'] = password_hash
+
+                stored = store_chunk(users, cards, rejected)
+
+                progress.offset += len(chunk)
+                progress.imported += stored
+                progress.rejected += len(rejected)
+                progress.save()
+
+                if reject_file:
+                    for where, errors in rejected:
+                        reject_file.write(json.dumps({'record': where, 'errors': errors}) + '\n')
+                    reject_file.flush()
+
+                done += len(chunk)
+                elapsed = time.monotonic() - started
+                click.echo('{0} records handled, {1} imported, {2} rejected '
+                           '({3:.0f} records/s)'.format(progress.offset, progress.imported,
+                                                        progress.rejected, done / elapsed))
+    finally:
+        if reject_file:
+            reject_file.close()
+
+    click.echo('Import finished: {0} imported, {1} rejected.'
+               .format(progress.imported, progress.rejected))
@@ -0,0 +1,139 @@
+"""Streaming ingestion of meter readings into the 'consumption' table.
+
+Readings (meter_id, reading) arrive as CSV with a header row or as JSON
+Lines. They flow through a generator pipeline, so memory use depends on
+the chunk size and not on the size of the input:
+
+    parse -> validate -> deduplicate per chunk -> chunked update
+
+Readings only ever move a meter's current reading forward, which makes
+applying the same file again a no-op.
+"""
+import csv
+import json
+import time
+from itertools import islice
+
+import click
+from flask.cli import with_appcontext
+
+# Column is 'int(11) unsigned' in the schema.
+MAX_READING = 4294967295
+
+
+class IngestStats():
+    """Counters of one ingestion run."""
+
+    def __init__(self) -> None:
+        self.read = 0
+        self.rejected = 0
+        self.duplicates = 0
+        self.applied = 0
+        self.changed = 0
+        self.started = time.monotonic()
+
+    def as_dict(self) -> dict:
+        """Return counters along with the ingestion rate."""
+        elapsed = time.monotonic() - self.started
+        return {'read': self.read, 'rejected': self.rejected,
+                'duplicates': self.duplicates, 'applied': self.applied,
+                'changed': self.changed, 'seconds': round(elapsed, 3),
+                'rows_per_second': round(self.read / elapsed) if elapsed else 0}
+
+
+def parse_readings(lines: 'Iterable[str]', fmt: str,
+                   stats: IngestStats) -> 'Generator[dict]':
+    """Yield raw records from CSV or JSON Lines text lines."""
+    if fmt == 'csv':
+        records = csv.DictReader(lines)
+    else:
+        records = (line for line in lines if line.strip())
+
+    for record in records:
+        stats.read += 1
+        if fmt != 'csv':
+            try:
+                record = json.loads(record)
+            except ValueError:
+                stats.rejected += 1
+                continue
+        yield record
+
+
+def validate_readings(records: 'Iterable[dict]',
+                      stats: IngestStats) -> 'Generator[tuple]':
+    """Yield (meter_id, reading) pairs of well-formed records."""
+    for record in records:
+        try:
+            meter_id = int(record['meter_id'])
+            reading = int(record['reading'])
+        except (KeyError, TypeError, ValueError):
+            stats.rejected += 1
+            continue
+        if meter_id <= 0 or not 0 <= reading <= MAX_READING:
+            stats.rejected += 1
+            continue
+        yield meter_id, reading
+
+
+def dedupe_chunks(pairs: 'Iterable[tuple]', chunk_size: int,
+                  stats: IngestStats) -> 'Generator[dict]':
+    """Group pairs into chunks keeping the highest reading per meter."""
+    pairs = iter(pairs)
+    while True:
+        chunk = list(islice(pairs, chunk_size))
+        if not chunk:
+            return
+        latest = {}
+        for meter_id, reading in chunk:
+            if meter_id in latest:
+                stats.duplicates += 1
+                if reading <= latest[meter_id]:
+                    continue
+            latest[meter_id] = reading
+        yield latest
+
+
+def ingest(lines: 'Iterable[str]', fmt: str='csv', chunk_size: int=5000,
+           progress: object=None) -> dict:
+    """Apply readings from text lines and return run statistics.
+
+    Parameters:
+        - lines: iterable of text lines (an open file or a stream)
+        - fmt: 'csv' or 'jsonl'
+        - chunk_size: readings updated per transaction
+        - progress: callable given the stats dict after every chunk
+    """
+    import crud
+
+    stats = IngestStats()
+    records = parse_readings(lines, fmt, stats)
+    pairs = validate_readings(records, stats)
+    for latest in dedupe_chunks(pairs, chunk_size, stats):
+        stats.changed += crud.apply_readings(list(latest.items()))
+        stats.applied += len(latest)
+        if progress:
+            progress(stats.as_dict())
+    return stats.as_dict()
+
+
+@click.command('ingest-readings')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='Input format (guessed from the file extension by default).')
+@click.option('--chunk-size', default=5000, show_default=True,
+              help='Readings updated per transaction.')
+@with_appcontext
+def ingest_command(path: str, fmt: str, chunk_size: int) -> None:
+    """Load meter readings collected by scouts from a file."""
+    fmt = fmt or ('jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+
+    def report(stats: dict) -> None:
+        click.echo('{read} rows read, {applied} applied, {rejected} rejected '
+                   '({rows_per_second} rows/s)'.format(**stats))
+
+    with open(path, newline='', encoding='utf-8') as f:
+        stats = ingest(f, fmt, chunk_size, progress=report)
+    click.echo('Done: {read} rows read, {applied} applied ({changed} changed), '
+               '{duplicates} duplicates, {rejected} rejected in {seconds}s '
+               '({rows_per_second} rows/s).'.format(**stats))
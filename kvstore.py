@@ -0,0 +1,263 @@
+"""Key-value stores with per-entry expiry for caches and sessions.
+
+All stores map string keys to bytes values and share one interface:
+get(), set(), delete(), purge() and lock(). Three backends exist:
+
+    - LRUStore: in-process, bounded by entry count
+    - UWSGICacheStore: uWSGI cache visible to every worker process
+    - SQLiteStore: SQLite file visible to every process on the host
+"""
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock, RLock, Thread, local
+
+try:
+    # Only importable inside a uWSGI process.
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+
+class LRUStore():
+    """In-process store that evicts least recently used entries.
+
+    Attributes:
+        - maxsize: maximum number of entries kept
+
+    Entries are private to one worker process.
+    """
+
+    def __init__(self, maxsize: int=10000) -> None:
+        """Initialize an empty store."""
+        self.maxsize = maxsize
+        # key -> (value, expires_at)
+        self._data = OrderedDict()
+        self._lock = RLock()
+
+    def get(self, key: str) -> 'bytes | None':
+        """Return value of a live entry, or None."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[1] and entry[1] < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return entry[0]
+
+    def set(self, key: str, value: bytes, ttl: float=0) -> None:
+        """Store a value, expiring after 'ttl' seconds (0 never expires)."""
+        expires_at = time.monotonic() + ttl if ttl else 0
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        """Remove an entry if present."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def purge(self) -> int:
+        """Remove expired entries and return how many were removed."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [k for k, (_, exp) in self._data.items() if exp and exp < now]
+            for key in expired:
+                del self._data[key]
+        return len(expired)
+
+    def lock(self) -> RLock:
+        """Lock serializing read-modify-write sequences on the store."""
+        return self._lock
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class UWSGICacheStore():
+    """Store backed by a uWSGI cache shared by all worker processes.
+
+    Attributes:
+        - cache_name: name of a cache declared with 'cache2' in the
+                      uWSGI configuration
+        - failed_writes: values this worker could not store
+
+    uWSGI expires entries itself and, with 'purge_lru' enabled, evicts
+    the least recently used ones when the cache is full. Values larger
+    than the cache's blocksize cannot be stored; such writes are logged
+    and counted.
+    """
+
+    def __init__(self, cache_name: str) -> None:
+        """Bind to a cache. Raises RuntimeError outside uWSGI."""
+        if uwsgi is None:
+            raise RuntimeError('uWSGI cache store needs to run under uWSGI.')
+        self.cache_name = cache_name
+        self.failed_writes = 0
+
+    def get(self, key: str) -> 'bytes | None':
+        """Return value of a live entry, or None."""
+        return uwsgi.cache_get(key, self.cache_name)
+
+    def set(self, key: str, value: bytes, ttl: float=0) -> None:
+        """Store a value, expiring after 'ttl' seconds (0 never expires)."""
+        if not uwsgi.cache_update(key, value, int(ttl), self.cache_name):
+            self.failed_writes += 1
+            print('[KVSTORE] Cache {0} rejected {1} ({2} bytes); is it larger than '
+                  'the blocksize?'.format(self.cache_name, key, len(value)))
+
+    def delete(self, key: str) -> None:
+        """Remove an entry if present."""
+        uwsgi.cache_del(key, self.cache_name)
+
+    def purge(self) -> int:
+        """Expired entries are removed by uWSGI's cache sweeper."""
+        return 0
+
+    def stats(self) -> dict:
+        """Return this worker's number of failed writes."""
+        return {'failed_writes': self.failed_writes}
+
+    @contextmanager
+    def lock(self) -> None:
+        """Lock shared by all uWSGI workers."""
+        uwsgi.lock()
+        try:
+            yield
+        finally:
+            uwsgi.unlock()
+
+
+class SQLiteStore():
+    """Store kept in a SQLite database file.
+
+    Attributes:
+        - path: location of the database file
+
+    Each thread uses its own connection. WAL journaling lets readers in
+    other processes proceed while one process writes.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Create the store's table if needed."""
+        self.path = path
+        self._local = local()
+        self._lock = Lock()
+        conn = self._conn()
+        conn.execute('pragma journal_mode=wal')
+        conn.execute('create table if not exists kv (key text primary key, '
+                     'value blob not null, expires real not null)')
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        """Return this thread's connection, opening it if needed."""
+        conn = getattr(self._local, 'conn', None)
+        # Connections must not be shared with a forked child.
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key: str) -> 'bytes | None':
+        """Return value of a live entry, or None."""
+        row = self._conn().execute('select value, expires from kv where key=?',
+                                   (key,)).fetchone()
+        if row is None or (row[1] and row[1] < time.time()):
+            return None
+        return row[0]
+
+    def _write(self, sql: str, params: tuple) -> sqlite3.Cursor:
+        """Run a write, committing it unless inside lock()."""
+        conn = self._conn()
+        cursor = conn.execute(sql, params)
+        if not getattr(self._local, 'locked', False):
+            conn.commit()
+        return cursor
+
+    def set(self, key: str, value: bytes, ttl: float=0) -> None:
+        """Store a value, expiring after 'ttl' seconds (0 never expires)."""
+        expires = time.time() + ttl if ttl else 0
+        self._write('insert or replace into kv (key, value, expires) '
+                    'values (?, ?, ?)', (key, value, expires))
+
+    def delete(self, key: str) -> None:
+        """Remove an entry if present."""
+        self._write('delete from kv where key=?', (key,))
+
+    def purge(self) -> int:
+        """Remove expired entries and return how many were removed."""
+        cursor = self._write('delete from kv where expires > 0 and expires < ?',
+                             (time.time(),))
+        return cursor.rowcount
+
+    @contextmanager
+    def lock(self) -> None:
+        """Lock serializing read-modify-write sequences across processes.
+
+        Runs the enclosed operations in one 'begin immediate'
+        transaction, which keeps other writers out until it commits.
+        """
+        with self._lock:
+            conn = self._conn()
+            conn.execute('begin immediate')
+            self._local.locked = True
+            try:
+                yield
+            finally:
+                self._local.locked = False
+                conn.commit()
+
+
+def create_store(backend: str, **options) -> 'LRUStore | UWSGICacheStore | SQLiteStore':
+    """Create a store by backend name ('memory', 'uwsgi' or 'sqlite').
+
+    Parameters:
+        - backend: name of the store backend
+        - options: keyword arguments for the backend's constructor
+    """
+    backends = {'memory': LRUStore, 'uwsgi': UWSGICacheStore, 'sqlite': SQLiteStore}
+    if backend not in backends:
+        raise ValueError('Unknown store backend: {}'.format(backend))
+    return backends[backend](**options)
+
+
+class Purger():
+    """Background thread that periodically purges expired entries.
+
+    Attributes:
+        - store: store to purge
+        - interval: seconds between purges
+
+    The thread is started by ensure_running(), which is safe to call on
+    every request; it starts a new thread in each forked process.
+    """
+
+    def __init__(self, store: object, interval: float=60.0) -> None:
+        self.store = store
+        self.interval = interval
+        self._pid = None
+        self._lock = Lock()
+
+    def ensure_running(self) -> None:
+        """Start the purge thread in this process if not yet started."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                Thread(target=self._run, name='kvstore-purger', daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self) -> None:
+        """Purge expired entries forever."""
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.store.purge()
+            except Exception as e:
+                print('[KVSTORE] Purge failed: ', str(e))
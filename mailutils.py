@@ -1,37 +1,27 @@
 """Provide functions to help working with transactional emails."""
+import asyncio
+import atexit
+import heapq
+import os
+import re
+import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from smtplib import SMTP_SSL
-from socket import gaierror
+from itertools import count
+from smtplib import (SMTP, SMTP_SSL, SMTPDataError, SMTPException, SMTPRecipientsRefused,
+                     SMTPSenderRefused)
 from ssl import create_default_context
+from threading import Condition, Thread
 
 from flask import render_template
 
+import metrics
+from aioloop import bridged
 
-def create_mail_handler(sender_email: str, password: str, port: int,
-                        smtp_server: str):
-    """Create a SMTP object to perform email operations
-
-    Parameters:
-        - sender_email: email address to use for sending emails
-        - password: password for the above email
-        - port: port to use on smtp server for communicating
-        - smtp_server: smtp server's name
-
-    The SMTP object connects to the SMTP server over an SSL socket.
-    """
-    try:
-        # initialize ssl context and server
-        ssl_context = create_default_context()
-        server = SMTP_SSL(smtp_server, port, context=ssl_context)
-
-        # login
-        server.login(sender_email, password)
-        return server
-    except gaierror as e:
-        print(("[WARNING]: Socket error when creating mail handler.\n"
-               "[WARNING]: Check your internet connection."))
-        print(str(e))
+try:
+    import aiosmtplib
+except ImportError:
+    aiosmtplib = None
 
 
 def obfuscate_mail_addr(mail_address: str, ulimit: int=4) -> str:
@@ -81,3 +71,404 @@ def compose_html_mail(sender: str, receiver: str, subject: str, template: str,
     message.attach(html)
 
     return message.as_string()
+
+
+# Lines starting with a period, doubled when sending (RFC 5321 4.5.2).
+_LEADING_DOT_RE = re.compile(rb'^\.', re.MULTILINE)
+
+
+def pipelined_sendmail(server: SMTP, sender: str, receiver: str, data: bytes) -> None:
+    """Send a message with MAIL, RCPT and DATA in one round-trip.
+
+    Parameters:
+        - server: connected smtplib SMTP (or SMTP_SSL) object
+        - data: the whole message with CRLF line endings
+
+    Servers without the PIPELINING extension (RFC 2920) get the
+    commands one at a time through smtplib's sendmail(). Raises the
+    same exceptions as sendmail().
+    """
+    server.ehlo_or_helo_if_needed()
+    if not server.has_extn('pipelining'):
+        server.sendmail(sender, receiver, data)
+        return
+
+    server.send('MAIL FROM:<{0}>\r\nRCPT TO:<{1}>\r\nDATA\r\n'.format(sender, receiver))
+    mail_reply = server.getreply()
+    rcpt_reply = server.getreply()
+    data_reply = server.getreply()
+    if mail_reply[0] == 250 and rcpt_reply[0] in (250, 251) and data_reply[0] == 354:
+        data = _LEADING_DOT_RE.sub(b'..', data)
+        if not data.endswith(b'\r\n'):
+            data += b'\r\n'
+        server.send(data + b'.\r\n')
+        code, response = server.getreply()
+        if code != 250:
+            raise SMTPDataError(code, response)
+        return
+
+    # A server may still take data after refusing everything else.
+    if data_reply[0] == 354:
+        server.send(b'.\r\n')
+        server.getreply()
+    server.rset()
+    if mail_reply[0] != 250:
+        raise SMTPSenderRefused(mail_reply[0], mail_reply[1], sender)
+    if rcpt_reply[0] not in (250, 251):
+        raise SMTPRecipientsRefused({receiver: rcpt_reply})
+    raise SMTPDataError(*data_reply)
+
+
+class SMTPSession():
+    """A SMTP connection that reconnects whenever it is needed.
+
+    Attributes:
+        - smtp_server: smtp server's name
+        - port: port to use on smtp server for communicating
+        - sender_email: address used to log in (None skips login)
+        - password: password for the above email
+        - use_ssl: connect over an SSL socket instead of plain TCP
+        - timeout: socket timeout in seconds
+        - max_idle: idle seconds after which the connection is checked
+                    with NOOP before use
+
+    Servers drop idle clients after a while; instead of failing on the
+    next message, a dropped connection is detected and reopened.
+    """
+
+    def __init__(self, smtp_server: str, port: int, sender_email: str=None,
+                 password: str=None, use_ssl: bool=True, timeout: float=30.0,
+                 max_idle: float=60.0) -> None:
+        """Initialize settings. The connection is opened on first use."""
+        self.smtp_server = smtp_server
+        self.port = port
+        self.sender_email = sender_email
+        self.password = password
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.max_idle = max_idle
+
+        self._server = None
+        self._last_used = 0.0
+
+    def connect(self) -> None:
+        """Open (or reopen) the connection and log in."""
+        self.close()
+        if self.use_ssl:
+            server = SMTP_SSL(self.smtp_server, self.port, timeout=self.timeout,
+                              context=create_default_context())
+        else:
+            server = SMTP(self.smtp_server, self.port, timeout=self.timeout)
+
+        if self.sender_email and self.password:
+            server.login(self.sender_email, self.password)
+        self._server = server
+        self._last_used = time.monotonic()
+
+    def _is_alive(self) -> bool:
+        """Check if the open connection can still be used."""
+        if self._server is None:
+            return False
+        if time.monotonic() - self._last_used < self.max_idle:
+            return True
+        try:
+            return self._server.noop()[0] == 250
+        except (SMTPException, OSError):
+            return False
+
+    def sendmail(self, sender: str, receiver: 'str | list', message: str) -> None:
+        """Send a message, reconnecting once if the connection dropped."""
+        if not self._is_alive():
+            self.connect()
+        try:
+            self._server.sendmail(sender, receiver, message)
+        except (SMTPException, OSError) as e:
+            # Refused recipients won't be accepted on a new connection.
+            if isinstance(e, SMTPRecipientsRefused):
+                raise
+            self.connect()
+            self._server.sendmail(sender, receiver, message)
+        self._last_used = time.monotonic()
+
+    def send_pipelined(self, sender: str, receiver: str, data: bytes) -> None:
+        """Like sendmail(), for one receiver, with pipelined commands."""
+        if not self._is_alive():
+            self.connect()
+        try:
+            pipelined_sendmail(self._server, sender, receiver, data)
+        except (SMTPException, OSError) as e:
+            if isinstance(e, (SMTPRecipientsRefused, SMTPSenderRefused)):
+                raise
+            self.connect()
+            pipelined_sendmail(self._server, sender, receiver, data)
+        self._last_used = time.monotonic()
+
+    def close(self) -> None:
+        """Close the connection if open."""
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (SMTPException, OSError):
+                pass
+            self._server = None
+
+    def abort(self) -> None:
+        """Drop the connection without QUIT, e.g. after an unknown error."""
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+
+class MailOutbox():
+    """Queue of outgoing mail drained by background sender threads.
+
+    Attributes:
+        - session_factory: callable returning a new SMTPSession
+        - nsessions: number of sender threads, each with its own session
+        - max_retries: delivery attempts after the first one fails
+        - backoff: delay in seconds before the first retry (doubles on
+                   every further retry)
+        - max_backoff: upper limit of the retry delay in seconds
+        - maxsize: maximum number of queued messages
+
+    Requests only enqueue messages, so a slow or unreachable mail server
+    doesn't hold up a worker. Sender threads are started on first use
+    in each process, after uWSGI has forked its workers.
+    """
+
+    def __init__(self, session_factory: object, nsessions: int=2,
+                 max_retries: int=5, backoff: float=1.0,
+                 max_backoff: float=60.0, maxsize: int=1000) -> None:
+        """Initialize an empty outbox. No thread is started here."""
+        self.session_factory = session_factory
+        self.nsessions = nsessions
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.maxsize = maxsize
+
+        self._cond = Condition()
+        self._reset_state()
+
+    def _reset_state(self) -> None:
+        """Forget threads and queue (used at creation and after a fork)."""
+        self._pid = os.getpid()
+        self._threads = []
+        self._closing = False
+        # Heap of (ready_at, seq, attempt, enqueued_at, mail) entries.
+        self._queue = []
+        self._seq = count()
+        self._inflight = 0
+        self.counters = {'enqueued': 0, 'sent': 0, 'retries': 0,
+                         'failed': 0, 'rejected': 0,
+                         'send_seconds': 0.0, 'send_seconds_max': 0.0,
+                         'delivery_seconds': 0.0, 'delivery_seconds_max': 0.0}
+
+    def _start(self) -> None:
+        """Start sender threads (caller must hold the lock)."""
+        if self._pid != os.getpid():
+            self._reset_state()
+        if self._threads:
+            return
+        for i in range(self.nsessions):
+            thread = Thread(target=self._run, name='mail-outbox-{}'.format(i),
+                            daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        atexit.register(self.close)
+
+    def enqueue(self, sender: str, receiver: str, message: str) -> bool:
+        """Queue a message for delivery and return immediately.
+
+        Returns False if the outbox is full and the message was dropped.
+        """
+        with self._cond:
+            self._start()
+            if len(self._queue) >= self.maxsize:
+                self.counters['rejected'] += 1
+                return False
+            now = time.monotonic()
+            heapq.heappush(self._queue, (now, next(self._seq), 0, now,
+                                         (sender, receiver, message)))
+            self.counters['enqueued'] += 1
+            self._cond.notify()
+        return True
+
+    def _next(self) -> 'tuple | None':
+        """Wait for the next message that is due for delivery."""
+        with self._cond:
+            while True:
+                if self._queue:
+                    delay = self._queue[0][0] - time.monotonic()
+                    if delay <= 0:
+                        self._inflight += 1
+                        return heapq.heappop(self._queue)
+                elif self._closing:
+                    return None
+                else:
+                    delay = None
+                self._cond.wait(delay)
+
+    def _run(self) -> None:
+        """Sender thread: deliver due messages over one SMTP session."""
+        session = self.session_factory()
+        while True:
+            entry = self._next()
+            if entry is None:
+                break
+            _, _, attempt, enqueued_at, mail = entry
+
+            started = time.monotonic()
+            try:
+                session.sendmail(*mail)
+            except Exception as e:
+                # Whatever went wrong, the thread lives on for the next mail.
+                print('[MAIL] Delivery to {0} failed (attempt {1}): {2!r}'
+                      .format(mail[1], attempt + 1, e))
+                if not isinstance(e, (SMTPException, OSError)):
+                    # The conversation may have stopped halfway; start afresh.
+                    session.abort()
+                self._retry(entry, e)
+            else:
+                self._record(started, enqueued_at)
+            finally:
+                with self._cond:
+                    self._inflight -= 1
+                    self._cond.notify_all()
+        session.close()
+
+    def _retry(self, entry: tuple, error: Exception) -> None:
+        """Requeue a failed message with exponential backoff."""
+        _, seq, attempt, enqueued_at, mail = entry
+        with self._cond:
+            # Refused recipients won't be accepted on a later attempt, and
+            # errors other than SMTP or network ones would only repeat.
+            if (attempt >= self.max_retries or isinstance(error, SMTPRecipientsRefused)
+                    or not isinstance(error, (SMTPException, OSError))):
+                self.counters['failed'] += 1
+                return
+            delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+            heapq.heappush(self._queue, (time.monotonic() + delay, seq,
+                                         attempt + 1, enqueued_at, mail))
+            self.counters['retries'] += 1
+            self._cond.notify()
+
+    def _record(self, started: float, enqueued_at: float) -> None:
+        """Update latency counters after a successful delivery."""
+        now = time.monotonic()
+        metrics.registry.observe('smtp_send_seconds', now - started)
+        with self._cond:
+            c = self.counters
+            c['sent'] += 1
+            c['send_seconds'] += now - started
+            c['send_seconds_max'] = max(c['send_seconds_max'], now - started)
+            c['delivery_seconds'] += now - enqueued_at
+            c['delivery_seconds_max'] = max(c['delivery_seconds_max'],
+                                             now - enqueued_at)
+
+    def flush(self, timeout: float=None) -> bool:
+        """Wait until the queue is empty and no message is being sent."""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._queue and not self._inflight, timeout)
+
+    def close(self, timeout: float=5.0) -> None:
+        """Deliver what is due within 'timeout' and stop sender threads."""
+        self.flush(timeout)
+        with self._cond:
+            self._closing = True
+            # Messages still waiting for a retry are given up.
+            self._queue.clear()
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        """Return delivery counters along with the current queue depth."""
+        with self._cond:
+            stats = dict(self.counters)
+            stats['depth'] = len(self._queue)
+            stats['inflight'] = self._inflight
+        return stats
+
+
+class AsyncMailer():
+    """Send mail from async views without a thread per SMTP session.
+
+    Attributes:
+        - smtp_server, port, sender_email, password, use_ssl, timeout:
+          as for SMTPSession
+        - nsessions: number of SMTP connections kept open
+
+    Connections are opened on the worker's background loop (see
+    aioloop) on first use and reused; a dropped one is reopened once
+    before a delivery fails. Needs the optional 'aiosmtplib' package.
+    """
+
+    def __init__(self, smtp_server: str, port: int, sender_email: str=None,
+                 password: str=None, use_ssl: bool=True, timeout: float=30.0,
+                 nsessions: int=4) -> None:
+        """Initialize settings. No connection is opened here."""
+        if aiosmtplib is None:
+            raise ImportError('AsyncMailer needs the aiosmtplib package.')
+        self.smtp_server = smtp_server
+        self.port = port
+        self.sender_email = sender_email
+        self.password = password
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.nsessions = nsessions
+        self.counters = {'sent': 0, 'failed': 0, 'reconnects': 0}
+        self._sessions = None
+        self._pid = None
+
+    async def _connect(self) -> 'aiosmtplib.SMTP':
+        """Open a new SMTP connection and log in."""
+        server = aiosmtplib.SMTP(hostname=self.smtp_server, port=self.port,
+                                 use_tls=self.use_ssl, timeout=self.timeout)
+        await server.connect()
+        if self.sender_email and self.password:
+            await server.login(self.sender_email, self.password)
+        return server
+
+    def _queue(self) -> 'asyncio.Queue':
+        """Return this process's queue of idle sessions (None if unopened)."""
+        if self._pid != os.getpid():
+            self._sessions, self._pid = asyncio.Queue(), os.getpid()
+            for _ in range(self.nsessions):
+                self._sessions.put_nowait(None)
+        return self._sessions
+
+    @bridged
+    async def send(self, sender: str, receiver: 'str | list', message: str) -> None:
+        """Deliver a message, waiting for a free session.
+
+        Raises SMTPException or OSError if delivery fails.
+        """
+        sessions = self._queue()
+        server = await sessions.get()
+        started = time.monotonic()
+        try:
+            try:
+                if server is None or not server.is_connected:
+                    server = await self._connect()
+                await server.sendmail(sender, receiver, message)
+            except aiosmtplib.SMTPRecipientsRefused:
+                raise
+            except (aiosmtplib.SMTPException, OSError):
+                # The server may have dropped an idle connection.
+                self.counters['reconnects'] += 1
+                server = await self._connect()
+                await server.sendmail(sender, receiver, message)
+        except BaseException:
+            self.counters['failed'] += 1
+            if server is not None:
+                server.close()
+            server = None
+            raise
+        finally:
+            sessions.put_nowait(server)
+        self.counters['sent'] += 1
+        metrics.registry.observe('smtp_send_seconds', time.monotonic() - started)
+
+    def stats(self) -> dict:
+        """Return delivery counters."""
+        return dict(self.counters)
@@ -1,40 +1,319 @@
-import datetime
-from random import randint
-from typing import Literal
+"""Power corporation web app, created by create_app().
+
+Nothing here touches the network when imported or when the app is
+created: database connections, the SMTP session and worker threads are
+all opened on first use in each process. This lets uWSGI build the app
+once in the master process and fork warm workers.
+"""
+import asyncio
+import time
+
+# Imports are the first startup phase.
+_imports_started = time.perf_counter()
+
+from io import TextIOWrapper  # noqa: E402
+from random import randint  # noqa: E402
+from typing import Literal  # noqa: E402
+
+from flask import (Blueprint, Flask, current_app, render_template,  # noqa: E402
+                   stream_template, session, flash, redirect, url_for, request,
+                   abort, jsonify, g)
+
+import acrud  # noqa: E402
+import authutils  # noqa: E402
+import crud  # noqa: E402
+import metrics  # noqa: E402
+from aioloop import bridged  # noqa: E402
+from assets import AssetManifest, build_assets_command  # noqa: E402
+from authutils import (get_hash, check_hash, needs_rehash, require_login,  # noqa: E402
+                       require_employee, configure_hashing, HashingBusy)
+from availability import AvailabilityIndex  # noqa: E402
+from billing import billing_command  # noqa: E402
+from export import EXPORT_FORMATS, export_payments_command, export_stream  # noqa: E402
+from importer import import_users  # noqa: E402
+from ingest import ingest, ingest_command  # noqa: E402
+from kvstore import create_store, uwsgi  # noqa: E402
+from mailutils import (SMTPSession, MailOutbox, AsyncMailer,  # noqa: E402
+                       obfuscate_mail_addr, compose_html_mail)
+from payments import (CommitterBusy, GroupCommitter, PaymentRejected,  # noqa: E402
+                      clean_payment)
+from paymentsearch import check_search_plans_command, parse_filters, stream_json  # noqa: E402
+from reminders import send_reminders_command  # noqa: E402
+from ratelimit import LoginThrottle, RateLimited, TokenBucket  # noqa: E402
+from rendercache import RenderCache  # noqa: E402
+from serversession import ServerSessionInterface  # noqa: E402
+from validations import (is_decimal_str, is_username, ValidationError,  # noqa: E402
+                         REGISTRATION_FORM, CARD_FORM, SIGNUP_FORM)
+
+# Reported by the first create_app() only.
+_import_seconds = time.perf_counter() - _imports_started
+
+bp = Blueprint('main', __name__)
+
+# Set up by create_app(); sends mails from background threads.
+mail_outbox = None
+# Set up by create_app() with 'ASYNC_VIEWS'; sends mails from async views.
+async_mailer = None
+# Set up by create_app(); rendered anonymous pages and fragments.
+render_cache = None
+# Set up by create_app(); limits login attempts across workers.
+login_throttle = None
+# Set up by create_app(); stores submitted payments in shared transactions.
+payment_committer = None
+# Set up by create_app(); answers username/mobile availability checks.
+availability_index = None
+availability_limit = None
+
+
+class StartupReport():
+    """Time the phases of app creation and print them.
+
+    Use each phase as a context manager:
+
+        with report.phase('config'):
+            ...
+    """
+
+    def __init__(self) -> None:
+        self.phases = []
+
+    def phase(self, name: str) -> 'StartupReport':
+        self._name = name
+        return self
+
+    def add(self, name: str, seconds: float) -> None:
+        """Record a phase timed elsewhere."""
+        self.phases.append((name, seconds))
+
+    def __enter__(self) -> None:
+        self._started = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, exc_trace) -> None:
+        self.add(self._name, time.perf_counter() - self._started)
 
-from flask import Flask, render_template, session, flash, redirect, url_for, request
+    def print(self) -> None:
+        """Print one line per phase and the total, in milliseconds."""
+        for name, seconds in self.phases:
+            print('[STARTUP] {0:<12}{1:>9.1f} ms'.format(name, seconds * 1000))
+        total = sum(seconds for _, seconds in self.phases)
+        print('[STARTUP] {0:<12}{1:>9.1f} ms'.format('total', total * 1000))
 
-import crud
-from authutils import get_hash, check_hash, require_login
-from mailutils import create_mail_handler, obfuscate_mail_addr, compose_html_mail
-from validations import (range_validator, type_validator, regex_validator,
-                         compare_validator, is_decimal_str, non_empty, is_email, is_correct_date,
-                         is_username, is_password, ValidationError)
 
-app = Flask(__name__)
-app.config.from_envvar('CONFIG_FILE')
-# print(app.config)
+def create_smtp_session(config: dict) -> SMTPSession:
+    """Create a (not yet connected) SMTP session from app config."""
+    return SMTPSession(smtp_server=config['SMTP_SERVER'],
+                       port=config['SMTP_PORT'],
+                       sender_email=config['MAIL_ADDRESS'],
+                       password=config['MAIL_PASSWORD'],
+                       use_ssl=config.get('SMTP_SSL', True))
 
-# TODO: Perform this initialization asynchronously.
-mail_handler = create_mail_handler(sender_email=app.config['MAIL_ADDRESS'],
-                                   password=app.config['MAIL_PASSWORD'],
-                                   port=app.config['SMTP_PORT'],
-                                   smtp_server=app.config['SMTP_SERVER'])
 
+def create_app_store(app: Flask, prefix: str, cache_name: str) -> object:
+    """Create the kvstore store configured by '<prefix>_*' config keys.
 
-@app.route('/', methods=['GET'])
-@app.route('/home', methods=['GET'])
+    '<prefix>_BACKEND' selects 'memory', 'uwsgi' or 'sqlite'. Under
+    uWSGI the default is the uWSGI cache shared by all workers.
+    """
+    backend = app.config.get(prefix + '_BACKEND', 'uwsgi' if uwsgi else 'memory')
+    options = {'memory': {'maxsize': app.config.get(prefix + '_STORE_SIZE', 10000)},
+               'uwsgi': {'cache_name': app.config.get(prefix + '_UWSGI_CACHE', cache_name)},
+               'sqlite': {'path': app.config.get(prefix + '_SQLITE_PATH',
+                                                 cache_name + '.db')}}
+    return create_store(backend, **options[backend])
+
+
+def warm_templates(app: Flask) -> int:
+    """Compile all templates into the Jinja cache; return how many.
+
+    Done while preloading in the uWSGI master, workers inherit the
+    compiled templates instead of each compiling them on first use.
+    """
+    names = app.jinja_env.list_templates(extensions=('html',))
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def create_app(config_file: str=None, test_config: dict=None) -> Flask:
+    """Create and configure the app.
+
+    Parameters:
+        - config_file: path of the config file (default: CONFIG_FILE
+                       environment variable)
+        - test_config: settings applied over the config file
+
+    With 'PRELOAD_TEMPLATES' set, templates are compiled here rather
+    than on first render. With 'ASYNC_VIEWS' set, /verify and
+    /user/payments are served by their async versions (see
+    use_async_views()). Set 'STARTUP_REPORT' to False to silence the
+    timing report.
+    """
+    global mail_outbox, async_mailer, render_cache, login_throttle, \
+        availability_index, availability_limit, payment_committer, _import_seconds
+    report = StartupReport()
+    if _import_seconds is not None:
+        report.add('imports', _import_seconds)
+        _import_seconds = None
+
+    with report.phase('config'):
+        app = Flask(__name__)
+        if config_file:
+            app.config.from_pyfile(config_file)
+        else:
+            app.config.from_envvar('CONFIG_FILE')
+        if test_config:
+            app.config.update(test_config)
+
+    with report.phase('database'):
+        # Connections are opened on first query in each worker. User
+        # records are also cached in a store shared by workers, if set.
+        user_store = None
+        if app.config.get('USER_CACHE_SHARED', uwsgi is not None):
+            user_store = create_app_store(app, 'USER_CACHE', 'users')
+        crud.init_app(app, user_store)
+        # Filters of taken usernames and mobile numbers load on first use.
+        availability_index = AvailabilityIndex(app.config.get('AVAILABILITY_REFRESH', 1.0))
+        # Submitted payments are committed in batches by a background thread.
+        payment_committer = GroupCommitter(app.config.get('PAYMENT_BATCH_SIZE', 200),
+                                           app.config.get('PAYMENT_BATCH_DELAY', 0.005),
+                                           app.config.get('PAYMENT_QUEUE_SIZE', 5000))
+
+    with report.phase('sessions'):
+        # Keep session data on the server; the cookie only holds a session id.
+        app.session_interface = ServerSessionInterface(
+            create_app_store(app, 'SESSION', 'sessions'),
+            purge_interval=app.config.get('SESSION_PURGE_INTERVAL', 60))
+
+    with report.phase('metrics'):
+        # Time sampled requests; workers share snapshots through the store.
+        metrics.init_app(app, create_app_store(app, 'METRICS', 'metrics'))
+
+    with report.phase('ratelimit'):
+        # Buckets live in a store shared by all workers.
+        ratelimit_store = create_app_store(app, 'RATELIMIT', 'ratelimit')
+        login_throttle = LoginThrottle(
+            ratelimit_store,
+            ip_rate=app.config.get('LOGIN_RATE_IP', 0.5),
+            ip_burst=app.config.get('LOGIN_BURST_IP', 10),
+            user_rate=app.config.get('LOGIN_RATE_USER', 0.1),
+            user_burst=app.config.get('LOGIN_BURST_USER', 5))
+        # Employee API calls authenticate with every request.
+        authutils.configure_employee_auth(login_throttle,
+                                          app.config.get('EMPLOYEE_AUTH_TTL', 60.0))
+        availability_limit = TokenBucket(ratelimit_store, 'availability_ip',
+                                         app.config.get('AVAILABILITY_RATE_IP', 5.0),
+                                         app.config.get('AVAILABILITY_BURST_IP', 30))
+
+    with report.phase('hashing'):
+        # Password hashing runs on a bounded pool shared by request threads.
+        configure_hashing(workers=app.config.get('HASH_WORKERS'),
+                          max_pending=app.config.get('HASH_QUEUE'),
+                          timeout=app.config.get('HASH_TIMEOUT', 2.0),
+                          rounds=app.config.get('BCRYPT_ROUNDS', 12))
+
+    with report.phase('mail'):
+        # Mails are sent by background threads, which connect to the SMTP
+        # server only when the first message is queued.
+        mail_outbox = MailOutbox(lambda: create_smtp_session(app.config),
+                                 nsessions=app.config.get('MAIL_SESSIONS', 2),
+                                 max_retries=app.config.get('MAIL_RETRIES', 5),
+                                 maxsize=app.config.get('MAIL_QUEUE_SIZE', 1000))
+
+    with report.phase('views'):
+        app.register_blueprint(bp)
+        # Static URLs point at fingerprinted files once they are built.
+        AssetManifest(app)
+        render_cache = RenderCache(app.config.get('RENDER_CACHE_SIZE', 256))
+        render_cache.init_app(app)
+        # Command line tools ('flask --app main <command>').
+        app.cli.add_command(import_users)
+        app.cli.add_command(billing_command)
+        app.cli.add_command(ingest_command)
+        app.cli.add_command(build_assets_command)
+        app.cli.add_command(check_search_plans_command)
+        app.cli.add_command(send_reminders_command)
+        app.cli.add_command(export_payments_command)
+
+        # Counters of this worker's resources, exported with its histograms.
+        metrics.registry.register_collector('db_pool', lambda: crud.dbpool.stats())
+        metrics.registry.register_collector('hash', lambda: authutils.hasher.stats())
+        metrics.registry.register_collector('mail', mail_outbox.stats)
+        metrics.registry.register_collector('render_cache', render_cache.stats)
+        metrics.registry.register_collector('login_throttle', login_throttle.stats)
+        metrics.registry.register_collector('availability', availability_index.stats)
+        metrics.registry.register_collector('payments', payment_committer.stats)
+        if crud.tracer:
+            metrics.registry.register_collector('db_trace', crud.tracer.stats)
+        if crud.user_cache:
+            metrics.registry.register_collector('user_cache', crud.user_cache.stats)
+        if hasattr(app.session_interface.store, 'stats'):
+            # Sessions too large for the uWSGI cache are lost (logged out).
+            metrics.registry.register_collector('session_store',
+                                                app.session_interface.store.stats)
+        if app.config.get('ASYNC_VIEWS', False):
+            use_async_views(app)
+
+    if app.config.get('PRELOAD_TEMPLATES', False):
+        with report.phase('templates'):
+            warm_templates(app)
+
+    if app.config.get('STARTUP_REPORT', True):
+        report.print()
+    return app
+
+
+def use_async_views(app: Flask) -> None:
+    """Serve /verify and /user/payments with their async versions.
+
+    Their database queries and SMTP delivery run on each worker's
+    background event loop (see aioloop), through acrud's aiomysql pool
+    and an AsyncMailer. Needs the 'aiomysql', 'aiosmtplib' and
+    'asgiref' packages.
+    """
+    global async_mailer
+    acrud.init_app(app)
+    async_mailer = AsyncMailer(smtp_server=app.config['SMTP_SERVER'],
+                               port=app.config['SMTP_PORT'],
+                               sender_email=app.config['MAIL_ADDRESS'],
+                               password=app.config['MAIL_PASSWORD'],
+                               use_ssl=app.config.get('SMTP_SSL', True),
+                               nsessions=app.config.get('MAIL_SESSIONS', 2))
+    # Endpoints keep their names, so url_for() is unaffected. Flask runs
+    # async views through asgiref (ensure_sync).
+    app.view_functions['main.verify'] = app.ensure_sync(verify_async)
+    app.view_functions['main.show_payments'] = require_login(
+        app.ensure_sync(show_payments_async))
+    metrics.registry.register_collector('async_db_pool', acrud.dbpool.stats)
+    metrics.registry.register_collector('async_mail', async_mailer.stats)
+
+
+@bp.before_app_request
+def begin_query_scope() -> None:
+    # With query tracing on, repeated queries are reported per request.
+    if crud.tracer:
+        crud.tracer.begin_scope()
+
+
+@bp.after_app_request
+def end_query_scope(response: 'Response') -> 'Response':
+    if crud.tracer:
+        crud.tracer.end_scope('{0} {1}'.format(request.method, request.path))
+    return response
+
+
+@bp.route('/', methods=['GET'])
+@bp.route('/home', methods=['GET'])
 def home() -> 'html':
     """Render the webapp homepage."""
-    return render_template('home.html', the_title='Home')
+    return render_cache.page('home.html', the_title='Home')
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login() -> 'html | Redirect':
     """Login a user or redirect to dashboard if already logged in."""
     # Check if already logged in.
     if 'logged_in' in session:
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
 
     if request.method == 'POST':
         try:
@@ -44,6 +323,9 @@ def login() -> 'html | Redirect':
             print(str(e))
             raise ValidationError('One or more fields were left blank.')
 
+        # Turn away floods of attempts before any database or bcrypt work.
+        login_throttle.check(request.remote_addr or '', form_username)
+
         # Fetch user's record (if it exists) from the database.
         user = crud.get_user(form_username)
 
@@ -51,103 +333,44 @@ def login() -> 'html | Redirect':
         # and match given password's hash against one from the record.
         if user and check_hash(form_password, user['password']):
             # print(user)
+            # Upgrade hashes made with an older work factor while the
+            # plain password is at hand.
+            if needs_rehash(user['password']):
+                crud.update_password(user['id'], get_hash(form_password))
+
+            # A new session id for the logged in user (no session fixation).
+            session.regenerate()
             session['logged_in'] = True
             session['uid'] = user['id']
             # FIXME: flask flashes not visible in userpages
             # msg = 'Login successful for {}'.format(user['username'])
             # flash(msg)
-            return redirect(url_for('dashboard'))
+            return redirect(url_for('main.dashboard'))
         flash('Incorrect username or password.')
-    return render_template('login.html', the_title='Login')
+        return render_template('login.html', the_title='Login')
+    return render_cache.page('login.html', the_title='Login')
 
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register() -> 'html | Redirect':
     """Render and accept account registration forms."""
     if request.method == 'POST':
-        try:
-            # Validating Basic User Information
-            if not non_empty(request.form['fname'][:128]):
-                raise ValidationError('Invalid first name.')
-            if not non_empty(request.form['lname'][:128]):
-                raise ValidationError('Invalid last name.')
-
-            if not range_validator(int(request.form['age']), 18, 150):
-                raise ValidationError('Your age is inappropriate for registration.')
-
-            genders = ('Male', 'Female', 'Unsaid')
-            if not type_validator(request.form['gender'], genders):
-                raise ValidationError('Unknown gender type.')
-
-            if not is_email(request.form['email'][:256]):
-                raise ValidationError('Invalid email address provided.')
-
-            if not is_decimal_str(request.form['mobile-num'], 10):
-                raise ValidationError('Invalid phone number.')
-
-            if not non_empty(request.form['addr'][:256]):
-                raise ValidationError('Invalid address.')
-
-            # Basic registration particulars
-            basic_info = {'first_name': request.form['fname'][:128],
-                          'last_name':  request.form['lname'][:128],
-                          'age':        int(request.form['age']),
-                          'address':    request.form['addr'][:256],
-                          'gender':     request.form['gender'],
-                          'mobile_num': int(request.form['mobile-num']),
-                          'email':      request.form['email'][:256], }
-
-            # Validating given card details
-            if not regex_validator(request.form['card-name'][:32],
-                                   r'[A-Z]+ [A-Z]+'):
-                raise ValidationError('Enter a valid card name.')
-
-            card_types = ('Credit', 'Debit')
-            if not type_validator(request.form['card-type'], card_types):
-                raise ValidationError('Unknown card type.')
-
-            if not is_decimal_str(request.form['card-number'], 16):
-                raise ValidationError('Invalid card number.')
-            if not is_decimal_str(request.form['card-cvv'], 3):
-                raise ValidationError('Invalid CVV.')
-
-            if not is_correct_date(request.form['card-expiry'], '%Y-%m'):
-                raise ValidationError('Card is already expired or invalid card expiry date.')
-
-            # Add day to card expiry date before storing in DB.
-            # YYYY-MM -> YYYY-MM-DD where DD is last day of month MM.
-            exp_date = datetime.datetime.strptime(request.form['card-expiry'], '%Y-%m')
-
-            # Calculate last day of month:
-            # 1. Move up one day to first day of next month.
-            # 2. Go back 1 day to last day of original month.
-
-            # December is an exception as no month next to it.
-            if exp_date.month == 12:
-                exp_date = exp_date.replace(day=31)
-            else:
-                exp_date = (exp_date.replace(month=exp_date.month+1)
-                            - datetime.timedelta(days=1))
-
-            # credit/debit card details
-            card_info = {'name':   request.form['card-name'][:32],
-                         'type':   request.form['card-type'],
-                         'number': int(request.form['card-number']),
-                         'cvv':    int(request.form['card-cvv']),
-                         'expiry': exp_date}
-
-        except KeyError as e:
-            print(str(e))
-            raise ValidationError('One or more fields were left blank.')
-        except ValueError as e:
-            print(str(e))
-            raise ValidationError('Invalid value for a numeric field. ')
+        # Basic registration particulars and credit/debit card details
+        # are checked together so that all errors are reported at once.
+        basic_info, errors = REGISTRATION_FORM.clean(request.form)
+        card_info, card_errors = CARD_FORM.clean(request.form)
+        if errors or card_errors:
+            raise ValidationError(errors=errors + [e for e in card_errors
+                                                   if e not in errors])
+
+        # Catch a taken number before an OTP mail is sent for nothing.
+        if availability_index.is_taken('mobile', str(basic_info['mobile_num'])):
+            raise ValidationError('Mobile number is already registered.')
 
         # Generate random six digit OTP to verify email.
-        # TODO: Store in server-side session
         verify_info = {'otp': randint(100000, 999999)}
 
-        # Store registration data in browser's session cookie for later
+        # Store registration data in the server-side session for later
         # lookup when storing in DB after verification.
         session['reg'] = {}
         session['reg']['basic'] = basic_info
@@ -155,11 +378,29 @@ def register() -> 'html | Redirect':
         session['reg']['verify'] = verify_info
         print(session['reg'])
 
-        return redirect(url_for('verify'))
-    return render_template('register.html', the_title='New Connection')
+        return redirect(url_for('main.verify'))
+    return render_cache.page('register.html', the_title='New Connection')
+
+
+def compose_otp_mail(user_mail_addr: str) -> str:
+    """Compose the OTP mail of the registration in the session."""
+    # TODO: Separate email conversation for each OTP mail
+    # Construct email attachment from HTML template.
+    msg_subject = '[{}] - Confirm email with OTP'
+    msg_subject = msg_subject.format(session['reg']['verify']['otp'])
+    # print('[MAIL] Subject: ', msg_subject)
 
+    return compose_html_mail(sender=current_app.config['MAIL_ADDRESS'],
+                             receiver=session['reg']['basic']['email'],
+                             subject=msg_subject,
+                             template='otp.html',
+                             # template arguments
+                             user=session['reg']['basic']['first_name'],
+                             user_mail=user_mail_addr,
+                             otp=session['reg']['verify']['otp'])
 
-@app.route('/verify', methods=['GET', 'POST'])
+
+@bp.route('/verify', methods=['GET', 'POST'])
 def verify() -> 'Redirect':
     """Verify registration by sending OTP on email."""
     # Check if registration is initiated.
@@ -168,28 +409,18 @@ def verify() -> 'Redirect':
         user_mail_addr = obfuscate_mail_addr(session['reg']['basic']['email'])
 
         if request.method == 'GET' and 'sent' not in session['reg']['verify']:
-            # TODO: Asynchronous sending of OTP
-            # TODO: Separate email conversation for each OTP mail
-            # Construct email attachment from HTML template.
-            msg_subject = '[{}] - Confirm email with OTP'
-            msg_subject = msg_subject.format(session['reg']['verify']['otp'])
-            # print('[MAIL] Subject: ', msg_subject)
-
-            message = compose_html_mail(sender=app.config['MAIL_ADDRESS'],
-                                        receiver=session['reg']['basic']['email'],
-                                        subject=msg_subject,
-                                        template='otp.html',
-                                        # template arguments
-                                        user=session['reg']['basic']['first_name'],
-                                        user_mail=user_mail_addr,
-                                        otp=session['reg']['verify']['otp'])
-
-            # TODO: Handle edge case where mail_handler may be None
-            mail_handler.sendmail(app.config['MAIL_ADDRESS'],
-                                  session['reg']['basic']['email'],
-                                  message)
-
-            print('[OTP] Sent: ', session['reg']['verify']['otp'])
+            message = compose_otp_mail(user_mail_addr)
+
+            # Message is delivered in the background.
+            if not mail_outbox.enqueue(current_app.config['MAIL_ADDRESS'],
+                                       session['reg']['basic']['email'],
+                                       message):
+                flash('Could not send OTP right now. Please try resending.')
+                return render_template('verify_email.html',
+                                       the_title='Verify Email',
+                                       mail=user_mail_addr)
+
+            print('[OTP] Queued: ', session['reg']['verify']['otp'])
             flash('Check for OTP on registered email.')
 
             session['reg']['verify']['sent'] = True
@@ -200,7 +431,7 @@ def verify() -> 'Redirect':
                 if 'sent' in session['reg']['verify']:
                     session['reg']['verify'].pop('sent')
                     session.modified = True
-                return redirect(url_for('verify'))
+                return redirect(url_for('main.verify'))
 
             form_otp = ''
             otp_digits = request.form.getlist('digits[]')
@@ -218,7 +449,7 @@ def verify() -> 'Redirect':
                 session['reg']['verify']['verified'] = True
                 session['reg']['verify'].pop('sent')
                 session.modified = True
-                return redirect(url_for('set_credentials'))
+                return redirect(url_for('main.set_credentials'))
 
             msg = 'Incorrect OTP entered.'
             print(msg)
@@ -229,47 +460,83 @@ def verify() -> 'Redirect':
                                mail=user_mail_addr)
 
     flash('Please fill out the registration before verification.')
-    return redirect(url_for('register'))
+    return redirect(url_for('main.register'))
 
 
-@app.route('/signup', methods=['GET', 'POST'])
+@bridged
+async def deliver_or_queue(sender: str, receiver: str, message: str) -> bool:
+    """Deliver a mail directly, queueing it in the outbox if that fails.
+
+    Runs on the background loop to the end even when the awaiting view
+    stops waiting, so a slow delivery is neither cut off after the
+    server took the message nor sent a second time by the outbox.
+    Returns False only if the mail could be neither sent nor queued.
+    """
+    try:
+        await async_mailer.send(sender, receiver, message)
+    except Exception as e:
+        # Any failure leaves the mail to the outbox's retries.
+        print('[MAIL] Direct delivery failed, queueing: ', str(e))
+        return mail_outbox.enqueue(sender, receiver, message)
+    return True
+
+
+async def verify_async() -> 'Redirect':
+    """Verify registration, delivering the OTP mail before responding.
+
+    The request awaits SMTP delivery on the background loop instead of
+    queueing the mail. Failed deliveries go to the outbox, which
+    retries. After 'MAIL_SEND_TIMEOUT' the view responds without
+    waiting further; the delivery goes on in the background.
+    """
+    if request.method == 'GET' and 'reg' in session \
+            and 'sent' not in session['reg']['verify']:
+        message = compose_otp_mail(obfuscate_mail_addr(session['reg']['basic']['email']))
+        started = time.perf_counter()
+        try:
+            # Shielded: the timeout ends the wait, not the delivery.
+            handled = await asyncio.wait_for(
+                asyncio.shield(deliver_or_queue(current_app.config['MAIL_ADDRESS'],
+                                                session['reg']['basic']['email'],
+                                                message)),
+                current_app.config.get('MAIL_SEND_TIMEOUT', 5.0))
+        except asyncio.TimeoutError:
+            print('[MAIL] Delivery still in progress, not waiting for it')
+            handled = True
+        finally:
+            # Usually the bulk of this view's time.
+            metrics.add_time('smtp', time.perf_counter() - started)
+        # Unhandled (outbox full), the synchronous view reports the error.
+        if handled:
+            print('[OTP] Sent: ', session['reg']['verify']['otp'])
+            flash('Check for OTP on registered email.')
+            session['reg']['verify']['sent'] = True
+            session.modified = True
+    return verify()
+
+
+@bp.route('/signup', methods=['GET', 'POST'])
 def set_credentials() -> 'html | Redirect':
     """Set login credentials for a verified registration."""
     # Check if registered and verified.
     if 'reg' in session and 'verify' in session['reg']:
         if 'verified' in session['reg']['verify']:
             if request.method == 'POST':
-                try:
-                    form_username = request.form['username'][:64]
-                    if not is_username(form_username):
-                        errmsg = ('Username can only contain alphabets, '
-                                  'numerals, underscores, hyphens and periods.')
-                        raise ValidationError(errmsg)
-
-                    form_password = request.form['password'][:64]
-                    if not is_password(form_password):
-                        errmsg = ('Password must contain at least 8 characters '
-                                  'with at least a lowercase alphabet, an '
-                                  'uppercase alphabet, a numeral and one of '
-                                  '@$!%*?&.')
-                        raise ValidationError(errmsg)
-
-                    if not compare_validator(form_password,
-                                             request.form['confirm-password']):
-                        raise ValidationError('Passwords do not match.')
-
-                except KeyError as e:
-                    print(str(e))
-                    raise ValidationError('One or more fields were left blank.')
-
-                if compare_validator(form_password, form_username):
-                    raise ValidationError('Username cannot be the password.')
+                credentials = SIGNUP_FORM.validate(request.form)
+                form_username = credentials['username']
+                form_password = credentials['password']
+
+                # Catch a taken username before hashing the password.
+                if availability_index.is_taken('username', form_username):
+                    raise ValidationError('Username is already taken.')
 
                 session['reg']['basic']['username'] = form_username
                 session['reg']['basic']['password'] = get_hash(form_password)
 
                 # Commit the registration into a database record.
                 crud.add_user(session['reg']['basic'], session['reg']['card'])
+                availability_index.add(form_username,
+                                       session['reg']['basic']['mobile_num'])
 
                 # Flash registration completion message to user.
                 msg = ('Dear {user}, your request for a new '
@@ -277,46 +544,237 @@ def set_credentials() -> 'html | Redirect':
                        'expect further developments within 24 hours.')
                 flash(msg.format(user=session['reg']['basic']['first_name']))
 
-                # Remove data stored in session cookie during registration.
+                # Remove data stored in session during registration.
                 session.pop('reg')
-                return redirect(url_for('home'))
+                return redirect(url_for('main.home'))
             return render_template('signup.html',
                                    the_title='Set Login Credentials')
 
         flash('Please verify your email.')
-        return redirect(url_for('verify'))
+        return redirect(url_for('main.verify'))
 
     flash('Please register and verify yourself before account signup.')
-    return redirect(url_for('register'))
+    return redirect(url_for('main.register'))
+
 
+@bp.route('/api/availability', methods=['GET'])
+def check_availability() -> 'json':
+    """Tell forms whether a username or mobile number is still free.
 
-@app.route('/user/dashboard', methods=['GET'])
+    The query string holds one of 'username' or 'mobile'. Values that
+    fail the form's checks are reported as invalid without a lookup.
+    """
+    wait = availability_limit.take(request.remote_addr or '')
+    if wait:
+        raise RateLimited(wait, 'availability_ip')
+
+    checks = (('username', is_username),
+              ('mobile', lambda value: is_decimal_str(value, 10)))
+    for field, is_valid in checks:
+        value = request.args.get(field)
+        if value is None:
+            continue
+        value = value[:64]
+        if not is_valid(value):
+            return jsonify(field=field, valid=False, available=False)
+        return jsonify(field=field, valid=True,
+                       available=not availability_index.is_taken(field, value))
+    abort(400)
+
+
+@bp.route('/user/dashboard', methods=['GET'])
 @require_login
 def dashboard() -> 'html':
     """Render a logged in user's dashboard."""
-    return render_template('user/home.html', the_title='Dashboard')
+    return render_template('user/home.html', the_title='Dashboard',
+                           user=crud.find_user(uid=session['uid']))
 
 
-@app.route('/user/payments', methods=['GET'])
+@bp.route('/user/payments', methods=['GET'])
 @require_login
 def show_payments() -> 'html':
-    """Present a (logged in) user with their past payments."""
-    # TODO: Store uid in server-side session.
-    payments = crud.get_payments(session['uid'])
+    """Present a (logged in) user with a page of their past payments.
+
+    Pages are selected with the 'after'/'before' cursors in the query
+    string. With 'STREAM_PAYMENTS' set in the config, the page is sent
+    to the client as it is rendered (rows are fetched beforehand).
+    """
+    try:
+        payments = crud.PaymentPage(session['uid'],
+                                    current_app.config.get('PAYMENTS_PER_PAGE', 50),
+                                    after=request.args.get('after'),
+                                    before=request.args.get('before'))
+    except ValueError as e:
+        print(str(e))
+        abort(404)
+
     col_titles = ('#', 'Bill Amount', 'Time', 'Mode', 'Note')
+    if current_app.config.get('STREAM_PAYMENTS', False):
+        return current_app.response_class(stream_template('user/payments.html',
+                                                  the_title='Payment History',
+                                                  theads=col_titles,
+                                                  payments=payments))
+
+    # Exhaust the page here so that its cursors are set before rendering.
+    rows = list(payments)
     return render_template('user/payments.html', the_title='Payment History',
-                           theads=col_titles, payments=payments)
+                           theads=col_titles, payments=rows, page=payments)
+
+
+def payment_search_response(uid: int) -> 'json':
+    """Stream payments of a user that match the query string's filters.
+
+    See paymentsearch.parse_filters() for the filters. 'limit' caps the
+    number of payments (at most 'PAYMENT_SEARCH_LIMIT') and 'after' is
+    the 'next' cursor of earlier results.
+    """
+    max_limit = current_app.config.get('PAYMENT_SEARCH_LIMIT', 500)
+    try:
+        limit = int(request.args.get('limit', 50))
+        filters = parse_filters(request.args)
+        search = crud.PaymentSearch(uid, max(1, min(limit, max_limit)),
+                                    after=request.args.get('after'), **filters)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return current_app.response_class(stream_json(search), mimetype='application/json')
+
+
+@bp.route('/api/payments/search', methods=['GET'])
+@require_login
+def search_payments() -> 'json':
+    """Search the logged in user's payments."""
+    return payment_search_response(session['uid'])
+
+
+@bp.route('/api/payments/search/<int:uid>', methods=['GET'])
+@require_employee('Cashier', 'Admin')
+def search_user_payments(uid: int) -> 'json':
+    """Let a cashier search the payments of any user."""
+    return payment_search_response(uid)
+
+
+async def show_payments_async() -> 'html':
+    """Async version of show_payments(), also showing whose they are.
+
+    The page of payments and the user's record are fetched at the same
+    time.
+    """
+    try:
+        (rows, page), user = await asyncio.gather(
+            acrud.get_payment_page(session['uid'],
+                                   current_app.config.get('PAYMENTS_PER_PAGE', 50),
+                                   after=request.args.get('after'),
+                                   before=request.args.get('before')),
+            acrud.find_user(uid=session['uid']))
+    except ValueError as e:
+        print(str(e))
+        abort(404)
+
+    col_titles = ('#', 'Bill Amount', 'Time', 'Mode', 'Note')
+    return render_template('user/payments.html', the_title='Payment History',
+                           theads=col_titles, payments=rows, page=page, user=user)
+
+
+def record_payment_response(uid: int) -> tuple['json', int]:
+    """Record a payment of a user submitted as JSON.
+
+    The body holds 'amount', 'mode' and optionally 'note'; the
+    'Idempotency-Key' header identifies the submission. Respond 201
+    with the new payment, or 200 with the one recorded by an earlier
+    submission with the same key.
+    """
+    data = request.get_json(silent=True) if request.is_json else None
+    if not isinstance(data, dict):
+        raise PaymentRejected('Expected a JSON object.')
+    payment = clean_payment(data, request.headers.get('Idempotency-Key', ''))
+    row, created = payment_committer.record(
+        uid, payment, current_app.config.get('PAYMENT_COMMIT_TIMEOUT', 2.0))
+    return jsonify(trans_id=row['trans_id'], amount=str(row['amount']),
+                   tstamp=row['tstamp'].isoformat(), mode=row['mode'],
+                   note=row['note']), 201 if created else 200
+
+
+@bp.route('/api/payments', methods=['POST'])
+@require_login
+def submit_payment() -> tuple['json', int]:
+    """Record a payment made by the logged in user."""
+    return record_payment_response(session['uid'])
+
 
+@bp.route('/api/payments/<int:uid>', methods=['POST'])
+@require_employee('Cashier', 'Admin')
+def record_user_payment(uid: int) -> tuple['json', int]:
+    """Let a cashier record a payment received from a user."""
+    return record_payment_response(uid)
 
-@app.route('/logout', methods=["GET"])
+
+@bp.route('/api/readings', methods=['POST'])
+@require_employee('Scout', 'Admin')
+def upload_readings() -> 'json':
+    """Apply a batch of meter readings uploaded by a scout.
+
+    The request body is CSV (with a meter_id,reading header) or, with a
+    JSON content type, JSON Lines. It is read as a stream, so uploads of
+    any size use bounded memory.
+    """
+    fmt = 'jsonl' if 'json' in (request.mimetype or '') else 'csv'
+    lines = TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    stats = ingest(lines, fmt, current_app.config.get('INGEST_CHUNK_SIZE', 5000))
+    print('[INGEST] {0}: {1}'.format(g.employee['username'], stats))
+    return jsonify(stats)
+
+
+@bp.route('/api/admin/exports/payments', methods=['GET'])
+@require_employee('Admin')
+def export_payments() -> 'gzip':
+    """Download payments after a trans_id as gzip compressed CSV or NDJSON.
+
+    The query string gives the 'format' ('csv' by default) and 'after'
+    (0 by default). The 'X-Export-Watermark' header of the response is
+    the 'after' of the next incremental export.
+    """
+    fmt = request.args.get('format', 'csv')
+    after = request.args.get('after', '0')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify(error='Format must be one of: {}'.format(', '.join(EXPORT_FORMATS))), 400
+    if not after.isdigit():
+        return jsonify(error='After must be a trans_id.'), 400
+
+    after = int(after)
+    until = max(after, crud.get_export_bound(current_app.config.get('EXPORT_SETTLE_SECONDS', 60)))
+    print('[EXPORT] {0}: payments {1} to {2} as {3}'.format(g.employee['username'],
+                                                            after + 1, until, fmt))
+    name = 'payments-{0}-{1}.{2}.gz'.format(after + 1, until, fmt)
+    # Small buffered chunks: a slow download must not keep a pooled
+    # connection (and an open transaction) checked out between reads.
+    return current_app.response_class(
+        export_stream(fmt, after, until, current_app.config.get('EXPORT_HTTP_CHUNK_SIZE', 1000),
+                      buffered=True),
+        mimetype='application/gzip',
+        headers={'Content-Disposition': 'attachment; filename="{}"'.format(name),
+                 'X-Export-Watermark': str(until)})
+
+
+@bp.route('/metrics', methods=['GET'])
+@require_employee('Admin')
+def show_metrics() -> 'text':
+    """Export metrics of all workers in Prometheus text format.
+
+    Scrapers authenticate as an Admin employee (HTTP basic auth).
+    """
+    return (metrics.registry.render(), 200,
+            {'Content-Type': 'text/plain; version=0.0.4'})
+
+
+@bp.route('/logout', methods=["GET"])
 def logout() -> 'html | Redirect':
     """Logout if logged in then redirect to homepage."""
     if 'logged_in' in session:
         session.pop('logged_in')
-    return redirect(url_for('home'))
+    return redirect(url_for('main.home'))
 
 
-@app.errorhandler(ValidationError)
+@bp.app_errorhandler(ValidationError)
 def invalid_form(err_msg) -> 'Redirect':
     """Clear an invalidly filled form and flash the validation issue.
 
@@ -325,11 +783,43 @@ def invalid_form(err_msg) -> 'Redirect':
     flash message.
     """
     print(str(err_msg))
-    flash(str(err_msg))
+    # Forms checked as a whole report every problem found.
+    for message in getattr(err_msg, 'errors', None) or [str(err_msg)]:
+        flash(message)
     return redirect(request.url)
 
 
-@app.errorhandler(404)
+@bp.app_errorhandler(HashingBusy)
+def hashing_busy(e) -> tuple[str, Literal[503], dict]:
+    """Turn away logins and signups while password hashing is saturated."""
+    print(str(e))
+    return ('Server is busy, please try again shortly.', 503,
+            {'Retry-After': '1'})
+
+
+@bp.app_errorhandler(RateLimited)
+def rate_limited(e) -> tuple[str, Literal[429], dict]:
+    """Answer throttled requests without rendering a page."""
+    print(str(e))
+    return ('Too many attempts, please try again later.', 429,
+            {'Retry-After': str(max(1, round(e.retry_after)))})
+
+
+@bp.app_errorhandler(PaymentRejected)
+def payment_rejected(e) -> tuple['json', Literal[422]]:
+    """Tell the client why a payment was not recorded."""
+    print(str(e))
+    return jsonify(error=str(e)), 422
+
+
+@bp.app_errorhandler(CommitterBusy)
+def committer_busy(e) -> tuple['json', Literal[503], dict]:
+    """Shed payments while the committer is saturated; retries are safe."""
+    print(str(e))
+    return jsonify(error=str(e)), 503, {'Retry-After': '1'}
+
+
+@bp.app_errorhandler(404)
 def page_not_found(e) -> tuple[str, Literal[404]]:
     """Render custom 404 template."""
     print(e)
@@ -337,4 +827,4 @@ def page_not_found(e) -> tuple[str, Literal[404]]:
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', debug=True)
+    create_app().run(host='0.0.0.0', debug=True)
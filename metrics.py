@@ -0,0 +1,236 @@
+"""Hot-path instrumentation exported in Prometheus text format.
+
+Sampled requests record their wall time per route, split into time
+spent in the database, bcrypt, Jinja rendering and SMTP delivery. Each
+worker keeps its histograms in process memory and periodically
+publishes a snapshot to a store shared by all uWSGI workers; /metrics
+merges the snapshots.
+"""
+import json
+import os
+import time
+from bisect import bisect_left
+from random import random
+from threading import Lock
+
+from flask import g, has_request_context, request
+from jinja2 import Template
+
+# Upper bounds (seconds) of histogram buckets; +Inf is implied.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+# Phases of a request measured separately from its total time.
+PHASES = ('db', 'bcrypt', 'render', 'smtp')
+
+
+class Histogram():
+    """Cumulative-on-export histogram of observed durations."""
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """Record one observation."""
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+
+class Registry():
+    """Histograms and counter collectors of one worker process.
+
+    Attributes:
+        - sample_rate: fraction of requests that are measured
+        - store: kvstore store shared by workers (None keeps metrics
+                 local to the process)
+        - flush_interval: seconds between snapshot publications
+    """
+
+    def __init__(self, sample_rate: float=1.0, store: object=None,
+                 flush_interval: float=5.0) -> None:
+        self.sample_rate = sample_rate
+        self.store = store
+        self.flush_interval = flush_interval
+        self.collectors = {}
+        self._lock = Lock()
+        self._reset_state()
+
+    def _reset_state(self) -> None:
+        """Start empty (used at creation and after a fork)."""
+        self._pid = os.getpid()
+        # (metric name, labels tuple) -> Histogram
+        self.histograms = {}
+        self._flushed_at = 0.0
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Record a duration in the histogram 'name' with given labels."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset_state()
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(value)
+
+    def register_collector(self, name: str, collect: object) -> None:
+        """Export numbers returned by 'collect()' (a dict) on scrape."""
+        self.collectors[name] = collect
+
+    def snapshot(self) -> dict:
+        """Return this worker's metrics as JSON-serializable data."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset_state()
+            histograms = [[name, list(labels), hist.counts[:], hist.sum]
+                          for (name, labels), hist in self.histograms.items()]
+        counters = {}
+        for name, collect in self.collectors.items():
+            for key, value in (collect() or {}).items():
+                counters['{0}_{1}'.format(name, key)] = value
+        return {'histograms': histograms, 'counters': counters}
+
+    def maybe_flush(self) -> None:
+        """Publish a snapshot if the flush interval has passed."""
+        if self.store is None:
+            return
+        now = time.monotonic()
+        if now - self._flushed_at < self.flush_interval:
+            return
+        self._flushed_at = now
+
+        pid = str(os.getpid())
+        self.store.set('metrics:' + pid, json.dumps(self.snapshot()).encode(),
+                       self.flush_interval * 12)
+        with self.store.lock():
+            pids = set(json.loads(self.store.get('metrics:pids') or b'[]'))
+            if pid not in pids:
+                pids.add(pid)
+                self.store.set('metrics:pids', json.dumps(sorted(pids)).encode())
+
+    def snapshots(self) -> list[dict]:
+        """Return snapshots of all workers (only this one without store)."""
+        if self.store is None:
+            return [self.snapshot()]
+
+        # Publish fresh numbers of the scraped worker first.
+        self._flushed_at = 0.0
+        self.maybe_flush()
+        pids = json.loads(self.store.get('metrics:pids') or b'[]')
+        snapshots = []
+        expired = set()
+        for pid in pids:
+            data = self.store.get('metrics:' + pid)
+            if data is not None:
+                snapshots.append(json.loads(data))
+            else:
+                expired.add(pid)
+
+        if expired:
+            # Respawned workers would otherwise grow the list until it no
+            # longer fits a cache block.
+            with self.store.lock():
+                pids = set(json.loads(self.store.get('metrics:pids') or b'[]'))
+                # A worker may have published again since it was read.
+                pids -= {pid for pid in expired if self.store.get('metrics:' + pid) is None}
+                self.store.set('metrics:pids', json.dumps(sorted(pids)).encode())
+        return snapshots
+
+    def render(self) -> str:
+        """Merge worker snapshots into Prometheus text exposition."""
+        histograms = {}
+        counters = {}
+        for snapshot in self.snapshots():
+            for name, labels, counts, total in snapshot['histograms']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                merged = histograms.setdefault(key, [[0] * len(counts), 0.0])
+                merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                merged[1] += total
+            for name, value in snapshot['counters'].items():
+                if name.endswith('_max'):
+                    counters[name] = max(counters.get(name, 0), value)
+                else:
+                    counters[name] = counters.get(name, 0) + value
+
+        lines = []
+        typed = set()
+        for (name, labels), (counts, total) in sorted(histograms.items()):
+            metric = 'power_corp_' + name
+            if metric not in typed:
+                lines.append('# TYPE {} histogram'.format(metric))
+                typed.add(metric)
+            label_str = ','.join('{0}="{1}"'.format(k, v) for k, v in labels)
+            prefix = label_str + ',' if label_str else ''
+            suffix = '{' + label_str + '}' if label_str else ''
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{0}_bucket{{{1}le="{2}"}} {3}'.format(metric, prefix, bound,
+                                                                    cumulative))
+            lines.append('{0}_sum{1} {2}'.format(metric, suffix, total))
+            lines.append('{0}_count{1} {2}'.format(metric, suffix, cumulative))
+
+        for name, value in sorted(counters.items()):
+            lines.append('# TYPE power_corp_{} gauge'.format(name))
+            lines.append('power_corp_{0} {1}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+
+# Replaced by init_app() with one configured from the app.
+registry = Registry()
+
+
+def add_time(phase: str, seconds: float) -> None:
+    """Add time spent in a phase to the current request, if sampled."""
+    if has_request_context():
+        timings = g.get('_metrics')
+        if timings is not None:
+            timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+class TimedTemplate(Template):
+    """Jinja template that adds its render time to the request."""
+
+    def render(self, *args, **kwargs) -> str:
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            add_time('render', time.perf_counter() - started)
+
+
+def _start_request() -> None:
+    """Decide whether to measure this request and start its clock."""
+    if registry.sample_rate and random() < registry.sample_rate:
+        g._metrics = {'start': time.perf_counter()}
+
+
+def _finish_request(response: 'Response') -> 'Response':
+    """Record the request's total and per-phase times."""
+    timings = g.pop('_metrics', None)
+    if timings is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        total = time.perf_counter() - timings['start']
+        registry.observe('request_seconds', total, route=route,
+                         method=request.method)
+        # Only phases the request went through are recorded.
+        for phase in PHASES:
+            if phase in timings:
+                registry.observe('request_phase_seconds', timings[phase],
+                                 route=route, phase=phase)
+    registry.maybe_flush()
+    return response
+
+
+def init_app(app: 'Flask', store: object=None) -> None:
+    """Instrument an app's request lifecycle and templates.
+
+    Must be called before the first template is loaded.
+    """
+    global registry
+    registry = Registry(app.config.get('METRICS_SAMPLE_RATE', 1.0), store,
+                        app.config.get('METRICS_FLUSH_INTERVAL', 5.0))
+    app.jinja_env.template_class = TimedTemplate
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
@@ -0,0 +1,223 @@
+"""Recording of payments with idempotency keys and group commit.
+
+Clients submit a payment with a key of their choosing (a UUID, say) in
+the 'Idempotency-Key' header. The key is stored with the payment, with
+a unique index on (idem_key, uid). A retried submission gets back the
+payment recorded the first time rather than being charged twice.
+
+On due dates many customers pay within minutes, and a transaction per
+payment would spend most of its time waiting for its own commit.
+Request threads therefore hand payments to a committer thread. It
+stores whatever has arrived within 'max_delay' seconds (up to
+'batch_size' payments) in one transaction and then wakes the waiting
+requests. A payment waits at most 'max_delay' plus one transaction. A
+full queue turns submissions away at once rather than letting latency
+grow.
+"""
+import os
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from decimal import Decimal
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+
+import metrics
+from paymentsearch import PAYMENT_MODES, parse_amount
+
+# Length of payment_history.idem_key and note.
+MAX_KEY_LENGTH = 64
+MAX_NOTE_LENGTH = 64
+
+
+class PaymentRejected(Exception):
+    """Raised for a payment that cannot be recorded, with the reason."""
+    pass
+
+
+class CommitterBusy(Exception):
+    """Raised when payments arrive faster than they can be committed."""
+    pass
+
+
+def clean_payment(data: dict, idem_key: str) -> tuple:
+    """Check a submitted payment against payment_history's constraints.
+
+    Parameters:
+        - data: submitted fields 'amount', 'mode' and optional 'note'
+        - idem_key: the submission's idempotency key
+
+    Return (idem_key, amount, mode, note). Raises PaymentRejected.
+    """
+    if not idem_key or len(idem_key) > MAX_KEY_LENGTH or not idem_key.isprintable():
+        raise PaymentRejected('An Idempotency-Key header of at most {} printable '
+                              'characters is required.'.format(MAX_KEY_LENGTH))
+    try:
+        amount = parse_amount(str(data.get('amount', '')))
+    except ValueError as e:
+        raise PaymentRejected(str(e))
+    if amount <= 0:
+        raise PaymentRejected('Amount must be above zero.')
+    # Same values as the CHECK constraint on payment_history.mode.
+    if data.get('mode') not in PAYMENT_MODES:
+        raise PaymentRejected('Mode must be one of: {}'.format(', '.join(PAYMENT_MODES)))
+    note = data.get('note')
+    if note is not None and (not isinstance(note, str) or len(note) > MAX_NOTE_LENGTH):
+        raise PaymentRejected('Note must be text of at most {} characters.'.format(
+            MAX_NOTE_LENGTH))
+    return idem_key, amount, data['mode'], note
+
+
+class GroupCommitter():
+    """Store payments submitted by request threads in shared transactions.
+
+    Attributes:
+        - batch_size: maximum number of payments per transaction
+        - max_delay: seconds the first payment of a batch waits for others
+        - maxsize: maximum number of payments waiting for a batch
+        - counters: payments, batches, replays, rejections and turned
+                    away submissions
+
+    The committer thread is started on first use in each process, after
+    uWSGI has forked its workers.
+    """
+
+    def __init__(self, batch_size: int=200, max_delay: float=0.005,
+                 maxsize: int=5000) -> None:
+        """Initialize settings. No thread is started here."""
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.maxsize = maxsize
+        self._lock = Lock()
+        self._reset_state()
+
+    def _reset_state(self) -> None:
+        """Forget thread and queue (used at creation and after a fork)."""
+        self._pid = os.getpid()
+        self._queue = Queue(self.maxsize)
+        self._thread = None
+        self.counters = {'payments': 0, 'batches': 0, 'replayed': 0,
+                         'rejected': 0, 'busy': 0, 'errors': 0,
+                         'commit_seconds': 0.0, 'commit_seconds_max': 0.0}
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset_state()
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='payment-committer',
+                                      daemon=True)
+                self._thread.start()
+
+    def submit(self, uid: int, payment: tuple) -> Future:
+        """Queue a cleaned payment of a user for the next batch.
+
+        Return a future of (payment record, created). Raises
+        CommitterBusy if the queue is full.
+        """
+        self._start()
+        future = Future()
+        try:
+            self._queue.put_nowait(((uid,) + payment, future, time.monotonic()))
+        except Full:
+            with self._lock:
+                self.counters['busy'] += 1
+            raise CommitterBusy('Too many payments waiting to be recorded.')
+        return future
+
+    def record(self, uid: int, payment: tuple, timeout: float=2.0) -> tuple[dict, bool]:
+        """Submit a payment and wait for its batch to commit.
+
+        Return the stored payment and whether it was created now (False
+        for a retry of an earlier submission).
+        """
+        future = self.submit(uid, payment)
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            # It may still be committed; a retry with the key finds it.
+            raise CommitterBusy('Payment not recorded within {}s.'.format(timeout))
+
+    def _collect(self) -> list:
+        """Wait for a payment, then take all arriving within max_delay."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0
+                             else self._queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        """Committer thread: store batches until the process exits."""
+        # Imported here so payments can be checked without a database.
+        import crud
+
+        while True:
+            batch = self._collect()
+            # A retry may arrive in the same batch as the first attempt;
+            # only the first submission of a key is stored, the others
+            # are answered against it.
+            firsts = {}
+            for payment, _, _ in batch:
+                firsts.setdefault(payment[:2], payment)
+            started = time.monotonic()
+            try:
+                stored = crud.record_payments(list(firsts.values()))
+            except Exception as e:
+                print('[PAYMENTS] Batch of {0} failed: {1}'.format(len(batch), e))
+                with self._lock:
+                    self.counters['errors'] += len(batch)
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            now = time.monotonic()
+            with self._lock:
+                c = self.counters
+                c['batches'] += 1
+                c['commit_seconds'] += now - started
+                c['commit_seconds_max'] = max(c['commit_seconds_max'], now - started)
+            metrics.registry.observe('payment_batch_seconds', now - started)
+
+            for payment, future, submitted_at in batch:
+                # Latency seen by the request: queueing plus commit.
+                metrics.registry.observe('payment_commit_seconds', now - submitted_at)
+                try:
+                    future.set_result(self._outcome(payment, stored,
+                                                    firsts[payment[:2]] is payment))
+                except PaymentRejected as e:
+                    future.set_exception(e)
+
+    def _outcome(self, payment: tuple, stored: dict,
+                 first: bool=True) -> tuple[dict, bool]:
+        """Match a submitted payment with the row stored under its key.
+
+        'first' is False for a later submission of a key in the same
+        batch, which can only be a replay. Raises PaymentRejected if no
+        row was stored, or if the key was first used for another payment.
+        """
+        uid, idem_key, amount, mode, note = payment
+        row, created = stored.get((uid, idem_key), (None, False))
+        created = created and first
+        if row is None:
+            # Skipped by the insert, e.g. for an unknown user.
+            with self._lock:
+                self.counters['rejected'] += 1
+            raise PaymentRejected('Payment could not be recorded.')
+        if not created and (Decimal(row['amount']) != amount or row['mode'] != mode):
+            with self._lock:
+                self.counters['rejected'] += 1
+            raise PaymentRejected('Idempotency key was used for a different payment.')
+        with self._lock:
+            self.counters['payments' if created else 'replayed'] += 1
+        return row, created
+
+    def stats(self) -> dict:
+        """Return counters and the number of waiting payments."""
+        with self._lock:
+            stats = dict(self.counters)
+        stats['depth'] = self._queue.qsize()
+        return stats
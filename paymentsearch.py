@@ -0,0 +1,184 @@
+"""Search of payment_history by date, mode, amount and note text.
+
+Query string filters of the search API are checked here and turned into
+a crud.PaymentSearch, whose rows are streamed as compact JSON:
+
+    {"columns":["trans_id","amount","tstamp","mode","note"],
+     "rows":[[52,"100.00","2023-01-05T10:12:00","Debit Card",null],...],
+     "next":"<cursor of the following results, or null>"}
+
+Every search is meant to be an index range scan. The plan of each
+combination of filters can be checked against the live schema with:
+
+    flask --app main check-search-plans --uid 1
+
+which exits with status 1 if any plan reads a whole table or index.
+"""
+import json
+import re
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from itertools import combinations
+
+import click
+from flask.cli import with_appcontext
+
+# Allowed by the CHECK constraint on payment_history.mode.
+PAYMENT_MODES = ('Credit Card', 'Debit Card')
+
+# Largest value of payment_history.amount, a decimal(13,2).
+MAX_AMOUNT = Decimal('99999999999.99')
+
+# Words of a note query; the full-text index ignores shorter ones.
+WORD_RE = re.compile(r'\w{3,}')
+MAX_WORDS = 8
+
+# Rows serialized together before being written out.
+CHUNK_ROWS = 64
+
+
+def parse_date(value: str) -> datetime:
+    """Parse a 'YYYY-MM-DD' filter; raises ValueError if malformed."""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError('Dates must be given as YYYY-MM-DD: {}'.format(value[:16]))
+
+
+def parse_amount(value: str) -> Decimal:
+    """Parse an amount filter with at most 2 decimals."""
+    try:
+        amount = Decimal(value)
+    except InvalidOperation:
+        raise ValueError('Not an amount: {}'.format(value[:16]))
+    if not amount.is_finite() or not 0 <= amount <= MAX_AMOUNT \
+            or amount.as_tuple().exponent < -2:
+        raise ValueError('Not an amount: {}'.format(value[:16]))
+    return amount
+
+
+def fulltext_query(text: str) -> str:
+    """Turn free text into a boolean mode query matching all its words.
+
+    Only word characters are kept, so user input cannot inject
+    operators. Each word also matches longer words it starts.
+    """
+    words = WORD_RE.findall(text)[:MAX_WORDS]
+    if not words:
+        raise ValueError('Note text needs a word of 3 or more letters.')
+    return ' '.join('+{}*'.format(word) for word in words)
+
+
+def parse_filters(args: 'MultiDict') -> dict:
+    """Read search filters from a query string.
+
+    Recognized arguments: 'from' and 'to' (dates, both included),
+    'mode', 'min' and 'max' (amounts) and 'text'. Raises ValueError
+    with a message for the client if a value is invalid.
+    """
+    filters = {}
+    if args.get('from'):
+        filters['date_from'] = parse_date(args['from'])
+    if args.get('to'):
+        # Up to the end of that day.
+        filters['date_to'] = parse_date(args['to']) + timedelta(days=1)
+    if args.get('mode'):
+        if args['mode'] not in PAYMENT_MODES:
+            raise ValueError('Mode must be one of: {}'.format(', '.join(PAYMENT_MODES)))
+        filters['mode'] = args['mode']
+    if args.get('min'):
+        filters['min_amount'] = parse_amount(args['min'])
+    if args.get('max'):
+        filters['max_amount'] = parse_amount(args['max'])
+    if args.get('text'):
+        filters['text'] = fulltext_query(args['text'][:64])
+
+    if filters.get('date_from') and filters.get('date_to') \
+            and filters['date_from'] >= filters['date_to']:
+        raise ValueError("'from' is after 'to'.")
+    if filters.get('min_amount') is not None and filters.get('max_amount') is not None \
+            and filters['min_amount'] > filters['max_amount']:
+        raise ValueError("'min' is above 'max'.")
+    return filters
+
+
+def encode_row(row: tuple) -> list:
+    """Make a (trans_id, amount, tstamp, mode, note) row JSON ready.
+
+    Amounts are sent as strings so that no cents are lost to floats.
+    """
+    trans_id, amount, tstamp, mode, note = row
+    return [trans_id, str(amount), tstamp.isoformat(), mode, note]
+
+
+def stream_json(search: 'crud.PaymentSearch') -> 'Generator[str]':
+    """Yield the JSON document of a search's results in pieces.
+
+    Rows are written as they are fetched; the 'next' cursor, only known
+    once they all are, comes last.
+    """
+    dumps = json.JSONEncoder(separators=(',', ':')).encode
+    yield '{{"columns":{},"rows":['.format(dumps(list(search.COLUMNS)))
+
+    chunk, first = [], True
+    for row in search:
+        chunk.append(dumps(encode_row(row)))
+        if len(chunk) == CHUNK_ROWS:
+            yield ('' if first else ',') + ','.join(chunk)
+            chunk, first = [], False
+    if chunk:
+        yield ('' if first else ',') + ','.join(chunk)
+
+    yield '],"next":{}}}'.format(dumps(search.next_cursor))
+
+
+# A value for each filter, to explain queries with.
+SAMPLE_FILTERS = {'date_from': datetime(2000, 1, 1),
+                  'date_to': datetime(2100, 1, 1),
+                  'mode': PAYMENT_MODES[0],
+                  'min_amount': Decimal('0.00'),
+                  'max_amount': MAX_AMOUNT,
+                  'text': '+bill*'}
+
+
+def check_search_plans(uid: int, echo: object=print) -> list[tuple]:
+    """Explain the search for every combination of filters.
+
+    Return (filter names, offending plan steps) of each search whose
+    plan scans a whole table or index.
+    """
+    import crud
+
+    failures = []
+    names = list(SAMPLE_FILTERS)
+    for n in range(len(names) + 1):
+        for combination in combinations(names, n):
+            filters = {name: SAMPLE_FILTERS[name] for name in combination}
+            # Paging adds a keyset condition; check both forms.
+            for after in (None, crud.encode_page_cursor(datetime(2050, 1, 1), 1)):
+                search = crud.PaymentSearch(uid, 50, after=after, **filters)
+                plan = search.explain()
+                scans = crud.find_table_scans(plan)
+                label = '+'.join(combination) or 'no filter'
+                if after:
+                    label += ' (paged)'
+                echo('{0:<8}{1:<60}{2}'.format('SCAN' if scans else 'ok', label,
+                                               ', '.join('{0}:{1}'.format(step.get('type'),
+                                                                          step.get('key'))
+                                                         for step in plan)))
+                if scans:
+                    failures.append((label, scans))
+    return failures
+
+
+@click.command('check-search-plans')
+@click.option('--uid', type=int, required=True,
+              help='User whose payments are searched (plans depend on data).')
+@with_appcontext
+def check_search_plans_command(uid: int) -> None:
+    """Fail if any payment search plan reads a whole table or index."""
+    failures = check_search_plans(uid, echo=click.echo)
+    if failures:
+        click.echo('{} search plan(s) scan a whole table or index.'.format(len(failures)))
+        raise SystemExit(1)
+    click.echo('All search plans use index ranges.')
@@ -0,0 +1,112 @@
+"""Token-bucket rate limiting with buckets kept in a kvstore store.
+
+With the uWSGI cache store, all worker processes draw from the same
+buckets; the memory and SQLite stores stand in for it outside uWSGI.
+"""
+import time
+from threading import Lock
+
+
+class RateLimited(Exception):
+    """Raised when a request exceeds a rate limit.
+
+    Attributes:
+        - retry_after: seconds until the request would be allowed
+        - limit: name of the exceeded limit
+    """
+
+    def __init__(self, retry_after: float, limit: str) -> None:
+        super().__init__('Rate limit {0} exceeded, retry after {1:.1f}s.'.format(
+            limit, retry_after))
+        self.retry_after = retry_after
+        self.limit = limit
+
+
+class TokenBucket():
+    """Bucket of 'burst' tokens refilled at 'rate' tokens per second.
+
+    Attributes:
+        - name: name of the limit (part of the store keys)
+        - rate: tokens added per second
+        - burst: maximum number of tokens (and of back-to-back requests)
+
+    Each key (an IP address, a username...) has its own bucket, stored
+    as 'tokens:updated_at'. A bucket unused long enough to be full
+    again expires from the store.
+    """
+
+    def __init__(self, store: object, name: str, rate: float, burst: int) -> None:
+        self.store = store
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+
+    def take(self, key: str, cost: float=1.0) -> float:
+        """Take tokens for a request; return 0 or seconds to wait."""
+        store_key = 'rate:{0}:{1}'.format(self.name, key)
+        # Wall clock time, as buckets are shared between processes.
+        now = time.time()
+        with self.store.lock():
+            data = self.store.get(store_key)
+            tokens = self.burst
+            if data is not None:
+                level, updated_at = map(float, data.split(b':'))
+                tokens = min(self.burst, level + (now - updated_at) * self.rate)
+
+            if tokens < cost:
+                return (cost - tokens) / self.rate
+
+            tokens -= cost
+            self.store.set(store_key, '{0:.3f}:{1:.3f}'.format(tokens, now).encode(),
+                           (self.burst - tokens) / self.rate + 1)
+        return 0.0
+
+
+class LoginThrottle():
+    """Limit login attempts per client IP address and per username.
+
+    Attributes:
+        - by_ip: bucket of each client address
+        - by_user: bucket of each attempted username (whether or not
+                   the account exists)
+        - counters: allowed and shed attempts, store errors
+
+    Checks only touch the store, so shedding costs neither a database
+    query nor a bcrypt check. If the store fails, attempts are allowed.
+    """
+
+    def __init__(self, store: object, ip_rate: float=0.5, ip_burst: int=10,
+                 user_rate: float=0.1, user_burst: int=5) -> None:
+        self.by_ip = TokenBucket(store, 'login_ip', ip_rate, ip_burst)
+        self.by_user = TokenBucket(store, 'login_user', user_rate, user_burst)
+        self.counters = {'allowed': 0, 'shed_ip': 0, 'shed_user': 0, 'errors': 0}
+        self._lock = Lock()
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    def check(self, ip: str, username: str) -> None:
+        """Raise RateLimited if the attempt must be turned away."""
+        try:
+            wait = self.by_ip.take(ip)
+            if wait:
+                self._count('shed_ip')
+                raise RateLimited(wait, 'login_ip')
+            # Usernames are compared case-insensitively by the database.
+            wait = self.by_user.take(username.lower())
+            if wait:
+                self._count('shed_user')
+                raise RateLimited(wait, 'login_user')
+        except RateLimited:
+            raise
+        except Exception as e:
+            self._count('errors')
+            print('[RATELIMIT] Store error, allowing attempt: ', str(e))
+            return
+        self._count('allowed')
+
+    def stats(self) -> dict:
+        """Return counters of this process."""
+        with self._lock:
+            return dict(self.counters)
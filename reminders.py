@@ -0,0 +1,318 @@
+"""Due-date reminder campaigns over the 'consumption' table.
+
+Meters due within a date range are read in chunks (keyset on meter_id),
+and every owner with an email address gets a reminder rendered from
+'reminder.html'. The template is compiled once per campaign and only
+rendered per recipient; headers are prepared once and the message is
+assembled as bytes without building MIME objects.
+
+Messages go out over several SMTP connections at once, each sending
+MAIL, RCPT and DATA in one round-trip when the server supports
+PIPELINING. A token bucket caps the overall send rate. Progress is
+saved after every chunk, so an interrupted campaign can be resumed.
+Run with:
+
+    flask --app main send-reminders [--days 3] [--rate 50] [--checkpoint FILE]
+"""
+import json
+import os
+import time
+from base64 import encodebytes
+from datetime import date, timedelta
+from email.utils import formatdate, make_msgid
+from queue import Queue
+from smtplib import SMTPException
+from threading import Lock, Thread
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from kvstore import LRUStore
+from ratelimit import TokenBucket
+
+REMINDER_SUBJECT = 'PowerCorp bill due on {0}'
+
+
+class ReminderComposer():
+    """Build reminder messages from a compiled template.
+
+    Attributes:
+        - template: compiled Jinja template of the HTML body
+        - sender: address used in the From header
+        - domain: domain part of generated Message-IDs
+    """
+
+    def __init__(self, template: 'jinja2.Template', sender: str,
+                 domain: str=None) -> None:
+        self.template = template
+        self.sender = sender
+        # make_msgid() looks the host name up on every call without it.
+        self.domain = domain or sender.rpartition('@')[2] or 'localhost'
+        self._headers = ('From: {0}\r\n'
+                         'To: {{0}}\r\n'
+                         'Subject: {{1}}\r\n'
+                         'Date: {{2}}\r\n'
+                         'Message-ID: {{3}}\r\n'
+                         'MIME-Version: 1.0\r\n'
+                         'Content-Type: text/html; charset="utf-8"\r\n'
+                         'Content-Transfer-Encoding: base64\r\n'
+                         '\r\n').format(self.sender)
+
+    def compose(self, row: tuple) -> bytes:
+        """Return the message for a row of crud.get_due_reminders()."""
+        meter_id, first_name, email, due_date, last_reading, curr_reading = row
+        html = self.template.render(user=first_name, meter_id=meter_id,
+                                    due_date=due_date, last_reading=last_reading,
+                                    curr_reading=curr_reading,
+                                    units=curr_reading - last_reading)
+        headers = self._headers.format(email, REMINDER_SUBJECT.format(due_date),
+                                       formatdate(localtime=True),
+                                       make_msgid(domain=self.domain))
+        # Base64 keeps lines short and ASCII whatever the names hold.
+        body = encodebytes(html.encode('utf-8')).replace(b'\n', b'\r\n')
+        return headers.encode('utf-8') + body
+
+
+class Checkpoint():
+    """Progress of a campaign, saved after every chunk.
+
+    Attributes:
+        - path: JSON file the progress is kept in
+        - campaign: due date range the progress belongs to
+        - after: meter_id of the last meter of the last finished chunk
+        - sent: number of reminders accepted by the server
+        - failed: number of reminders that could not be sent
+    """
+
+    def __init__(self, path: str, campaign: str) -> None:
+        """Load saved progress for 'campaign', or start from scratch."""
+        self.path = path
+        self.campaign = campaign
+        self.after = self.sent = self.failed = 0
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved.get('campaign') == self.campaign:
+                self.after = saved['after']
+                self.sent = saved['sent']
+                self.failed = saved['failed']
+
+    def save(self) -> None:
+        """Atomically write progress to disk."""
+        if not self.path:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'campaign': self.campaign, 'after': self.after,
+                       'sent': self.sent, 'failed': self.failed}, f)
+        os.replace(tmp, self.path)
+
+
+def due_chunks(due_from: date, due_to: date, after: int,
+               chunk_size: int) -> 'Generator[list]':
+    """Yield chunks of meters due in a date range, after a meter_id."""
+    # Imported here so campaigns can be run against other sources.
+    import crud
+
+    while True:
+        rows = crud.get_due_reminders(due_from, due_to, after, chunk_size)
+        if not rows:
+            return
+        after = rows[-1][0]
+        yield rows
+
+
+class ReminderSender():
+    """Threads sending composed reminders, each over its own connection.
+
+    Attributes:
+        - session_factory: callable returning a new SMTPSession
+        - nsessions: number of sending threads and connections
+        - rate: maximum messages per second over all connections (0 for
+                no limit)
+        - failures: (row, error) of reminders not sent since last taken
+
+    Reminders are queued with send() and wait() blocks until all queued
+    ones are handled.
+    """
+
+    def __init__(self, composer: ReminderComposer, session_factory: object,
+                 nsessions: int=4, rate: float=0, dry_run: bool=False) -> None:
+        self.composer = composer
+        self.session_factory = session_factory
+        self.nsessions = nsessions
+        self.rate = rate
+        self.dry_run = dry_run
+        self.failures = []
+        self.sent = 0
+        self._bucket = TokenBucket(LRUStore(16), 'reminders', rate,
+                                   max(1, nsessions)) if rate else None
+        self._queue = Queue(4 * nsessions)
+        self._lock = Lock()
+        self._threads = [Thread(target=self._run, name='reminder-sender-{}'.format(i),
+                                daemon=True) for i in range(nsessions)]
+        for thread in self._threads:
+            thread.start()
+
+    def send(self, row: tuple) -> None:
+        """Queue a reminder, blocking while the senders are busy."""
+        self._queue.put(row)
+
+    def wait(self) -> None:
+        """Block until every queued reminder has been sent or failed."""
+        self._queue.join()
+
+    def take_failures(self) -> list:
+        """Return and forget the failures recorded so far."""
+        with self._lock:
+            failures, self.failures = self.failures, []
+        return failures
+
+    def _throttle(self) -> None:
+        """Wait for a token of the shared rate limit."""
+        if self._bucket is None:
+            return
+        while True:
+            wait = self._bucket.take('all')
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def _run(self) -> None:
+        """Sender thread: send queued reminders until told to stop.
+
+        Any error is recorded against its row, so a bad row or an
+        unreachable server never stops the thread (run_campaign() would
+        wait forever for the rows left in the queue).
+        """
+        session = None
+        sender = self.composer.sender
+        while True:
+            row = self._queue.get()
+            if row is None:
+                if session is not None:
+                    try:
+                        session.close()
+                    except Exception:
+                        pass
+                self._queue.task_done()
+                return
+            try:
+                message = self.composer.compose(row)
+                if not self.dry_run:
+                    if session is None:
+                        session = self.session_factory()
+                    self._throttle()
+                    session.send_pipelined(sender, row[2], message)
+                with self._lock:
+                    self.sent += 1
+            except Exception as e:
+                if session is not None and not isinstance(e, (SMTPException, OSError)):
+                    # Out of step with the server after an unexpected
+                    # error: drop the connection and open a new one.
+                    session.abort()
+                    session = None
+                with self._lock:
+                    self.failures.append((row, str(e) or repr(e)))
+            finally:
+                self._queue.task_done()
+
+    def close(self) -> None:
+        """Stop the threads after the queued reminders are handled."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+def run_campaign(chunks: 'Iterable[list]', sender: ReminderSender,
+                 progress: Checkpoint, failed_file: 'TextIO'=None,
+                 echo: object=print) -> Checkpoint:
+    """Send reminders for all meters of 'chunks' and record progress.
+
+    The checkpoint is saved once every reminder of a chunk was handled;
+    a campaign stopped in the middle of a chunk sends that chunk again
+    when resumed, so a few customers may get the reminder twice.
+    """
+    started = time.monotonic()
+    done = 0
+    try:
+        for rows in chunks:
+            for row in rows:
+                sender.send(row)
+            sender.wait()
+
+            failures = sender.take_failures()
+            progress.after = rows[-1][0]
+            progress.sent += len(rows) - len(failures)
+            progress.failed += len(failures)
+            progress.save()
+
+            if failed_file:
+                for row, error in failures:
+                    failed_file.write(json.dumps({'meter_id': row[0], 'email': row[2],
+                                                  'error': error}) + '\n')
+                failed_file.flush()
+
+            done += len(rows)
+            echo('{0} reminders sent, {1} failed ({2:.0f} messages/s)'.format(
+                progress.sent, progress.failed, done / (time.monotonic() - started)))
+    finally:
+        sender.close()
+    return progress
+
+
+@click.command('send-reminders')
+@click.option('--date', 'due_from', type=click.DateTime(['%Y-%m-%d']),
+              help='First due date reminded of (default: today).')
+@click.option('--days', default=3, show_default=True,
+              help='Remind of meters due within this many days of --date.')
+@click.option('--chunk-size', default=5000, show_default=True,
+              help='Meters read from the database at a time.')
+@click.option('--sessions', type=int,
+              help='Parallel SMTP connections (default: REMINDER_SESSIONS or 8).')
+@click.option('--rate', type=float,
+              help='Maximum messages per second (default: REMINDER_RATE, '
+                   'or no limit).')
+@click.option('--checkpoint', type=click.Path(dir_okay=False),
+              help='File to save progress in and resume from.')
+@click.option('--failed', type=click.Path(dir_okay=False),
+              help='JSON Lines file listing reminders that were not sent.')
+@click.option('--dry-run', is_flag=True, help='Render reminders without sending them.')
+@with_appcontext
+def send_reminders_command(due_from: 'datetime', days: int, chunk_size: int,
+                           sessions: int, rate: float, checkpoint: str, failed: str,
+                           dry_run: bool) -> None:
+    """Mail a reminder to every customer whose bill is due soon."""
+    # Imported here: main imports this module to register the command.
+    from main import create_smtp_session
+
+    config = current_app.config
+    due_from = due_from.date() if due_from else date.today()
+    due_to = due_from + timedelta(days=days)
+    # A dry run must not mark anyone as reminded.
+    progress = Checkpoint(None if dry_run else checkpoint,
+                          '{0}/{1}'.format(due_from, due_to))
+    if progress.after:
+        click.echo('Resuming after meter {0} ({1} reminders sent).'.format(
+            progress.after, progress.sent))
+
+    composer = ReminderComposer(current_app.jinja_env.get_template('reminder.html'),
+                                config['MAIL_ADDRESS'])
+    sender = ReminderSender(composer, lambda: create_smtp_session(config),
+                            nsessions=sessions or config.get('REMINDER_SESSIONS', 8),
+                            rate=rate if rate is not None else config.get('REMINDER_RATE', 0),
+                            dry_run=dry_run)
+    failed_file = open(failed, 'a', encoding='utf-8') if failed else None
+    try:
+        run_campaign(due_chunks(due_from, due_to, progress.after, chunk_size),
+                     sender, progress, failed_file, echo=click.echo)
+    finally:
+        if failed_file:
+            failed_file.close()
+
+    click.echo('{0}Campaign {1} finished: {2} sent, {3} failed.'.format(
+        '[DRY RUN] ' if dry_run else '', progress.campaign, progress.sent,
+        progress.failed))
@@ -0,0 +1,134 @@
+"""Cache of rendered pages and fragments that do not depend on the user.
+
+Anonymous pages (home, login, register) are rendered once per worker
+and sent with a strong ETag, so browsers revalidating them get a 304
+without any rendering. Fragments such as the user pages' header and
+sidebar are included through the 'cached_fragment()' template global:
+
+    {{ cached_fragment('user/header.html') }}
+
+Entries are keyed by template name and the inputs given to it. When
+Jinja auto-reloads templates (debug mode or TEMPLATES_AUTO_RELOAD), an
+entry is re-rendered as soon as its template, or any template it
+extends or includes, changes on disk.
+
+Nothing is served from the cache while flashed messages are pending,
+as base.html shows them.
+"""
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+
+from flask import make_response, render_template, request, session
+from jinja2 import meta
+from markupsafe import Markup
+
+
+class RenderCache():
+    """Bounded cache of rendered templates of one worker.
+
+    Attributes:
+        - maxsize: maximum number of entries kept
+        - counters: hits, misses, stale entries, 304 responses and
+                    renders bypassing the cache
+    """
+
+    def __init__(self, maxsize: int=256) -> None:
+        self.maxsize = maxsize
+        self.counters = {'hits': 0, 'misses': 0, 'stale': 0, 'not_modified': 0,
+                         'bypassed': 0}
+        # (name, inputs) -> (html, etag, templates it was rendered from)
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._env = None
+
+    def init_app(self, app: 'Flask') -> None:
+        """Make 'cached_fragment()' available in the app's templates."""
+        self._env = app.jinja_env
+        app.jinja_env.globals['cached_fragment'] = self.fragment
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    def _dependencies(self, name: str) -> list:
+        """Return the template and all it extends or includes."""
+        templates, pending = {}, [name]
+        while pending:
+            current = pending.pop()
+            if current in templates:
+                continue
+            template = templates[current] = self._env.get_template(current)
+            source = self._env.loader.get_source(self._env, current)[0]
+            for ref in meta.find_referenced_templates(self._env.parse(source)):
+                # Dynamic names (None) cannot be followed.
+                if ref is not None:
+                    pending.append(ref)
+        return list(templates.values())
+
+    def _is_fresh(self, templates: list) -> bool:
+        """Check if no template of an entry changed on disk."""
+        if not self._env.auto_reload:
+            return True
+        return all(template.is_up_to_date for template in templates)
+
+    def render(self, name: str, **inputs) -> tuple[str, str]:
+        """Render 'name' with 'inputs' (str values) or return it cached.
+
+        Return the HTML and its strong ETag.
+        """
+        key = (name, tuple(sorted(inputs.items())))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is not None:
+            if self._is_fresh(entry[2]):
+                self._count('hits')
+                return entry[0], entry[1]
+            self._count('stale')
+        else:
+            self._count('misses')
+
+        html = render_template(name, **inputs)
+        etag = sha256(html.encode('utf-8')).hexdigest()[:32]
+        templates = self._dependencies(name) if self._env.auto_reload else []
+        with self._lock:
+            self._entries[key] = (html, etag, templates)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return html, etag
+
+    def fragment(self, name: str, **inputs) -> Markup:
+        """Template global rendering an include through the cache."""
+        if '_flashes' in session:
+            self._count('bypassed')
+            return Markup(render_template(name, **inputs))
+        return Markup(self.render(name, **inputs)[0])
+
+    def page(self, name: str, **inputs) -> 'Response':
+        """Respond with a cached page, or 304 if the client has it."""
+        if '_flashes' in session:
+            self._count('bypassed')
+            return make_response(render_template(name, **inputs))
+
+        html, etag = self.render(name, **inputs)
+        if etag in request.if_none_match:
+            self._count('not_modified')
+        response = make_response(html)
+        response.set_etag(etag)
+        # Browsers revalidate on every visit and get a 304 if unchanged.
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    def clear(self) -> None:
+        """Drop all entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Return counters and the number of entries."""
+        with self._lock:
+            return dict(self.counters, entries=len(self._entries))
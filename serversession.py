@@ -0,0 +1,119 @@
+"""Flask session interface that keeps session data on the server.
+
+The session cookie only carries a random session id. Session data is
+serialized into a kvstore store, so requests don't carry (and the app
+doesn't sign) the whole session on every round-trip.
+"""
+import secrets
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from kvstore import Purger
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session dict that remembers its id and tracks modification."""
+
+    def __init__(self, initial: dict=None, sid: str=None,
+                 new: bool=False) -> None:
+        def on_update(self) -> None:
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        # Id replaced by regenerate(), removed from the store on save.
+        self.old_sid = None
+
+    def regenerate(self) -> None:
+        """Move the session's data to a fresh id (call on login).
+
+        An id planted or seen before login is no good to an attacker
+        afterwards.
+        """
+        if self.old_sid is None and not self.new:
+            self.old_sid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    """Store sessions in a kvstore store keyed by an opaque id.
+
+    Attributes:
+        - store: kvstore store holding serialized sessions
+        - purger: background thread removing expired sessions
+        - key_prefix: prefix of store keys, to share a store safely
+
+    Sessions expire from the store after the app's
+    PERMANENT_SESSION_LIFETIME, whether permanent or not.
+    """
+
+    serializer = TaggedJSONSerializer()
+    session_class = ServerSideSession
+
+    def __init__(self, store: object, purge_interval: float=60.0,
+                 key_prefix: str='session:') -> None:
+        """Initialize with a store; purging starts with first request."""
+        self.store = store
+        self.purger = Purger(store, purge_interval)
+        self.key_prefix = key_prefix
+
+    def _new_session(self) -> ServerSideSession:
+        """Create an empty session with a fresh unguessable id."""
+        return self.session_class(sid=secrets.token_urlsafe(32), new=True)
+
+    def open_session(self, app: 'Flask', request: 'Request') -> ServerSideSession:
+        """Load the session named by the request's cookie, if any."""
+        self.purger.ensure_running()
+
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if not sid:
+            return self._new_session()
+
+        data = self.store.get(self.key_prefix + sid)
+        if data is None:
+            # Unknown or expired id; never adopt a client chosen id.
+            return self._new_session()
+        try:
+            return self.session_class(self.serializer.loads(data), sid=sid)
+        except ValueError:
+            return self._new_session()
+
+    def save_session(self, app: 'Flask', session: ServerSideSession,
+                     response: 'Response') -> None:
+        """Write a modified session back and set the id cookie."""
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.old_sid is not None:
+            self.store.delete(self.key_prefix + session.old_sid)
+
+        # Drop sessions emptied during this request.
+        if not session:
+            if session.modified:
+                self.store.delete(self.key_prefix + session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not self.should_set_cookie(app, session):
+            return
+
+        ttl = app.permanent_session_lifetime.total_seconds()
+        self.store.set(self.key_prefix + session.sid,
+                       self.serializer.dumps(dict(session)).encode('utf-8'),
+                       ttl)
+
+        expires = self.get_expiration_time(app, session)
+        response.set_cookie(name, session.sid, expires=expires,
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
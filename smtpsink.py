@@ -0,0 +1,222 @@
+"""Local SMTP stand-in that accepts and keeps every message it receives.
+
+Point the app at it with SMTP_SERVER='localhost', SMTP_PORT=1025 and
+SMTP_SSL=False to exercise mail code without a real mail server:
+
+    python smtpsink.py --port 1025 --maildir /tmp/mails
+"""
+import argparse
+import os
+import socketserver
+import time
+from email import message_from_bytes
+from threading import Condition, Thread
+
+
+class SinkMessage():
+    """A message accepted by the sink.
+
+    Attributes:
+        - sender: envelope sender address
+        - receivers: envelope receiver addresses
+        - data: raw message data (headers and body)
+        - received: epoch time at which DATA was completed
+    """
+
+    def __init__(self, sender: str, receivers: list, data: bytes) -> None:
+        self.sender = sender
+        self.receivers = receivers
+        self.data = data
+        self.received = time.time()
+
+    def parsed(self) -> 'email.message.Message':
+        """Parse raw data into an email message object."""
+        return message_from_bytes(self.data)
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """Speak just enough SMTP for smtplib clients to deliver mail."""
+
+    # Replies are written line by line; without this, pipelined clients
+    # wait for delayed ACKs between them.
+    disable_nagle_algorithm = True
+
+    def reply(self, line: str) -> None:
+        """Send one reply line to the client."""
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def read_data(self) -> 'bytes | None':
+        """Read message data up to the terminating '.' line.
+
+        Returns None if the client disconnects before the end.
+        """
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return None
+            if line in (b'.\r\n', b'.\n'):
+                break
+            # Undo dot-stuffing (RFC 5321 section 4.5.2).
+            if line.startswith(b'.'):
+                line = line[1:]
+            lines.append(line)
+        return b''.join(lines)
+
+    def handle(self) -> None:
+        """Run an SMTP conversation until QUIT or disconnect."""
+        sink = self.server
+        sender, receivers = None, []
+        self.reply('220 smtpsink ready')
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command, _, arg = line.decode('utf-8', 'replace').strip().partition(' ')
+            command = command.upper()
+
+            if sink.delay:
+                time.sleep(sink.delay)
+
+            if command == 'EHLO':
+                self.reply('250-smtpsink')
+                self.reply('250-8BITMIME')
+                self.reply('250-PIPELINING')
+                self.reply('250 AUTH PLAIN LOGIN')
+            elif command == 'HELO':
+                self.reply('250 smtpsink')
+            elif command == 'AUTH':
+                # Any credentials are accepted.
+                mechanism, _, initial = arg.partition(' ')
+                if mechanism.upper() == 'LOGIN':
+                    prompts = 1 if initial else 2
+                    for prompt in ('VXNlcm5hbWU6', 'UGFzc3dvcmQ6')[-prompts:]:
+                        self.reply('334 ' + prompt)
+                        self.rfile.readline()
+                elif not initial:
+                    self.reply('334 ')
+                    self.rfile.readline()
+                self.reply('235 Authentication successful')
+            elif command == 'MAIL':
+                sender = arg.partition(':')[2].strip().strip('<>').split(' ')[0]
+                receivers = []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                receivers.append(arg.partition(':')[2].strip().strip('<>'))
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = self.read_data()
+                if data is None:
+                    return
+                sink.deliver(SinkMessage(sender, receivers, data))
+                sender, receivers = None, []
+                self.reply('250 OK: queued')
+            elif command == 'RSET':
+                sender, receivers = None, []
+                self.reply('250 OK')
+            elif command == 'NOOP':
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """Threaded SMTP server that stores received messages.
+
+    Attributes:
+        - messages: received SinkMessage objects (unless 'keep' is False)
+        - count: number of messages received so far
+        - delay: seconds to sleep before every reply (simulates a slow
+                 mail server)
+        - maildir: directory to write each message into (optional)
+        - on_message: callable invoked with each SinkMessage (optional)
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str='localhost', port: int=1025,
+                 delay: float=0.0, maildir: str=None, keep: bool=True,
+                 on_message: object=None) -> None:
+        """Bind the server. Call start() or serve_forever() to run it."""
+        super().__init__((host, port), SMTPSinkHandler)
+        self.delay = delay
+        self.maildir = maildir
+        self.keep = keep
+        self.on_message = on_message
+        self.messages = []
+        self.count = 0
+        self._cond = Condition()
+
+    @property
+    def port(self) -> int:
+        """Port the sink is listening on (useful when bound to port 0)."""
+        return self.server_address[1]
+
+    def deliver(self, message: SinkMessage) -> None:
+        """Store a received message and notify waiters."""
+        if self.maildir:
+            name = '{0:.6f}-{1}.eml'.format(message.received, os.getpid())
+            with open(os.path.join(self.maildir, name), 'wb') as f:
+                f.write(message.data)
+        if self.on_message:
+            self.on_message(message)
+
+        with self._cond:
+            self.count += 1
+            if self.keep:
+                self.messages.append(message)
+            self._cond.notify_all()
+
+    def wait_for(self, receiver: str, timeout: float=10.0) -> 'SinkMessage | None':
+        """Wait for (and remove) the first message sent to 'receiver'."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                for i, message in enumerate(self.messages):
+                    if receiver in message.receivers:
+                        return self.messages.pop(i)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    def wait_count(self, count: int, timeout: float=10.0) -> bool:
+        """Wait until at least 'count' messages have been received."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.count >= count, timeout)
+
+    def start(self) -> 'SMTPSink':
+        """Serve in a background daemon thread."""
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        """Stop serving and close the listening socket."""
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=1025)
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help='seconds to wait before each reply')
+    parser.add_argument('--maildir', help='directory to save messages in')
+    args = parser.parse_args()
+
+    sink = SMTPSink(args.host, args.port, delay=args.delay,
+                    maildir=args.maildir, keep=False,
+                    on_message=lambda m: print('[SINK]', m.sender, '->',
+                                               ', '.join(m.receivers)))
+    print('[SINK] Listening on {0}:{1}'.format(args.host, sink.port))
+    try:
+        sink.serve_forever()
+    except KeyboardInterrupt:
+        sink.server_close()
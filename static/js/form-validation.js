@@ -18,3 +18,53 @@
   })
 })()
 
+
+// Tell users while they type if a username or mobile number is taken.
+// Inputs opt in with data-availability='username' or 'mobile'.
+(() => {
+  'use strict'
+
+  const inputs = document.querySelectorAll('[data-availability]')
+
+  Array.from(inputs).forEach(input => {
+    const field = input.dataset.availability
+    const feedback = input.parentElement.querySelector('.invalid-feedback')
+    let timer = null
+    let controller = null
+
+    const show = message => {
+      input.setCustomValidity(message)
+      input.classList.toggle('is-invalid', message !== '')
+      if (feedback) {
+        feedback.textContent = message
+      }
+    }
+
+    input.addEventListener('input', () => {
+      clearTimeout(timer)
+      show('')
+      const value = input.value.trim()
+      if (!value) {
+        return
+      }
+
+      // Wait for a pause in typing, and drop answers for older values.
+      timer = setTimeout(() => {
+        if (controller) {
+          controller.abort()
+        }
+        controller = new AbortController()
+        const url = '/api/availability?' + new URLSearchParams({ [field]: value })
+        fetch(url, { signal: controller.signal })
+          .then(response => response.ok ? response.json() : null)
+          .then(result => {
+            // Invalid values are left to the form's own checks.
+            if (result && result.valid && !result.available) {
+              show(input.dataset.takenMessage || 'Already taken.')
+            }
+          })
+          .catch(() => {})
+      }, 250)
+    })
+  })
+})()
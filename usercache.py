@@ -0,0 +1,144 @@
+"""Read-through cache of user records for crud.
+
+Records are cached under both their id and their (lowercased) username
+in two tiers:
+
+    - a small LRU store private to each worker, with a short TTL
+    - optionally, a kvstore store shared by all workers (a uWSGI cache),
+      with a longer TTL
+
+Writes through crud drop a user's entries from this worker's tier and
+the shared one. Other workers' private entries can lag behind a write
+for at most the private TTL, so keep it short.
+
+Password hashes are never cached: they are removed from a record before
+it is stored, and login reads the hash from the database every time.
+"""
+from decimal import Decimal
+from threading import Lock
+
+from flask.json.tag import JSONTag, TaggedJSONSerializer
+
+from kvstore import LRUStore
+
+# Columns never kept in the cache.
+UNCACHED_COLUMNS = ('password',)
+
+
+class TagDecimal(JSONTag):
+    """Keep DECIMAL columns (such as mobile_num) exact through JSON."""
+
+    __slots__ = ('serializer',)
+    key = ' dec'
+
+    def check(self, value: object) -> bool:
+        return isinstance(value, Decimal)
+
+    def to_json(self, value: Decimal) -> str:
+        return str(value)
+
+    def to_python(self, value: str) -> Decimal:
+        return Decimal(value)
+
+
+class UserCache():
+    """Two-tier cache of user records keyed by id and username.
+
+    Attributes:
+        - local: this worker's LRUStore
+        - shared: store visible to all workers, or None
+        - local_ttl: seconds a record stays in the worker's tier
+        - shared_ttl: seconds a record stays in the shared tier
+        - counters: local and shared hits, misses and invalidations
+    """
+
+    def __init__(self, maxsize: int=1000, shared: object=None,
+                 local_ttl: float=5.0, shared_ttl: float=300.0) -> None:
+        self.local = LRUStore(maxsize)
+        self.shared = shared
+        self.local_ttl = local_ttl
+        self.shared_ttl = shared_ttl
+        self.counters = {'hits': 0, 'shared_hits': 0, 'misses': 0,
+                         'invalidations': 0, 'errors': 0}
+        self.serializer = TaggedJSONSerializer()
+        self.serializer.register(TagDecimal, index=0)
+        self._lock = Lock()
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    @staticmethod
+    def _keys(uid: int=None, username: str=None) -> list[str]:
+        keys = []
+        if uid is not None:
+            keys.append('user:id:{}'.format(uid))
+        if username is not None:
+            # Usernames compare case-insensitively in the database.
+            keys.append('user:name:{}'.format(username.lower()))
+        return keys
+
+    def _read(self, key: str) -> tuple['bytes | None', str]:
+        """Look a key up in both tiers; return the data and the tier."""
+        data = self.local.get(key)
+        if data is not None:
+            return data, 'hits'
+        if self.shared is not None:
+            try:
+                data = self.shared.get(key)
+            except Exception as e:
+                # The database is still there to answer.
+                self._count('errors')
+                print('[USERCACHE] Shared store error: ', str(e))
+            if data is not None:
+                self.local.set(key, data, self.local_ttl)
+                return data, 'shared_hits'
+        return None, 'misses'
+
+    def get(self, uid: int=None, username: str=None) -> 'dict | None':
+        """Return the cached record of a user given one of its keys."""
+        data, tier = self._read(self._keys(uid, username)[0])
+        self._count(tier)
+        return self.serializer.loads(data) if data is not None else None
+
+    def put(self, record: dict) -> None:
+        """Cache a user record (without its password hash)."""
+        record = {k: v for k, v in record.items() if k not in UNCACHED_COLUMNS}
+        data = self.serializer.dumps(record).encode('utf-8')
+        for key in self._keys(record['id'], record['username']):
+            self.local.set(key, data, self.local_ttl)
+            if self.shared is not None:
+                try:
+                    self.shared.set(key, data, self.shared_ttl)
+                except Exception as e:
+                    self._count('errors')
+                    print('[USERCACHE] Shared store error: ', str(e))
+
+    def invalidate(self, uid: int=None, username: str=None) -> None:
+        """Drop a user's entries after a write, given one or both keys."""
+        # The cached record, if any, knows the other key.
+        if uid is None or username is None:
+            data = self._read(self._keys(uid, username)[0])[0]
+            if data is not None:
+                record = self.serializer.loads(data)
+                uid, username = record['id'], record['username']
+
+        for key in self._keys(uid, username):
+            self.local.delete(key)
+            if self.shared is not None:
+                try:
+                    self.shared.delete(key)
+                except Exception as e:
+                    self._count('errors')
+                    print('[USERCACHE] Shared store error: ', str(e))
+        self._count('invalidations')
+
+    def stats(self) -> dict:
+        """Return counters and the ratio of lookups answered by a tier."""
+        with self._lock:
+            stats = dict(self.counters)
+        lookups = stats['hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_ratio'] = round((stats['hits'] + stats['shared_hits']) / lookups, 4) \
+            if lookups else 0.0
+        stats['entries'] = len(self.local)
+        return stats
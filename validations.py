@@ -1,31 +1,53 @@
 """Boolean functions for validating input.
 An Exception for handling invalid inputs.
+Declarative schemas validating whole forms in a single pass.
 """
+from calendar import monthrange
 from datetime import datetime
-from re import fullmatch
+from re import compile, fullmatch, Pattern
+
+# Regular expressions are compiled once, at import.
+NON_EMPTY_RE = compile(r'.*\S.*')
+EMAIL_RE = compile(r'[a-zA-Z0-9.!#$%&\'*+\/=?^_`{|}~-]+'
+                   r'@[a-zA-Z0-9]'
+                   r'(?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])'
+                   r'?(?:\.[a-zA-Z0-9]'
+                   r'(?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)*')
+USERNAME_RE = compile(r'[\w\-\.]{4,}')
+PASSWORD_RE = compile(r'(?=.*[a-z])(?=.*[A-Z])(?=.*\d)(?=.*[@$!%*?&\.])[A-Za-z\d@$!%*?&\.]{8,}')
+CARD_NAME_RE = compile(r'[A-Z]+ [A-Z]+')
 
 
 class ValidationError(Exception):
-    pass
+    """Invalid user input.
+
+    Attributes:
+        - errors: every problem found, when a whole form was checked
+    """
+
+    def __init__(self, message: str=None, errors: list=None) -> None:
+        self.errors = errors or ([message] if message else [])
+        super().__init__(message or ' '.join(self.errors))
 
 
 def range_validator(value: int, min: int, max: int) -> bool:
     """Check if a (numeric) value is within min/max constraints."""
     # Both min and max are inclusive.
     if min <= max:
-        if value in range(min, max+1):
-            return True
-        return False
+        return min <= value <= max
 
     print("Invalid range constraints.")
     return False
 
 
-def regex_validator(to_check: str, regex: str) -> bool:
+def regex_validator(to_check: str, regex: 'str | Pattern') -> bool:
     """Match the given string against given regular expression.
 
     Ignores trailing whitespace in the string 'to_check'.
+    The expression can be a pattern string or a compiled pattern.
     """
+    if isinstance(regex, Pattern):
+        return regex.fullmatch(to_check.rstrip()) is not None
     if fullmatch(regex, to_check.rstrip()):
         return True
     return False
@@ -61,7 +83,7 @@ def type_validator(type: str, valid_types: tuple):
 
 def non_empty(name: str) -> bool:
     """Check if a name has (except from trailing) whitespace."""
-    return regex_validator(name, r'.*\S.*')
+    return regex_validator(name, NON_EMPTY_RE)
 
 
 def is_email(mail_addr: str) -> bool:
@@ -69,13 +91,7 @@ def is_email(mail_addr: str) -> bool:
 
     Uses RFC 5322 as a reference.
     """
-    email_regex = (r'[a-zA-Z0-9.!#$%&\'*+\/=?^_`{|}~-]+'
-                   r'@[a-zA-Z0-9]'
-                   r'(?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])'
-                   r'?(?:\.[a-zA-Z0-9]'
-                   r'(?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)*')
-
-    return regex_validator(mail_addr, email_regex)
+    return regex_validator(mail_addr, EMAIL_RE)
 
 
 def is_decimal_str(num: str, ntotal: int, nprecision: int=0) -> bool:
@@ -126,7 +142,7 @@ def is_username(username: str) -> bool:
         - period     ->  '.'
     Password must also have at least 4 characters.
     """
-    return regex_validator(username, r'[\w\-\.]{4,}')
+    return regex_validator(username, USERNAME_RE)
 
 def is_password(password: str) -> bool:
     """Validates a password string according to set conditions.
@@ -142,7 +158,7 @@ def is_password(password: str) -> bool:
     Character type conditions are checked using a positive lookahead.
     """
     # TODO: Indicate which condition the password doesn't meet.
-    return regex_validator(password, r'(?=.*[a-z])(?=.*[A-Z])(?=.*\d)(?=.*[@$!%*?&\.])[A-Za-z\d@$!%*?&\.]{8,}')
+    return regex_validator(password, PASSWORD_RE)
 
 
 def is_correct_date(date: str, date_format: str='%Y-%m-%d') -> bool:
@@ -160,15 +176,171 @@ def is_correct_date(date: str, date_format: str='%Y-%m-%d') -> bool:
     try:
         input_date_obj = datetime.strptime(date, date_format)
     # If date is not in given date format.
-    except ValueError as e:
-        print(str(e))
+    except ValueError:
         return False
 
+    # Truncate today's date to the format's precision, e.g. month for '%Y-%m'.
     today_date = datetime.now().strftime(date_format)
     today_date_obj = datetime.strptime(today_date, date_format)
 
-    print('input date: ', input_date_obj, '\ntoday date: ', today_date_obj)
     # Only future and present dates are valid.
-    if input_date_obj >= today_date_obj:
-        return True
-    return False
+    return input_date_obj >= today_date_obj
+
+
+BLANK_FIELDS = 'One or more fields were left blank.'
+
+
+def card_expiry(value: str) -> datetime:
+    """Convert a 'YYYY-MM' card expiry into the last day of that month.
+
+    Raises ValueError for malformed or already passed expiry months.
+    """
+    # Fixed width format is parsed without going through strptime.
+    if len(value) != 7 or value[4] != '-':
+        raise ValueError(value)
+    year, month = int(value[:4]), int(value[5:])
+    if not 1 <= month <= 12:
+        raise ValueError(value)
+
+    today = datetime.now()
+    if (year, month) < (today.year, today.month):
+        raise ValueError(value)
+    return datetime(year, month, monthrange(year, month)[1])
+
+
+class Field():
+    """Declarative description of one form field.
+
+    Attributes:
+        - name: name of the field in the submitted form
+        - key: key of the cleaned value (defaults to 'name')
+        - message: error reported when the field is invalid
+        - maxlen: length the raw value is cut down to before checks
+        - pattern: regular expression the value must fully match
+                   (trailing whitespace ignored)
+        - choices: collection of allowed values
+        - coerce: callable converting the checked string (ValueError
+                  marks the value invalid)
+        - min/max: inclusive bounds of the coerced value
+    """
+
+    def __init__(self, name: str, message: str, key: str=None,
+                 maxlen: int=None, pattern: str=None, choices: tuple=None,
+                 coerce: object=None, min: int=None, max: int=None) -> None:
+        """Store field rules, compiling the pattern once."""
+        self.name = name
+        self.key = key or name
+        self.message = message
+        self.maxlen = maxlen
+        self.pattern = compile(pattern) if isinstance(pattern, str) else pattern
+        self.choices = frozenset(choices) if choices else None
+        self.coerce = coerce
+        self.min = min
+        self.max = max
+
+    def clean(self, raw: str) -> object:
+        """Return the checked and coerced value or raise ValueError."""
+        value = raw[:self.maxlen] if self.maxlen else raw
+        if self.pattern and self.pattern.fullmatch(value.rstrip()) is None:
+            raise ValueError(self.message)
+        if self.choices is not None and value not in self.choices:
+            raise ValueError(self.message)
+        if self.coerce:
+            try:
+                value = self.coerce(value)
+            except (TypeError, ValueError):
+                raise ValueError(self.message)
+        if ((self.min is not None and value < self.min)
+                or (self.max is not None and value > self.max)):
+            raise ValueError(self.message)
+        return value
+
+
+class FormSchema():
+    """Validate and coerce all fields of a form in one pass.
+
+    Attributes:
+        - fields: Field objects checked in order
+        - checks: (predicate, message) pairs run on the cleaned data
+                  when every field is valid
+
+    Every problem is collected, so a user sees all of them at once.
+    """
+
+    def __init__(self, *fields: Field, checks: tuple=()) -> None:
+        self.fields = fields
+        self.checks = checks
+
+    def clean(self, form: 'Mapping') -> tuple[dict, list]:
+        """Return cleaned data and a list of error messages."""
+        data = {}
+        errors = []
+        for field in self.fields:
+            raw = form.get(field.name)
+            if raw is None:
+                if BLANK_FIELDS not in errors:
+                    errors.append(BLANK_FIELDS)
+                continue
+            try:
+                data[field.key] = field.clean(raw)
+            except ValueError as e:
+                errors.append(str(e))
+
+        if not errors:
+            for predicate, message in self.checks:
+                if not predicate(data):
+                    errors.append(message)
+        return data, errors
+
+    def validate(self, form: 'Mapping') -> dict:
+        """Return cleaned data or raise ValidationError with all errors."""
+        data, errors = self.clean(form)
+        if errors:
+            raise ValidationError(errors=errors)
+        return data
+
+
+REGISTRATION_FORM = FormSchema(
+    Field('fname', 'Invalid first name.', key='first_name', maxlen=128,
+          pattern=NON_EMPTY_RE),
+    Field('lname', 'Invalid last name.', key='last_name', maxlen=128,
+          pattern=NON_EMPTY_RE),
+    Field('age', 'Your age is inappropriate for registration.', coerce=int,
+          min=18, max=150),
+    Field('gender', 'Unknown gender type.', choices=('Male', 'Female', 'Unsaid')),
+    Field('email', 'Invalid email address provided.', maxlen=256,
+          pattern=EMAIL_RE),
+    Field('mobile-num', 'Invalid phone number.', key='mobile_num',
+          pattern=r'[0-9]{10}', coerce=int),
+    Field('addr', 'Invalid address.', key='address', maxlen=256,
+          pattern=NON_EMPTY_RE),
+)
+
+CARD_FORM = FormSchema(
+    Field('card-name', 'Enter a valid card name.', key='name', maxlen=32,
+          pattern=CARD_NAME_RE),
+    Field('card-type', 'Unknown card type.', key='type',
+          choices=('Credit', 'Debit')),
+    Field('card-number', 'Invalid card number.', key='number',
+          pattern=r'[0-9]{16}', coerce=int),
+    Field('card-cvv', 'Invalid CVV.', key='cvv', pattern=r'[0-9]{3}',
+          coerce=int),
+    Field('card-expiry', 'Card is already expired or invalid card expiry date.',
+          key='expiry', coerce=card_expiry),
+)
+
+SIGNUP_FORM = FormSchema(
+    Field('username', ('Username can only contain alphabets, numerals, '
+                       'underscores, hyphens and periods.'),
+          maxlen=64, pattern=USERNAME_RE),
+    Field('password', ('Password must contain at least 8 characters with at '
+                       'least a lowercase alphabet, an uppercase alphabet, a '
+                       'numeral and one of @$!%*?&.'),
+          maxlen=64, pattern=PASSWORD_RE),
+    Field('confirm-password', 'Passwords do not match.', key='confirm_password',
+          maxlen=64),
+    checks=((lambda d: d['password'] == d['confirm_password'],
+             'Passwords do not match.'),
+            (lambda d: d['password'] != d['username'],
+             'Username cannot be the password.')),
+)
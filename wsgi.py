@@ -1,4 +1,8 @@
-from main import app
+from main import create_app
+
+# Created at import, so uWSGI builds the app in the master process
+# (unless 'lazy-apps' is set) and forks workers that share it.
+app = create_app()
 
 if __name__ == "__main__":
     app.run()